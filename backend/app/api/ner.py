@@ -1,3 +1,4 @@
+import math
 import os
 from typing import Optional
 from pathlib import Path
@@ -6,12 +7,14 @@ import numpy as np
 import requests
 import spacy
 import torch
-from fastapi import APIRouter, Body, HTTPException
+from fastapi import APIRouter, Body, HTTPException, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from transformers import BertForSequenceClassification, BertTokenizer
 
 from app.config import biolink_context, settings
+from app.deadline import Deadline
+from app.disconnect import run_until_disconnected
 
 router = APIRouter()
 
@@ -67,8 +70,18 @@ def curie_to_uri(curie: str):
     response_model={},
 )
 async def get_entities_relations(
-    input: NerInput = Body(...), extract_relations: Optional[bool] = True
+    request: Request, input: NerInput = Body(...), extract_relations: Optional[bool] = True
 ):
+    # The extraction is stopped if the client disconnects, there is no time limit
+    deadline = Deadline(math.inf)
+    return await run_until_disconnected(
+        request, deadline.cancel, extract_entities_relations, input.text, extract_relations, deadline
+    )
+
+
+def extract_entities_relations(text: str, extract_relations: bool, deadline: Deadline):
+    """Extract entities and relations from a text (blocking, run in the threadpool),
+    raise DeadlineExceededError if the deadline is cancelled"""
     # Loading models for NER
     ner = spacy.load(Rf"{settings.NER_MODELS_PATH}/litcoin-ner-model")
     # Loading models for relations extraction
@@ -84,12 +97,14 @@ async def get_entities_relations(
     model.to(device)
     print("✅ Models for NER and relations extraction loaded")
 
-    ner_res = ner(input.text)
+    deadline.check()
+    ner_res = ner(text)
 
     entities_extracted = []
     # Extract entities
     i = 0
     for ent in ner_res.ents:
+        deadline.check()
         # print(ent.text, ent.start_char, ent.end_char, ent.label_)
         entity = {
             "index": f"{ent.text}:{i}:{ent.start_char}:{ent.end_char}",
@@ -155,7 +170,7 @@ async def get_entities_relations(
                     if rel_exists is False:
                         potential_relations.append(
                             {
-                                "sentence": input.text,
+                                "sentence": text,
                                 "entity1": ent1["text"],
                                 "entity2": ent2["text"],
                             }
@@ -164,6 +179,7 @@ async def get_entities_relations(
         # Extract relations from each entity pairing
         relations_extracted = []
         for rel in potential_relations:
+            deadline.check()
             extracted_rel = classify_relation(rel, device, tokenizer, model)
             if extracted_rel:
                 relations_extracted.append(extracted_rel)
@@ -1,11 +1,13 @@
-from time import sleep
+import math
 
 import openai
 import yaml
-from fastapi import APIRouter, Body, HTTPException
+from fastapi import APIRouter, Body, HTTPException, Request
 from pydantic import BaseModel
 
 from app.config import logger, settings
+from app.deadline import Deadline
+from app.disconnect import run_until_disconnected
 
 # Check available engines at https://platform.openai.com/docs/models/overview
 default_model = "gpt-3.5-turbo"
@@ -43,7 +45,8 @@ class NerInput(BaseModel):
     response_description="Entities and relations extracted from the given text",
     response_model={},
 )
-def get_entities_relations_openai(
+async def get_entities_relations_openai(
+    request: Request,
     input: NerInput = Body(...),
     prompt: str = default_prompt,
     model: str = default_model,
@@ -59,7 +62,14 @@ def get_entities_relations_openai(
             status_code=400,
             detail=f"The provided engine {model} does not exist, please use on of {' ,'.join(model_list)}",
         )
+    # The retries are stopped if the client disconnects, there is no time limit
+    deadline = Deadline(math.inf)
+    return await run_until_disconnected(request, deadline.cancel, extract_openai, input.text, prompt, model, deadline)
 
+
+def extract_openai(text: str, prompt: str, model: str, deadline: Deadline):
+    """Extract entities and relations from a text with OpenAI (blocking, run in the threadpool),
+    raise DeadlineExceededError if the deadline is cancelled between attempts"""
     prompt = f"""{prompt}
 
 Text:
@@ -67,10 +77,11 @@ Text:
     i = 0
     response = None
     while not response:
+        deadline.check()
         i += 1
         logger.debug(f"Calling OpenAI API (attempt {i})...")
         print(f"Calling OpenAI API (attempt {i})...")
-        send_prompt = prompt + input.text + '"'
+        send_prompt = prompt + text + '"'
         try:
             if model in chat_models:
                 response = openai.ChatCompletion.create(
@@ -93,7 +104,8 @@ Text:
                 raise e
             sleep_time = 4**i
             logger.info(f"Retrying {i} of {NUM_RETRIES} after {sleep_time} seconds...")
-            sleep(sleep_time)
+            # Wait before retrying, unless the request is cancelled
+            deadline.cancelled.wait(sleep_time)
         logger.debug(response)
         print(response)
 
@@ -1,9 +1,23 @@
-from fastapi import APIRouter, Body
-from fastapi.responses import JSONResponse
+from typing import Optional
+
+from fastapi import APIRouter, Body, Header, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from reasoner_pydantic import Query
 
+from app.config import settings
+from app.deadline import Deadline
+from app.disconnect import iter_until_disconnected, run_until_disconnected
+from app.trapi.async_jobs import COMPLETED, FAILED, check_callback_url, get_job, submit_job
+from app.trapi.batch import answer_batch
 from app.trapi.openapi import TRAPI_EXAMPLE
-from app.trapi.reasonerapi_parser import get_metakg_from_nanopubs, reasonerapi_to_sparql
+from app.trapi.reasonerapi_parser import (
+    check_reasoner_query,
+    get_metakg_from_nanopubs,
+    get_query_deadline,
+    reasonerapi_to_sparql,
+)
+from app.trapi.streaming import iter_trapi_response
+from app.trapi.validation import check_query, should_validate, validate_query, validate_response
 
 # from typing import Optional, Dict
 
@@ -22,46 +36,268 @@ The following `query_options` are available:
     "in_index": "http://purl.org/np/RAaZp4akBZI6FuRzIpeksyYxTArOtxqmhuv9on-YssEzA"
   }
 ```
+
+When more results are available, the response `query_options` contains a `next_cursor`: send the same query with `"cursor": "<next_cursor>"` in `query_options` to get the next page of results.
+
+Only return some edge attributes with `"attributes": ["biolink:publications"]` in `query_options` (`[]` for none), and no qualifiers with `"qualifiers": false`:
+the properties which are not needed are not retrieved, to get smaller responses faster.
+
+The `workflow` operations `lookup`, `filter_results_top_n` and `filter_kgraph_orphans` are supported, e.g. `"workflow": [{"id": "lookup"}, {"id": "filter_results_top_n", "parameters": {"max_results": 10}}]`.
+
+The `qualifier_constraints` and `attribute_constraints` (operators `==`, `>`, `<`, `matches` and `===`) of the query graph edges are supported:
+they are applied in the SPARQL queries when possible, so only the matching edges are retrieved.
+
+The `categories` and `predicates` of the query graph also match their BioLink descendants, e.g. `biolink:ChemicalEntity` matches `biolink:Drug` nodes.
+
+Set `"engine": "sqlite"` in `query_options` to answer from the local edge store mirroring the Nanopublication network instead of its SPARQL endpoint,
+or `"engine": "csr"` to answer queries with pinned ids from its memory-mapped snapshot.
+
+Query graphs with multiple edges are decomposed in one-hop queries, executed concurrently when independent, and joined in the results.
+
+Use `?stream=true` to receive the response in chunks: the query graph is sent right away to keep the connection busy,
+then the knowledge graph and results are serialized piece by piece once the query is answered (the answer is still built in full before).
+
+The time budget of the query (in seconds) can be set with the `X-Request-Timeout` header or `"timeout"` in `query_options`.
+When it runs out, the results already retrieved are returned, with a log saying they are truncated.
+The query is cancelled if the client disconnects before receiving the response.
 """,
     response_model=Query,
+    # The body is received as a dict to skip the pydantic parsing, the TRAPI Query schema is still documented
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": {"$ref": "#/components/schemas/Query"}}},
+            "required": True,
+        }
+    },
     tags=["trapi"],
     # tags=["reasoner"],
 )
-def post_reasoner_query(
-    request_body: Query = Body(..., example=TRAPI_EXAMPLE)
+async def post_reasoner_query(
+    request: Request,
+    request_body: dict = Body(..., example=TRAPI_EXAMPLE),
+    stream: bool = False,
+    x_request_timeout: Optional[str] = Header(None),
 ) -> Query:
     """Get associations for a given ReasonerAPI query.
 
+    The query and the response are handled as dicts, and only a sample of them is validated
+    against the TRAPI models (see app.trapi.validation). The query runs in the threadpool,
+    and is cancelled if the client disconnects (see app.disconnect).
+
     :param request_body: The ReasonerStdAPI query in JSON
+    :param stream: Send the query graph first, then serialize the response in chunks instead of at once
+    :param x_request_timeout: Time budget of the query in seconds
     :return: Results as a ReasonerStdAPI Message
     """
-    query_graph = request_body.message.query_graph.dict(exclude_none=True)
-    print(query_graph)
-    if len(query_graph["edges"]) == 0:
-        return (
-            {
-                "status": 400,
-                "title": "Bad Request",
-                "detail": "No edges",
-                "type": "about:blank",
-            },
-            400,
+    try:
+        query_graph = check_query(request_body)
+    except ValueError as e:
+        return bad_request(str(e))
+    if settings.DEV_MODE:
+        print(query_graph)
+    try:
+        # The deadline starts when the request is received
+        deadline = get_query_deadline(request_body, x_request_timeout)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    def cancel():
+        # Stops waiting for an identical query in flight, or cancels the query once no coalesced query waits for it
+        reasonerapi_to_sparql.cancel(request_body, deadline=deadline)
+
+    validate = should_validate()
+    if stream:
+        if validate:
+            validate_query(request_body)
+        try:
+            # The status code is sent with the first chunk, invalid queries are rejected before streaming
+            check_reasoner_query(request_body)
+        except ValueError as e:
+            return bad_request(str(e))
+        return StreamingResponse(
+            iter_until_disconnected(
+                iter_trapi_response(request_body, lambda query: reasonerapi_to_sparql(query, deadline=deadline)),
+                cancel,
+            ),
+            media_type="application/json",
         )
-    if len(query_graph["edges"]) > 1:
-        return (
-            {
-                "status": 501,
-                "title": "Not Implemented",
-                "detail": "Multi-edges queries not yet implemented",
-                "type": "about:blank",
+    return await run_until_disconnected(request, cancel, answer_query, request_body, deadline, validate)
+
+
+def answer_query(request_body, deadline, validate=False):
+    """Answer a TRAPI query and serialize the response (blocking, run in the threadpool)"""
+    if validate:
+        validate_query(request_body)
+    try:
+        reasonerapi_response = reasonerapi_to_sparql(request_body, deadline=deadline)
+    except ValueError as e:
+        return bad_request(str(e))
+    if validate:
+        validate_response(reasonerapi_response)
+    return ORJSONResponse(reasonerapi_response)
+
+
+@router.post(
+    "/batch_query",
+    name="Query the Nanopublication network with a batch of TRAPI queries",
+    description=f"""Execute a list of Translator Reasoner API queries (at most {settings.TRAPI_MAX_BATCH_SIZE}), and get the list of their responses, in the same order.
+
+One-hop queries which only differ by the ids pinned on one of their nodes (e.g. the same pattern for hundreds of drugs) are merged:
+they are answered together by the same SPARQL queries, and their results are split back per query.
+Pagination is not available for merged queries: queries with a `cursor` are answered one by one.
+
+The time budget of the whole batch (in seconds) can be set with the `X-Request-Timeout` header, or the smallest `"timeout"` in the `query_options`.
+""",
+    response_model=list[dict],
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {"schema": {"type": "array", "items": {"$ref": "#/components/schemas/Query"}}}
             },
-            501,
+            "required": True,
+        }
+    },
+    tags=["trapi"],
+)
+async def post_batch_query(
+    request: Request,
+    request_body: list = Body(..., example=[TRAPI_EXAMPLE]),
+    x_request_timeout: Optional[str] = Header(None),
+) -> list[dict]:
+    """Get the responses of a list of ReasonerAPI queries, see app.trapi.batch
+
+    :param request_body: List of ReasonerStdAPI queries in JSON
+    :param x_request_timeout: Time budget of the batch in seconds
+    :return: List of the ReasonerStdAPI responses
+    """
+    if len(request_body) > settings.TRAPI_MAX_BATCH_SIZE:
+        return bad_request(f"The batch contains more than {settings.TRAPI_MAX_BATCH_SIZE} queries")
+    # Each query is checked before the compatible queries are grouped
+    for i, reasoner_query in enumerate(request_body):
+        try:
+            check_query(reasoner_query)
+        except ValueError as e:
+            return bad_request(f"Invalid query {i}: {e}")
+    try:
+        deadline = Deadline.from_timeouts(
+            x_request_timeout,
+            *[(reasoner_query.get("query_options") or {}).get("timeout") for reasoner_query in request_body],
+            default=settings.TRAPI_TIMEOUT,
         )
+    except ValueError as e:
+        return bad_request(str(e))
+    return await run_until_disconnected(request, deadline.cancel, answer_batch_query, request_body, deadline)
+
+
+def answer_batch_query(request_body, deadline):
+    """Answer a batch of TRAPI queries and serialize the responses (blocking, run in the threadpool)"""
+    return ORJSONResponse(answer_batch(request_body, deadline))
+
+
+@router.post(
+    "/asyncquery",
+    name="Query the Nanopublication network asynchronously with TRAPI",
+    description=f"""Queue a Translator Reasoner API query, and get its job ID immediately.
+
+The query is executed in the background, with a time budget of {settings.ASYNC_QUERY_TIMEOUT:g} seconds (or its `"timeout"` in `query_options`).
+Its response is then POSTed to the URL in the `callback` property of the query, and can be retrieved from `/asyncquery_status/{{job_id}}`.
+The queued queries are persisted, and still executed if the service restarts.
+""",
+    response_model=dict,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "allOf": [
+                            {"$ref": "#/components/schemas/Query"},
+                            {
+                                "type": "object",
+                                "properties": {"callback": {"type": "string", "format": "uri"}},
+                                "required": ["callback"],
+                            },
+                        ]
+                    }
+                }
+            },
+            "required": True,
+        }
+    },
+    tags=["trapi"],
+)
+def post_async_query(
+    request_body: dict = Body(..., example={**TRAPI_EXAMPLE, "callback": "https://example.org/callback"}),
+) -> dict:
+    """Queue an asynchronous ReasonerAPI query, see app.trapi.async_jobs
+
+    :param request_body: The ReasonerStdAPI query in JSON, with a callback URL
+    :return: The ID of the job answering the query
+    """
+    try:
+        check_query(request_body)
+    except ValueError as e:
+        return bad_request(str(e))
+    callback = request_body.get("callback")
+    if not isinstance(callback, str) or not callback.startswith(("http://", "https://")):
+        return bad_request("The query must contain the HTTP URL its response is sent to in callback")
+    try:
+        check_callback_url(callback)
+    except ValueError as e:
+        return bad_request(str(e))
+    try:
+        get_query_deadline(request_body)
+    except ValueError as e:
+        return bad_request(str(e))
+    job_id = submit_job(request_body, callback)
+    return {"status": "Accepted", "description": "The query was queued", "job_id": job_id}
+
+
+@router.get(
+    "/asyncquery_status/{job_id}",
+    name="Get the status of an asynchronous TRAPI query",
+    description="Get the status of an asynchronous query: Queued, Running, Completed or Failed, and the URL of its response once done",
+    response_model=dict,
+    tags=["trapi"],
+)
+def get_async_query_status(request: Request, job_id: str) -> dict:
+    job = get_job(job_id)
+    if job is None:
+        return not_found(f"No asynchronous query with the job ID {job_id}")
+    status = {"status": job["status"], "description": job["description"], "logs": []}
+    if job["response"] is not None:
+        status["logs"] = job["response"].get("logs") or []
+        status["response_url"] = str(request.url_for("get_async_query_response", job_id=job_id))
+    return status
+
+
+@router.get(
+    "/asyncquery_response/{job_id}",
+    name="get_async_query_response",
+    description="Get the TRAPI response of an asynchronous query once it is completed or failed",
+    response_model=Query,
+    tags=["trapi"],
+)
+def get_async_query_response(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return not_found(f"No asynchronous query with the job ID {job_id}")
+    if job["status"] not in (COMPLETED, FAILED):
+        return not_found(f"The asynchronous query {job_id} is not done yet, its status is {job['status']}")
+    return ORJSONResponse(job["response"])
+
+
+def bad_request(detail):
+    return ORJSONResponse(
+        {"status": 400, "title": "Bad Request", "detail": detail, "type": "about:blank"},
+        status_code=400,
+    )
 
-    reasonerapi_response = reasonerapi_to_sparql(request_body.dict(exclude_none=True))
-    # reasonerapi_response = request_body
 
-    return JSONResponse(reasonerapi_response) or ("Not found", 404)
+def not_found(detail):
+    return ORJSONResponse(
+        {"status": 404, "title": "Not Found", "detail": detail, "type": "about:blank"},
+        status_code=404,
+    )
 
 
 @router.get(
@@ -0,0 +1,215 @@
+"""Circuit breakers around upstream services, and a cache of their last good responses served while they fail
+
+A circuit breaker tracks the outcome and latency of the recent calls to a service. When too many of them fail
+or are slow, the circuit opens: calls fail immediately with CircuitOpenError instead of waiting for the service,
+so the worker threads are not piling up during an upstream incident. After CIRCUIT_OPEN_SECONDS a single trial
+call is let through (half-open): the circuit closes if it succeeds, and opens again otherwise.
+
+The StaleCache keeps the last good response of each call, served (marked stale) while the circuit is open
+or the call fails. The trial calls revalidate the cache, the other requests are not waiting for them.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+from app.config import settings
+from app.metrics import counter, get_metric
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+stale_responses = counter(
+    "stale_responses_total", "Number of upstream responses served from the cache while the upstream was failing"
+)
+
+
+class CircuitOpenError(Exception):
+    """The circuit of an upstream service is open, it is not called"""
+
+
+class CircuitBreaker:
+    """Circuit breaker tripped by the rate of failed or slow calls in a sliding window
+
+    :param name: Name of the upstream service, used in errors and metrics
+    :param window: Number of recent calls used to compute the failure and slow call rates
+    :param min_calls: Minimum number of calls in the window before the circuit can trip
+    :param failure_rate: Rate of failed calls opening the circuit
+    :param slow_call_rate: Rate of slow calls opening the circuit
+    :param slow_call_seconds: Duration after which a call is considered slow
+    :param open_seconds: Time the circuit stays open before a trial call
+    :param ignored_exceptions: Exceptions counted neither as a success nor a failure (e.g. cancellations)
+    """
+
+    def __init__(
+        self,
+        name,
+        window=20,
+        min_calls=5,
+        failure_rate=None,
+        slow_call_rate=0.8,
+        slow_call_seconds=None,
+        open_seconds=None,
+        ignored_exceptions=(),
+    ):
+        self.name = name
+        self.calls = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate if failure_rate is not None else settings.CIRCUIT_FAILURE_RATE
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = (
+            slow_call_seconds if slow_call_seconds is not None else settings.CIRCUIT_SLOW_CALL_SECONDS
+        )
+        self.open_seconds = open_seconds if open_seconds is not None else settings.CIRCUIT_OPEN_SECONDS
+        self.ignored_exceptions = ignored_exceptions
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+        circuit_breakers.breakers.append(self)
+
+    @property
+    def available(self):
+        """Check if the circuit is closed, or could let a trial call through"""
+        return self.state == CLOSED or (
+            not self.trial_running and time.monotonic() - self.opened_at >= self.open_seconds
+        )
+
+    def acquire(self):
+        """Check if a call can be made now, in half-open state a single trial call is allowed at a time"""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+            if self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+    def release(self):
+        """End a call without recording its outcome"""
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, failed, duration):
+        with self.lock:
+            slow = duration >= self.slow_call_seconds
+            if self.state != CLOSED:
+                self.trial_running = False
+                if failed or slow:
+                    self.trip()
+                else:
+                    self.state = CLOSED
+                    self.calls.clear()
+                return
+            self.calls.append((failed, slow))
+            if len(self.calls) >= self.min_calls and (
+                sum(call[0] for call in self.calls) >= self.failure_rate * len(self.calls)
+                or sum(call[1] for call in self.calls) >= self.slow_call_rate * len(self.calls)
+            ):
+                self.trip()
+
+    def trip(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+
+    def call(self, function, *args, **kwargs):
+        """Call a function through the circuit breaker, raise CircuitOpenError if the circuit is open"""
+        if not self.acquire():
+            raise CircuitOpenError(f"{self.name} is unavailable, its circuit breaker is open")
+        start = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except self.ignored_exceptions:
+            self.release()
+            raise
+        except Exception:
+            self.record(True, time.monotonic() - start)
+            raise
+        self.record(False, time.monotonic() - start)
+        return result
+
+
+class CircuitBreakerStates:
+    """Gauge of the state of each circuit breaker: 0 closed, 1 open, 0.5 half-open"""
+
+    kind = "gauge"
+    values = {CLOSED: 0, OPEN: 1, HALF_OPEN: 0.5}
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.breakers = []
+
+    def samples(self):
+        return [
+            (f'{self.name}{{upstream="{breaker.name}"}}', self.values[breaker.state]) for breaker in self.breakers
+        ]
+
+
+circuit_breakers = get_metric(
+    CircuitBreakerStates, "circuit_breaker_state", "State of the circuit breakers of the upstream services"
+)
+
+
+class StaleCache:
+    """Last good responses of upstream calls, served when the upstream fails
+
+    :param max_entries: Maximum number of responses kept, the least recently used are evicted
+    :param ignored_exceptions: Exceptions raised without serving the cached response (e.g. cancellations)
+    :param max_size: Maximum size of a response kept (e.g. number of rows), larger responses are not cached.
+        No limit if None
+    :param size: Function computing the size of a response
+    """
+
+    def __init__(self, max_entries, ignored_exceptions=(), max_size=None, size=len):
+        self.max_entries = max_entries
+        self.ignored_exceptions = ignored_exceptions
+        self.max_size = max_size
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Get the last good response for this key and its age in seconds, None if there is none"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stale_responses.inc()
+        return entry[0], time.monotonic() - entry[1]
+
+    def put(self, key, response):
+        """Keep the response, if it is not larger than max_size (the previous response for this key is then dropped)"""
+        if self.max_entries <= 0:
+            return
+        if self.max_size is not None and self.size(response) > self.max_size:
+            with self.lock:
+                self.entries.pop(key, None)
+            return
+        with self.lock:
+            self.entries[key] = (response, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def call(self, key, function, *args, **kwargs):
+        """Call a function, or get the last good response for this key if it fails
+
+        :return: Tuple with the response, and its age in seconds if it is stale (None if the call succeeded)
+        """
+        try:
+            response = function(*args, **kwargs)
+        except self.ignored_exceptions:
+            raise
+        except Exception:
+            stale = self.get(key)
+            if stale is None:
+                raise
+            return stale
+        self.put(key, response)
+        return response, None
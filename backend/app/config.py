@@ -31,6 +31,74 @@ class Settings(BaseSettings):
     NANOPUB_GRLC_URL: str = "https://grlc.np.dumontierlab.com/api/local/local"
     NANOPUB_SPARQL_URL: str = "https://virtuoso.nps.petapico.org/sparql"
     # NANOPUB_SPARQL_URL: str = "https://virtuoso.test.nps.knowledgepixels.com/sparql"
+    # Equivalent SPARQL endpoints of the Nanopublication network, queries are hedged and failed over between them
+    # (defaults to NANOPUB_SPARQL_URL only)
+    NANOPUB_SPARQL_URLS: list[str] = []
+    # Percentile of the primary endpoint recent latencies after which a query is hedged to the next endpoint
+    SPARQL_HEDGE_PERCENTILE: float = 0.95
+    # Timeout in seconds to read the response of a SPARQL endpoint
+    SPARQL_TIMEOUT: int = 60
+    # Default time budget in seconds of a TRAPI query, clients can set their own with the X-Request-Timeout header
+    # or the timeout query option. The results retrieved when it runs out are returned
+    TRAPI_TIMEOUT: float = 120
+    # Timeout in seconds of the requests to the grlc API
+    GRLC_TIMEOUT: int = 30
+    # Circuit breakers of the upstream services open when this rate of their recent calls failed, or when most
+    # of them took more than CIRCUIT_SLOW_CALL_SECONDS, and let a trial call through after CIRCUIT_OPEN_SECONDS
+    CIRCUIT_FAILURE_RATE: float = 0.5
+    CIRCUIT_SLOW_CALL_SECONDS: float = 20
+    CIRCUIT_OPEN_SECONDS: int = 30
+    # Number of SPARQL query results kept to be served (marked stale) while the endpoints fail
+    STALE_CACHE_SIZE: int = 128
+    # Maximum number of concurrent requests, and of requests started per second, to each SPARQL endpoint and to
+    # the grlc API. Set UPSTREAM_SLOTS_PATH to a directory shared by the workers to apply the limits to all of them
+    UPSTREAM_MAX_CONCURRENT: int = 8
+    UPSTREAM_MAX_PER_SECOND: float = 20
+    UPSTREAM_SLOTS_PATH: Optional[str] = None
+
+    # Maximum number of associations returned by a one-hop TRAPI query (or a page of results)
+    TRAPI_MAX_RESULTS: int = 10000
+    # Maximum number of SPARQL queries running concurrently for a single TRAPI query
+    TRAPI_MAX_PARALLEL_QUERIES: int = 4
+    # Maximum number of TRAPI queries in a request to /batch_query
+    TRAPI_MAX_BATCH_SIZE: int = 1000
+    # Maximum number of ids of a query node sent in a single SPARQL query, larger lists are queried in chunks
+    TRAPI_ID_CHUNK_SIZE: int = 200
+    # How edge properties are retrieved with SPARQL: "optional" (a single query with OPTIONAL blocks),
+    # or "batched" (edges first, then their properties in batched queries, without the cartesian product of rows)
+    TRAPI_DETAILS_MODE: str = "optional"
+    # Parse the SPARQL results of one-hop queries incrementally, and assemble the edges as the rows are received
+    # (in "optional" details mode), instead of loading the whole results first. Streamed queries are not hedged
+    TRAPI_STREAM_RESULTS: bool = True
+    # Seconds before checking if new indexes were appended to a cached nanopub index (query_options.in_index)
+    NP_INDEX_CACHE_TTL: int = 300
+    # Seconds between refreshes of the retracted and superseded nanopubs filtered client-side,
+    # 0 to filter retracted nanopubs in the SPARQL queries instead
+    RETRACTIONS_REFRESH_INTERVAL: int = 300
+    # Engine used to answer one-hop TRAPI queries: "sparql" (NANOPUB_SPARQL_URL), "sqlite" (local edge store),
+    # or "csr" (memory-mapped snapshot of the edge store for pinned ids, edge store otherwise)
+    TRAPI_ENGINE: str = "sparql"
+    # Validate 1 in N TRAPI queries and responses against the TRAPI models, 0 to disable (always validated in DEV_MODE)
+    TRAPI_VALIDATION_SAMPLE_RATE: int = 100
+    EDGE_STORE_PATH: str = "./edge-store.sqlite"
+    CSR_SNAPSHOT_PATH: str = "./edge-store.csr"
+    # Seconds between incremental syncs of the edge store with the Nanopublication network, 0 to disable
+    EDGE_STORE_SYNC_INTERVAL: int = 300
+    # Asynchronous TRAPI queries (/asyncquery) are persisted in ASYNC_QUERY_JOBS_PATH, and executed by
+    # ASYNC_QUERY_WORKERS threads in each worker process (0 to not execute them), with a time budget of
+    # ASYNC_QUERY_TIMEOUT seconds. Their responses are kept ASYNC_QUERY_RETENTION seconds
+    ASYNC_QUERY_JOBS_PATH: str = "./async-jobs.sqlite"
+    ASYNC_QUERY_WORKERS: int = 2
+    ASYNC_QUERY_TIMEOUT: float = 3600
+    ASYNC_QUERY_RETENTION: int = 7 * 24 * 3600
+    # Timeout in seconds of the requests sending the responses of asynchronous queries to their callback URL
+    ASYNC_QUERY_CALLBACK_TIMEOUT: int = 30
+    # Hosts the responses of asynchronous queries can be sent to (defaults to the hosts with public addresses only)
+    ASYNC_QUERY_CALLBACK_HOSTS: list[str] = []
+    # Expand the categories and predicates of the TRAPI queries to their BioLink descendants, with the closure of
+    # the BioLink hierarchies built once per BIOLINK_VERSION and cached in BIOLINK_CLOSURE_PATH
+    TRAPI_EXPAND_BIOLINK: bool = True
+    BIOLINK_CLOSURE_PATH: str = "./biolink-closure.json"
 
     # SERVER_NAME: str = 'localhost'
     # SERVER_HOST: AnyHttpUrl = 'http://localhost'
@@ -87,6 +155,10 @@ class Settings(BaseSettings):
         )
         self.KEYSTORE_PATH = self.DATA_PATH + "/nanopub-keystore"
         self.NER_MODELS_PATH = self.DATA_PATH + "/ner-models"
+        self.EDGE_STORE_PATH = self.DATA_PATH + "/edge-store.sqlite"
+        self.CSR_SNAPSHOT_PATH = self.DATA_PATH + "/edge-store.csr"
+        self.ASYNC_QUERY_JOBS_PATH = self.DATA_PATH + "/async-jobs.sqlite"
+        self.BIOLINK_CLOSURE_PATH = self.DATA_PATH + f"/biolink-closure-{self.BIOLINK_VERSION}.json"
 
 
 
@@ -0,0 +1,89 @@
+"""Time budget of a request, propagated to the upstream calls it makes
+
+A Deadline is created when a request is received and passed down to every SPARQL query it runs. The upstream
+calls use its remaining time as timeout, and stop reading their response once it has expired (or was cancelled).
+Work dropped because of the deadline marks it as truncated, so the response can report partial results.
+"""
+import threading
+import time
+from concurrent.futures import wait
+
+# Interval in seconds at which waits check if the deadline was cancelled
+POLL_INTERVAL = 0.1
+
+
+class DeadlineExceededError(Exception):
+    """The time budget of the request ran out, or the request was cancelled"""
+
+
+class Deadline:
+    """Point in time after which the work for a request should stop
+
+    :param seconds: Time budget of the request
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.cancelled = threading.Event()
+        self.truncated = False
+
+    @classmethod
+    def from_timeouts(cls, *timeouts, default):
+        """Create a deadline from the shortest of the timeouts provided (in seconds), or the default
+
+        :raise ValueError: if a timeout is not a positive number
+        """
+        seconds = []
+        for timeout in timeouts:
+            # Empty header or option values are not set
+            if timeout is None or (isinstance(timeout, str) and not timeout):
+                continue
+            try:
+                value = float(timeout)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid timeout: {timeout}") from None
+            if value <= 0:
+                raise ValueError(f"Invalid timeout: {timeout}, it should be a positive number of seconds")
+            seconds.append(value)
+        return cls(min(seconds) if seconds else default)
+
+    @property
+    def expired(self):
+        return self.cancelled.is_set() or time.monotonic() >= self.expires_at
+
+    def remaining(self):
+        """Remaining time in seconds, 0 once expired"""
+        if self.cancelled.is_set():
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, default):
+        """Timeout for an upstream call: the remaining time, at most default"""
+        return min(default, self.remaining())
+
+    def cancel(self):
+        """Stop the work for the request, e.g. when its client is gone"""
+        self.cancelled.set()
+
+    def check(self):
+        """Raise DeadlineExceededError if the deadline has expired"""
+        if self.cancelled.is_set():
+            raise DeadlineExceededError("The request was cancelled")
+        if self.expired:
+            raise DeadlineExceededError(f"The time budget of {self.seconds:g} seconds ran out")
+
+    def wait(self, futures):
+        """Wait for futures until the deadline, the ones not done are cancelled and the deadline marked truncated
+
+        :return: Set of the futures done
+        """
+        pending = set(futures)
+        # Wake up regularly to stop waiting as soon as the deadline is cancelled
+        while pending and not self.expired:
+            _done, pending = wait(pending, timeout=min(self.remaining(), POLL_INTERVAL))
+        if pending:
+            self.truncated = True
+            for future in pending:
+                future.cancel()
+        return set(futures) - pending
@@ -0,0 +1,68 @@
+"""Stop the work for a request when its client disconnects
+
+The blocking work of a request (upstream queries, models inference) runs in the threadpool, while the handler
+checks regularly if the client is still connected. When it is gone, the work is cancelled through a callback
+(usually cancelling the Deadline the work checks), and no response is sent.
+"""
+import asyncio
+
+import anyio
+from fastapi import Request, Response
+from starlette.concurrency import run_in_threadpool
+
+from app.metrics import counter
+
+# Interval in seconds at which the connection of the client is checked
+DISCONNECT_POLL_INTERVAL = 0.5
+# Non-standard status code used for requests closed by the client (as in nginx logs)
+CLIENT_CLOSED_REQUEST = 499
+
+disconnect_cancellations = counter(
+    "client_disconnect_cancellations_total", "Number of requests whose work was cancelled as their client disconnected"
+)
+
+
+def ignore_result(task):
+    """Retrieve the result of a task nobody awaits anymore, to avoid the "exception never retrieved" warnings"""
+    if not task.cancelled():
+        task.exception()
+
+
+async def run_until_disconnected(request: Request, cancel, function, *args, **kwargs):
+    """Run a blocking function in the threadpool, and cancel it if the client disconnects before it returns
+
+    :param request: Request of the client
+    :param cancel: Function called when the client disconnected, to stop the work of the function
+    :return: The result of the function, or an empty response with status 499 if the client disconnected
+    """
+    task = asyncio.ensure_future(run_in_threadpool(function, *args, **kwargs))
+    while True:
+        done, _pending = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            cancel()
+            disconnect_cancellations.inc()
+            task.add_done_callback(ignore_result)
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+
+async def iter_until_disconnected(iterator, cancel):
+    """Iterate over a blocking iterator in the threadpool, for a StreamingResponse
+
+    The streaming is stopped by Starlette when the client disconnects, the work of the iterator is then cancelled.
+
+    :param cancel: Function called when the response was not completely sent, to stop the work of the iterator
+    """
+    end = object()
+    try:
+        while True:
+            # Cancellable: the streaming stops waiting for the chunk being computed when the client disconnects
+            chunk = await anyio.to_thread.run_sync(next, iterator, end, cancellable=True)
+            if chunk is end:
+                break
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        cancel()
+        disconnect_cancellations.inc()
+        raise
@@ -0,0 +1,282 @@
+"""Limit the concurrent and per-second requests sent to each upstream service
+
+Each upstream URL has a Governor. Requests wait in a fair queue for a slot: interactive requests (TRAPI queries)
+and background requests (edge store sync, retractions refresh, meta-KG) have their own FIFO queue, served in a
+weighted round robin, so neither can starve the other. A slot is granted when there are less than
+UPSTREAM_MAX_CONCURRENT requests running and the token bucket of UPSTREAM_MAX_PER_SECOND requests is not empty.
+
+When UPSTREAM_SLOTS_PATH is set, the limits are also shared by the worker processes: the slots are lock files
+(fcntl), and the token bucket is stored in a file updated under a lock. The waiter granted a slot takes its token
+and its slot file after leaving the queue, so the file IO does not block the other threads of the governor.
+
+The priority is a property of the current thread: the threads running requests on behalf of another thread
+(e.g. concurrent SPARQL queries) are given its priority with call_with_priority.
+"""
+import fcntl
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from app.config import settings
+from app.deadline import POLL_INTERVAL, DeadlineExceededError
+from app.metrics import get_metric
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+# Out of 4 slots granted while both queues are waiting, 3 go to interactive requests
+ROUND_ROBIN = [INTERACTIVE, INTERACTIVE, INTERACTIVE, BACKGROUND]
+# Number of queue waits kept to compute their percentiles
+WAIT_WINDOW = 500
+# Interval in seconds at which a free cross-worker slot is looked for
+FILE_SLOT_POLL_INTERVAL = 0.01
+
+priority_context = threading.local()
+
+
+def current_priority():
+    """Get the priority of the requests sent by the current thread"""
+    return getattr(priority_context, "priority", INTERACTIVE)
+
+
+@contextmanager
+def with_priority(priority):
+    """Send the requests of the current thread with a priority"""
+    previous = current_priority()
+    priority_context.priority = priority
+    try:
+        yield
+    finally:
+        priority_context.priority = previous
+
+
+def background_priority():
+    """Send the requests of the current thread with the background priority"""
+    return with_priority(BACKGROUND)
+
+
+def call_with_priority(priority, function, *args, **kwargs):
+    """Call a function with a priority, e.g. in an executor thread with the priority of the thread submitting it"""
+    with with_priority(priority):
+        return function(*args, **kwargs)
+
+
+class TokenBucket:
+    """Allow rate requests per second, with bursts of up to rate requests"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, return 0 if it was taken, or the number of seconds to wait for the next one"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FileTokenBucket:
+    """Token bucket shared by the worker processes, stored in a file updated under a lock"""
+
+    def __init__(self, rate, path):
+        self.rate = rate
+        self.path = path
+
+    def take(self):
+        """Take a token, return 0 if it was taken, or the number of seconds to wait for the next one"""
+        with open(self.path, "a+") as bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            bucket_file.seek(0)
+            try:
+                tokens, updated_at = (float(value) for value in bucket_file.read().split())
+            except ValueError:
+                tokens, updated_at = self.rate, time.time()
+            now = time.time()
+            tokens = min(self.rate, tokens + max(0.0, now - updated_at) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            bucket_file.seek(0)
+            bucket_file.truncate()
+            bucket_file.write(f"{tokens} {now}")
+            return wait
+
+
+class FileSlots:
+    """Slots shared by the worker processes, each slot is a file locked while a request runs"""
+
+    def __init__(self, count, path_prefix):
+        self.paths = [f"{path_prefix}.{i}.lock" for i in range(count)]
+
+    def try_acquire(self):
+        """Lock a free slot file and return its file descriptor, None if all slots are taken
+
+        The slot is released by closing the file descriptor.
+        """
+        for path in self.paths:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+
+class Waiter:
+    """Request waiting in a queue for a slot, compared by identity"""
+
+    __slots__ = ("priority",)
+
+    def __init__(self, priority):
+        self.priority = priority
+
+
+class Governor:
+    """Limit the requests to an upstream service
+
+    :param name: Name of the upstream, used in the metrics and the slot files
+    :param max_concurrent: Maximum number of requests running at the same time
+    :param max_per_second: Maximum number of requests started per second
+    :param slots_path: Directory of the files sharing the limits between the worker processes, None to not share them
+    """
+
+    def __init__(self, name, max_concurrent, max_per_second, slots_path=None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.queues = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self.turn = 0
+        self.condition = threading.Condition()
+        self.file_slots = None
+        if slots_path:
+            os.makedirs(slots_path, exist_ok=True)
+            path_prefix = os.path.join(slots_path, re.sub(r"[^\w.-]", "_", name))
+            self.file_slots = FileSlots(max_concurrent, path_prefix)
+            self.bucket = FileTokenBucket(max_per_second, f"{path_prefix}.bucket")
+        else:
+            self.bucket = TokenBucket(max_per_second)
+
+    def next_waiter(self):
+        """Get the waiter whose turn it is, following the weighted round robin between the priorities"""
+        priority = ROUND_ROBIN[self.turn % len(ROUND_ROBIN)]
+        queue = self.queues[priority] or self.queues[BACKGROUND if priority == INTERACTIVE else INTERACTIVE]
+        return queue[0] if queue else None
+
+    @contextmanager
+    def slot(self, priority=None, deadline=None, cancel=None):
+        """Wait for a slot to send a request, and release it when the request is done
+
+        :param priority: INTERACTIVE or BACKGROUND, the priority of the current thread by default
+        :param deadline: Deadline of the request, DeadlineExceededError is raised if it expires while waiting
+        :param cancel: Event stopping the wait when set, DeadlineExceededError is raised
+        """
+        priority = priority or current_priority()
+        waiter = Waiter(priority)
+        start = time.monotonic()
+
+        def check_cancelled():
+            if (deadline is not None and deadline.expired) or (cancel is not None and cancel.is_set()):
+                raise DeadlineExceededError(f"Cancelled while waiting for a slot to query {self.name}")
+
+        with self.condition:
+            self.queues[priority].append(waiter)
+            try:
+                while True:
+                    check_cancelled()
+                    if self.running < self.max_concurrent and self.next_waiter() is waiter:
+                        break
+                    self.condition.wait(POLL_INTERVAL)
+            finally:
+                self.queues[priority].remove(waiter)
+                # The next waiter might be able to go
+                self.condition.notify_all()
+            # The slot is reserved while waiting for a token, outside of the condition
+            self.running += 1
+            self.turn += 1
+        slot_fd = None
+        try:
+            while True:
+                wait = self.bucket.take()
+                if not wait:
+                    break
+                check_cancelled()
+                time.sleep(min(wait, POLL_INTERVAL))
+            if self.file_slots:
+                while slot_fd is None:
+                    slot_fd = self.file_slots.try_acquire()
+                    if slot_fd is None:
+                        check_cancelled()
+                        time.sleep(FILE_SLOT_POLL_INTERVAL)
+            queue_waits.observe(self.name, priority, time.monotonic() - start)
+            yield
+        finally:
+            if slot_fd is not None:
+                os.close(slot_fd)
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+
+class QueueWaits:
+    """Summary of the time spent waiting for a slot, labelled by upstream and priority"""
+
+    kind = "summary"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.waits = {}
+        self.lock = threading.Lock()
+
+    def observe(self, upstream, priority, seconds):
+        with self.lock:
+            entry = self.waits.setdefault((upstream, priority), [0, 0.0, deque(maxlen=WAIT_WINDOW)])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2].append(seconds)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for (upstream, priority), (count, total, window) in self.waits.items():
+                labels = f'upstream="{upstream}",priority="{priority}"'
+                recent = sorted(window)
+                for quantile in (0.5, 0.95):
+                    value = recent[min(len(recent) - 1, int(quantile * len(recent)))]
+                    samples.append((f'{self.name}{{{labels},quantile="{quantile}"}}', value))
+                samples.append((f"{self.name}_sum{{{labels}}}", total))
+                samples.append((f"{self.name}_count{{{labels}}}", count))
+        return samples
+
+
+queue_waits = get_metric(
+    QueueWaits, "upstream_queue_wait_seconds", "Time spent waiting for a slot to send a request to an upstream service"
+)
+
+governors = {}
+governors_lock = threading.Lock()
+
+
+def get_governor(url):
+    """Get the governor of the requests to an upstream URL, with the limits defined in the settings"""
+    with governors_lock:
+        if url not in governors:
+            governors[url] = Governor(
+                url,
+                settings.UPSTREAM_MAX_CONCURRENT,
+                settings.UPSTREAM_MAX_PER_SECOND,
+                settings.UPSTREAM_SLOTS_PATH,
+            )
+        return governors[url]
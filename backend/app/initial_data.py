@@ -3,6 +3,8 @@ import os
 from pathlib import Path
 
 from app.config import settings
+from app.trapi.csr_snapshot import build_csr_snapshot
+from app.trapi.edge_store import sync_edge_store
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -47,6 +49,13 @@ def main() -> None:
     else:
         logger.info("✅ litcoin-relations-extraction-model already present")
 
+    if settings.TRAPI_ENGINE in ("sqlite", "csr") and not os.path.exists(settings.EDGE_STORE_PATH):
+        logger.info("📥️ Edge store not present, synchronizing it from the Nanopublication network")
+        sync_edge_store()
+    if settings.TRAPI_ENGINE == "csr" and not os.path.exists(settings.CSR_SNAPSHOT_PATH):
+        logger.info("🗜️ CSR snapshot not present, building it from the edge store")
+        build_csr_snapshot()
+
 
 if __name__ == "__main__":
     main()
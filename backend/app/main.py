@@ -1,12 +1,19 @@
 import logging
 import os
-from fastapi.responses import RedirectResponse
+import threading
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
 from app.api.api import api_router
 from app.config import settings
+from app.metrics import render_metrics
+from app.trapi.async_jobs import start_job_workers
+from app.trapi.biolink_closure import get_biolink_closure
+from app.trapi.csr_snapshot import build_csr_snapshot
+from app.trapi.edge_store import start_sync_thread
 from app.trapi.openapi import TRAPI
+from app.trapi.retractions import start_refresh_thread
 
 # app = FastAPI(
 app = TRAPI(
@@ -44,6 +51,37 @@ def health_check():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False, response_class=PlainTextResponse)
+def get_metrics():
+    """Metrics of this worker process in the Prometheus text format"""
+    return render_metrics()
+
+
+@app.on_event("startup")
+def start_background_sync():
+    """Keep the local edge store and the retracted nanopubs in sync with the Nanopublication network"""
+    if settings.TRAPI_ENGINE in ("sqlite", "csr") and settings.EDGE_STORE_SYNC_INTERVAL > 0:
+        # The CSR snapshot is rebuilt after each sync, and swapped in by the workers when they see the new file
+        start_sync_thread(on_sync=build_csr_snapshot if settings.TRAPI_ENGINE == "csr" else None)
+    if settings.RETRACTIONS_REFRESH_INTERVAL > 0:
+        # Retracted and superseded nanopubs are then filtered from the SPARQL results in memory
+        start_refresh_thread()
+
+
+@app.on_event("startup")
+def start_async_query_workers():
+    """Execute the asynchronous TRAPI queries, including the ones queued before a restart"""
+    if settings.ASYNC_QUERY_WORKERS > 0:
+        start_job_workers()
+
+
+@app.on_event("startup")
+def load_biolink_closure():
+    """Load the closure of the BioLink hierarchies before the first queries, it is built if it is not cached yet"""
+    if settings.TRAPI_EXPAND_BIOLINK:
+        threading.Thread(target=get_biolink_closure, name="biolink-closure", daemon=True).start()
+
+
 @app.get("/", include_in_schema=False)
 def redirect_root_to_docs():
     """Redirect the route / to /docs"""
@@ -0,0 +1,70 @@
+"""Lightweight in-process metrics, exposed in the Prometheus text format on /metrics"""
+import threading
+
+registry = {}
+registry_lock = threading.Lock()
+
+
+class Counter:
+    """Monotonically increasing value"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    """Value that can go up and down, or computed by a callback when the metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, callback=None):
+        self.name = name
+        self.description = description
+        self.value = 0.0
+        self.callback = callback
+
+    def set(self, value: float) -> None:  # noqa: A003 (same API as prometheus_client)
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.callback() if self.callback else self.value)]
+
+
+def get_metric(metric_class, name: str, description: str, **kwargs):
+    with registry_lock:
+        if name not in registry:
+            registry[name] = metric_class(name, description, **kwargs)
+        return registry[name]
+
+
+def counter(name: str, description: str) -> Counter:
+    """Get or create a counter"""
+    return get_metric(Counter, name, description)
+
+
+def gauge(name: str, description: str, callback=None) -> Gauge:
+    """Get or create a gauge"""
+    return get_metric(Gauge, name, description, callback=callback)
+
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in list(registry.values()):
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample_name, value in metric.samples():
+            lines.append(f"{sample_name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,177 @@
+"""Coalesce concurrent identical calls, so they share a single execution and all receive its result
+
+The calls in flight are tracked with threads, so sync handlers (run in the threadpool) and async handlers
+(using the call_async attribute of the decorated function) are coalesced together.
+A call waiting for an identical call in flight stops waiting when its own deadline expires (or is cancelled), and then
+runs the function itself with its expired deadline (e.g. to get an empty answer reporting it was truncated). When the
+deadline of the call in flight truncated its result, a call waiting with time left runs the function itself too.
+"""
+import functools
+import threading
+
+import orjson
+from starlette.concurrency import run_in_threadpool
+
+from app.deadline import POLL_INTERVAL, Deadline
+from app.metrics import counter
+
+coalesced_requests = counter(
+    "coalesced_requests_total", "Number of requests that waited for an identical request in flight instead of running"
+)
+
+
+class Call:
+    """Call in flight"""
+
+    __slots__ = ("done", "result", "error", "followers", "deadline", "abandoned", "truncated")
+
+    def __init__(self, deadline=None):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+        # Deadline of the leader, cancelled once the leader and all the followers are gone
+        self.deadline = deadline
+        self.abandoned = False
+        # The deadline of the leader truncated the result
+        self.truncated = False
+
+
+class SingleFlight:
+    """Group of calls deduplicated by key"""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def call(self, key, function, *args, call_deadline=None, **kwargs):
+        """Run the function, or wait for the call with the same key in flight and get its result
+
+        The followers get a copy of the result (through JSON), so the caller can modify or consume its result.
+
+        :param call_deadline: Deadline of this call (also passed to the function). The call waits at most until
+            it expires, and runs the function itself if the result of the call in flight was truncated by its
+            deadline while this one has time left
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call(call_deadline)
+            else:
+                call.followers += 1
+
+        if not leader:
+            coalesced_requests.inc()
+            if not wait_call(call, call_deadline):
+                self.leave(call)
+                return function(*args, **kwargs)
+            if call.truncated and call_deadline is not None:
+                if not call_deadline.expired:
+                    return function(*args, **kwargs)
+                call_deadline.truncated = True
+            if call.error is not None:
+                raise call.error
+            return orjson.loads(call.result)
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                del self.calls[key]
+            call.error = e
+            call.done.set()
+            raise
+        with self.lock:
+            del self.calls[key]
+            followers = call.followers
+        call.truncated = call.deadline is not None and call.deadline.truncated
+        if followers:
+            call.result = orjson.dumps(result)
+        call.done.set()
+        return result
+
+    def followers(self, key):
+        """Get the number of calls waiting for the call with this key in flight"""
+        with self.lock:
+            call = self.calls.get(key)
+            return call.followers if call is not None else 0
+
+    def leave(self, call):
+        """Stop waiting for a call in flight, its deadline is cancelled if its leader and all its followers left"""
+        with self.lock:
+            call.followers -= 1
+            cancel = call.abandoned and call.followers == 0
+        if cancel:
+            call.deadline.cancel()
+
+    def cancel(self, key, deadline):
+        """Cancel a call, e.g. when its client is gone
+
+        A call waiting for a call in flight stops waiting (its deadline is cancelled). The work of a leader is only
+        cancelled once no follower waits for its result anymore.
+
+        :param deadline: Deadline of the call to cancel
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call.deadline is deadline and call.followers:
+                call.abandoned = True
+                return
+        deadline.cancel()
+
+
+def wait_call(call, deadline=None):
+    """Wait for a call in flight to be done, until the deadline if provided
+
+    :return: True if the call is done, False if the deadline expired (or was cancelled) before
+    """
+    if deadline is None:
+        return call.done.wait()
+    # Wake up regularly to stop waiting as soon as the deadline is cancelled
+    while not call.done.wait(min(deadline.remaining(), POLL_INTERVAL)):
+        if deadline.expired:
+            return call.done.is_set()
+    return True
+
+
+def coalesce(function=None, ignore=()):
+    """Decorator coalescing concurrent calls with the same arguments (normalized as JSON with sorted keys)
+
+    :param ignore: Names of keyword arguments left out of the key (e.g. a deadline), the followers wait
+        for the call of the leader, made with its own values for these arguments. If one of them is a Deadline,
+        the followers wait at most until their own deadline, and run the call themselves if the deadline of the
+        leader truncated its result
+    """
+    if function is None:
+        return functools.partial(coalesce, ignore=ignore)
+    flight = SingleFlight()
+
+    def get_key(args, kwargs):
+        key_kwargs = {name: value for name, value in kwargs.items() if name not in ignore}
+        return orjson.dumps([args, key_kwargs], option=orjson.OPT_SORT_KEYS)
+
+    def get_deadline(kwargs):
+        return next((value for name, value in kwargs.items() if name in ignore and isinstance(value, Deadline)), None)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return flight.call(get_key(args, kwargs), function, *args, call_deadline=get_deadline(kwargs), **kwargs)
+
+    def followers(*args, **kwargs):
+        """Number of calls waiting for the identical call in flight"""
+        return flight.followers(get_key(args, kwargs))
+
+    def cancel(*args, **kwargs):
+        """Cancel the call made with these arguments, through its Deadline (see SingleFlight.cancel)"""
+        flight.cancel(get_key(args, kwargs), get_deadline(kwargs))
+
+    async def call_async(*args, **kwargs):
+        """Coalesced call from an async handler, without blocking the event loop while waiting"""
+        return await run_in_threadpool(wrapper, *args, **kwargs)
+
+    wrapper.flight = flight
+    wrapper.call_async = call_async
+    wrapper.followers = followers
+    wrapper.cancel = cancel
+    return wrapper
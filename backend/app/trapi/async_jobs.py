@@ -0,0 +1,352 @@
+"""Queue of the asynchronous TRAPI queries (/asyncquery), persisted in SQLite
+
+Submitted queries are stored as Queued jobs, and executed by a bounded pool of background threads in each worker
+process, which claim them atomically in the database. When a job is done, its response is stored and POSTed to the
+callback URL of the query, it can also be retrieved with its status. As the jobs are persisted, the queued jobs
+(and the running jobs of a worker which stopped) are executed after a restart.
+The callbacks are restricted (see check_callback_url), so the server cannot be used to send requests to its private
+network. The responses are sent to the addresses checked, so the host cannot be rebound to another address between
+the check and the request.
+"""
+import ipaddress
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import orjson
+import requests
+from app.config import logger, settings
+from app.governor import background_priority
+from app.metrics import counter, gauge
+from requests.adapters import HTTPAdapter
+
+QUEUED = "Queued"
+RUNNING = "Running"
+COMPLETED = "Completed"
+FAILED = "Failed"
+# Interval in seconds at which idle job workers look for jobs queued by other processes
+JOB_POLL_INTERVAL = 1.0
+# Seconds after the end of its time budget before the job of a worker which stopped is executed again
+ABANDONED_JOB_GRACE = 60
+# Number of times a job is started before it is marked as failed (e.g. if it crashes its worker)
+MAX_JOB_ATTEMPTS = 3
+CALLBACK_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    query TEXT NOT NULL,
+    callback TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    description TEXT NOT NULL DEFAULT '',
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created);
+"""
+
+completed_jobs = counter("async_query_jobs_completed_total", "Number of asynchronous TRAPI queries completed")
+failed_jobs = counter("async_query_jobs_failed_total", "Number of asynchronous TRAPI queries failed")
+failed_callbacks = counter(
+    "async_query_callbacks_failed_total", "Number of asynchronous TRAPI responses which could not be sent to a callback"
+)
+job_available = threading.Event()
+
+
+def connect(path=None):
+    """Open a connection to the jobs database, one connection should be used per thread"""
+    conn = sqlite3.connect(path or settings.ASYNC_QUERY_JOBS_PATH, timeout=30, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def check_callback_url(callback):
+    """Check the responses of asynchronous queries can be sent to a callback URL
+
+    When settings.ASYNC_QUERY_CALLBACK_HOSTS is set, only its hosts are allowed. Otherwise the host of the callback
+    should only resolve to public addresses (not private, loopback, link-local, or reserved).
+
+    :return: The addresses of the host checked, the response should be sent to one of them.
+        None if the host is allowed by settings.ASYNC_QUERY_CALLBACK_HOSTS
+    :raise ValueError: if the callback is not allowed
+    """
+    url = urlsplit(callback)
+    if url.scheme not in ("http", "https") or not url.hostname:
+        raise ValueError("The callback should be an HTTP URL")
+    host = url.hostname.lower()
+    if settings.ASYNC_QUERY_CALLBACK_HOSTS:
+        if host not in {allowed.lower() for allowed in settings.ASYNC_QUERY_CALLBACK_HOSTS}:
+            raise ValueError(f"The callback host {host} is not allowed")
+        return None
+    try:
+        port = url.port or (443 if url.scheme == "https" else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    except (OSError, UnicodeError):
+        raise ValueError(f"The callback host {host} could not be resolved") from None
+    for address in addresses:
+        # Drop the scope of IPv6 link-local addresses
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"The callback host {host} resolves to a non-public address: {ip}")
+    return sorted(addresses)
+
+
+class PinnedHostAdapter(HTTPAdapter):
+    """Transport adapter for HTTPS requests sent to an address instead of their host name, the TLS server name and
+    certificate are still checked against the host name
+
+    :param hostname: Host name of the URL the request is sent to
+    """
+
+    def __init__(self, hostname, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["server_hostname"] = self.hostname
+        kwargs["assert_hostname"] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def pin_callback_url(callback, address):
+    """Get the URL of a callback with its host replaced by one of its addresses
+
+    :return: Tuple with the URL, and the Host header to send
+    """
+    url = urlsplit(callback)
+    port = f":{url.port}" if url.port else ""
+    ip = ipaddress.ip_address(address.split("%")[0])
+    netloc = f"[{address}]{port}" if ip.version == 6 else f"{address}{port}"
+    host = f"[{url.hostname}]" if ":" in url.hostname else url.hostname
+    return url._replace(netloc=netloc).geturl(), f"{host}{port}"
+
+
+def submit_job(reasoner_query, callback, path=None):
+    """Queue an asynchronous TRAPI query
+
+    :param reasoner_query: TRAPI query, its callback property is removed before answering it
+    :param callback: URL the TRAPI response is POSTed to
+    :return: ID of the job
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    query = {key: value for key, value in reasoner_query.items() if key != "callback"}
+    conn = connect(path)
+    try:
+        conn.execute(
+            "INSERT INTO jobs (job_id, status, query, callback, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, QUEUED, orjson.dumps(query).decode(), callback, now, now),
+        )
+    finally:
+        conn.close()
+    job_available.set()
+    return job_id
+
+
+def get_job(job_id, path=None):
+    """Get the status, description, and response (None until completed) of a job, None if it does not exist"""
+    conn = connect(path)
+    try:
+        row = conn.execute(
+            "SELECT status, description, response, created, updated FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    status, description, response, created, updated = row
+    return {
+        "status": status,
+        "description": description,
+        "response": orjson.loads(response) if response else None,
+        "created": created,
+        "updated": updated,
+    }
+
+
+def count_jobs(status, path=None):
+    """Count the jobs with a status, 0 if the jobs database is not available"""
+    try:
+        conn = connect(path)
+    except sqlite3.Error:
+        return 0
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def claim_job(conn):
+    """Mark the oldest queued job (or a running job abandoned by a worker which stopped) as running
+
+    :return: Tuple with the ID, TRAPI query, callback and number of attempts of the job, None if there are no jobs
+    """
+    now = time.time()
+    abandoned_before = now - settings.ASYNC_QUERY_TIMEOUT - ABANDONED_JOB_GRACE
+    # The write lock is taken before reading, so the job is only claimed by one worker process
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT job_id, query, callback, attempts FROM jobs "
+            "WHERE status = ? OR (status = ? AND updated < ?) ORDER BY created LIMIT 1",
+            (QUEUED, RUNNING, abandoned_before),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated = ?, attempts = attempts + 1 WHERE job_id = ?",
+                (RUNNING, now, row[0]),
+            )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    job_id, query, callback, attempts = row
+    return job_id, orjson.loads(query), callback, attempts + 1
+
+
+def finish_job(conn, job_id, status, description, response):
+    conn.execute(
+        "UPDATE jobs SET status = ?, updated = ?, description = ?, response = ? WHERE job_id = ?",
+        (status, time.time(), description, orjson.dumps(response).decode(), job_id),
+    )
+
+
+def delete_expired_jobs(conn):
+    """Delete the completed and failed jobs older than settings.ASYNC_QUERY_RETENTION seconds"""
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+        (COMPLETED, FAILED, time.time() - settings.ASYNC_QUERY_RETENTION),
+    )
+
+
+def error_response(reasoner_query, description):
+    """Create the TRAPI response sent for a job which failed"""
+    from app.trapi.reasonerapi_parser import trapi_log
+
+    return {
+        "message": {"query_graph": (reasoner_query.get("message") or {}).get("query_graph")},
+        "status": FAILED,
+        "description": description,
+        "logs": [trapi_log("ERROR", description)],
+    }
+
+
+def run_job(reasoner_query, attempts):
+    """Answer the TRAPI query of a job
+
+    :return: Tuple with the status of the job, its description and the TRAPI response
+    """
+    from app.trapi.reasonerapi_parser import get_query_deadline, reasonerapi_to_sparql
+
+    if attempts > MAX_JOB_ATTEMPTS:
+        description = f"The query was abandoned after {MAX_JOB_ATTEMPTS} attempts"
+        return FAILED, description, error_response(reasoner_query, description)
+    try:
+        deadline = get_query_deadline(reasoner_query, settings.ASYNC_QUERY_TIMEOUT)
+        # Asynchronous queries should not slow down the synchronous queries waiting for their response
+        with background_priority():
+            response = reasonerapi_to_sparql(reasoner_query, deadline=deadline)
+        return COMPLETED, "The query completed", response
+    except Exception as e:
+        logger.error(f"Error while answering an asynchronous TRAPI query: {e}")
+        return FAILED, f"The query failed: {e}", error_response(reasoner_query, f"The query failed: {e}")
+
+
+def send_callback(callback, response):
+    """POST the TRAPI response of a job to its callback URL, retried with a backoff if it fails
+
+    The callback is checked again before sending, as the addresses of its host could have changed since the job
+    was submitted. The response is sent to the first address checked (the host is not resolved again), and
+    redirections are not followed.
+    """
+    try:
+        addresses = check_callback_url(callback)
+    except ValueError as e:
+        logger.warning(f"Not sending an asynchronous TRAPI response to {callback}: {e}")
+        failed_callbacks.inc()
+        return False
+    url = callback
+    headers = {"Content-Type": "application/json"}
+    with requests.Session() as session:
+        if addresses:
+            url, headers["Host"] = pin_callback_url(callback, addresses[0])
+            session.mount("https://", PinnedHostAdapter(urlsplit(callback).hostname))
+        for attempt in range(1, CALLBACK_ATTEMPTS + 1):
+            try:
+                session.post(
+                    url,
+                    data=orjson.dumps(response),
+                    headers=headers,
+                    timeout=settings.ASYNC_QUERY_CALLBACK_TIMEOUT,
+                    allow_redirects=False,
+                ).raise_for_status()
+                return True
+            except requests.RequestException as e:
+                logger.warning(
+                    f"Error while sending an asynchronous TRAPI response to {callback} (attempt {attempt}): {e}"
+                )
+                if attempt < CALLBACK_ATTEMPTS:
+                    time.sleep(2**attempt)
+    failed_callbacks.inc()
+    return False
+
+
+def process_next_job(conn):
+    """Claim and execute the next job, then send its response to its callback
+
+    :return: True if a job was executed, False if there are no jobs
+    """
+    job = claim_job(conn)
+    if job is None:
+        return False
+    job_id, reasoner_query, callback, attempts = job
+    status, description, response = run_job(reasoner_query, attempts)
+    finish_job(conn, job_id, status, description, response)
+    (completed_jobs if status == COMPLETED else failed_jobs).inc()
+    if callback:
+        send_callback(callback, response)
+    return True
+
+
+def start_job_workers(workers=None):
+    """Execute the queued jobs in background threads
+
+    :param workers: Number of threads, defaults to settings.ASYNC_QUERY_WORKERS
+    """
+    workers = workers or settings.ASYNC_QUERY_WORKERS
+
+    def work_loop():
+        conn = connect()
+        while True:
+            try:
+                if process_next_job(conn):
+                    continue
+                delete_expired_jobs(conn)
+            except Exception as e:
+                logger.error(f"Error while processing the asynchronous TRAPI queries: {e}")
+            # Woken up by the jobs submitted to this process, the other processes are polled
+            job_available.wait(JOB_POLL_INTERVAL)
+            job_available.clear()
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=work_loop, name=f"async-query-worker-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+gauge(
+    "async_query_jobs_queued",
+    "Number of asynchronous TRAPI queries waiting to be executed",
+    lambda: count_jobs(QUEUED),
+)
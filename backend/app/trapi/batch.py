@@ -0,0 +1,246 @@
+"""Answer a batch of TRAPI queries, merging the compatible one-hop queries in shared SPARQL executions
+
+One-hop queries which only differ by the ids pinned on one of their nodes (e.g. the same drug treats disease
+pattern for hundreds of drugs) are compatible: they are answered by a single one-hop query with the union of
+their ids, whose results are then split back per query. The number of SPARQL queries sent for a group of
+compatible queries only depends on the number of ids (chunked by TRAPI_ID_CHUNK_SIZE), not on the number of queries.
+The merged query returns at most TRAPI_MAX_RESULTS results in total: when it reaches this limit, the queries of the
+group which did not get all their results are split in two groups, answered again, until they are answered alone.
+The other queries (multiple edges, cursor, ids pinned on both nodes...) are answered one by one.
+The nanopub users are retrieved once for the whole batch.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import logger, settings
+from app.trapi.projection import Projection
+from app.trapi.reasonerapi_parser import (
+    answer_reasoner_query,
+    load_np_users,
+    parse_query_options,
+    query_one_hop,
+    resolve_curie,
+    resolve_curie_identifiersorg,
+    resolve_uri,
+    trapi_log,
+    trapi_response,
+)
+from app.trapi.workflow import parse_workflow
+
+
+def get_merge_key(reasoner_query):
+    """Get the key of the queries which can be merged with this one, None if it cannot be merged
+
+    A query can be merged if it has a single edge, ids pinned on one of its nodes only, and no cursor.
+    The key contains everything but the ids, the keys of the query graph nodes and edge, and the workflow
+    (which only limits the number of results of a one-hop query, applied when splitting the results).
+    Queries with invalid options are not merged, so they are the only ones failing.
+
+    :param reasoner_query: TRAPI query, with the structure checked by app.trapi.validation.check_query
+    :return: Tuple with the merge key, and the role ("subject" or "object") of the node with pinned ids
+    """
+    query_graph = reasoner_query["message"]["query_graph"]
+    query_options = dict(reasoner_query.get("query_options") or {})
+    if len(query_graph["edges"]) != 1 or "cursor" in query_options:
+        return None, None
+    edge = next(iter(query_graph["edges"].values()))
+    nodes = {role: query_graph["nodes"].get(edge.get(role)) for role in ("subject", "object")}
+    if any(not isinstance(node, dict) for node in nodes.values()):
+        return None, None
+    pinned = [role for role, node in nodes.items() if node.get("ids")]
+    if len(pinned) != 1:
+        return None, None
+    try:
+        Projection.from_query_options(query_options)
+        parse_workflow(reasoner_query)
+    except ValueError:
+        return None, None
+    # n_results is applied when splitting the results, the timeouts are replaced by the deadline of the batch
+    for option in ("n_results", "timeout", "next_cursor"):
+        query_options.pop(option, None)
+    key = json.dumps(
+        {
+            "pinned": pinned[0],
+            "edge": {k: v for k, v in edge.items() if k not in ("subject", "object")},
+            "nodes": {role: {k: v for k, v in node.items() if k != "ids"} for role, node in nodes.items()},
+            "query_options": query_options,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return key, pinned[0]
+
+
+def get_curies(ids):
+    """Get the CURIEs the knowledge graph nodes of a list of pinned ids are identified with"""
+    curies = set(ids)
+    for curie in ids:
+        curies.add(resolve_uri(resolve_curie(curie)))
+        curies.add(resolve_uri(resolve_curie_identifiersorg(curie)))
+    return curies
+
+
+def get_n_results(reasoner_query):
+    """Get the maximum number of results of a query of a group, from its query_options and workflow"""
+    _query_options, n_results, _in_index, _engine, _offsets = parse_query_options(reasoner_query)
+    max_results, _filter_orphans = parse_workflow(reasoner_query)
+    return min(n_results or settings.TRAPI_MAX_RESULTS, max_results or settings.TRAPI_MAX_RESULTS)
+
+
+def split_answer(answer, reasoner_query, pinned, merged_keys, np_users_logs, deadline, alone=False):
+    """Get the TRAPI response of one query of a group from the answer of the merged query
+
+    :param answer: Answer of the merged query graph, whose node and edge keys are the ones of the first query
+    :param pinned: Role of the node with pinned ids in the query graphs of the group
+    :param merged_keys: Keys (subject node, object node, edge) of the merged query graph
+    :param alone: True if the query is the only one of the group, the limit of results was then reached by its
+        own results
+    """
+    query_graph = reasoner_query["message"]["query_graph"]
+    query_options = parse_query_options(reasoner_query)[0]
+    n_results = get_n_results(reasoner_query)
+    edge_id, edge = next(iter(query_graph["edges"].items()))
+    merged_subject, merged_object, merged_edge = merged_keys
+    merged_pinned = merged_subject if pinned == "subject" else merged_object
+    curies = get_curies(query_graph["nodes"][edge[pinned]]["ids"])
+
+    kg = {"nodes": {}, "edges": {}}
+    results = []
+    for result in answer["results"]:
+        if len(results) >= n_results:
+            break
+        if result["node_bindings"][merged_pinned][0]["id"] not in curies:
+            continue
+        edge_bindings = result["analyses"][0]["edge_bindings"][merged_edge]
+        results.append(
+            {
+                "node_bindings": {
+                    edge["subject"]: result["node_bindings"][merged_subject],
+                    edge["object"]: result["node_bindings"][merged_object],
+                },
+                "analyses": [{**result["analyses"][0], "edge_bindings": {edge_id: edge_bindings}}],
+            }
+        )
+        for binding in edge_bindings:
+            kg_edge = answer["knowledge_graph"]["edges"][binding["id"]]
+            kg["edges"][binding["id"]] = kg_edge
+            for node in (kg_edge["subject"], kg_edge["object"]):
+                kg["nodes"][node] = answer["knowledge_graph"]["nodes"][node]
+
+    logs = list(np_users_logs)
+    if answer["next_offsets"] and (alone or len(results) < n_results):
+        logs.append(
+            trapi_log(
+                "WARNING",
+                f"The batch reached the limit of {settings.TRAPI_MAX_RESULTS} results for the queries merged with "
+                f"this one, its results might be incomplete: send it to /query to page through all of them",
+            )
+        )
+    return trapi_response(
+        query_graph,
+        {"knowledge_graph": kg, "results": results, "logs": answer["logs"]},
+        query_options,
+        logs,
+        deadline,
+        reasoner_query.get("workflow"),
+    )
+
+
+def answer_group(group, pinned, np_users, np_users_logs, deadline):
+    """Answer a group of compatible queries with a single one-hop query on the union of their ids
+
+    If the merged query reaches the limit of results, the queries which did not get all their results are split
+    in two groups answered again (until the deadline expires), so the ids at the end of the union are not left
+    without results.
+
+    :param group: List of the TRAPI queries of the group
+    :return: List of the TRAPI responses, in the order of the group
+    """
+    first_graph = group[0]["message"]["query_graph"]
+    edge_id, edge = next(iter(first_graph["edges"].items()))
+    # Union of the ids, in the order of the queries (as an insertion-ordered set)
+    merged_ids = {}
+    for reasoner_query in group:
+        query_graph = reasoner_query["message"]["query_graph"]
+        for curie in query_graph["nodes"][next(iter(query_graph["edges"].values()))[pinned]]["ids"]:
+            merged_ids[curie] = None
+    merged_node = {**first_graph["nodes"][edge[pinned]], "ids": list(merged_ids)}
+    merged_graph = {
+        "nodes": {**first_graph["nodes"], edge[pinned]: merged_node},
+        "edges": first_graph["edges"],
+    }
+    query_options, _n_results, in_index, engine, _offsets = parse_query_options(group[0])
+    projection = Projection.from_query_options(query_options)
+    answer = query_one_hop(
+        merged_graph, edge_id, np_users, in_index, None, engine, deadline=deadline, projection=projection
+    )
+    merged_keys = (edge["subject"], edge["object"], edge_id)
+    responses = [
+        split_answer(answer, reasoner_query, pinned, merged_keys, np_users_logs, deadline, len(group) == 1)
+        for reasoner_query in group
+    ]
+    if not answer["next_offsets"] or len(group) == 1 or deadline.expired:
+        return responses
+    incomplete = [
+        i for i, response in enumerate(responses) if len(response["message"]["results"]) < get_n_results(group[i])
+    ]
+    for half in (incomplete[: len(incomplete) // 2], incomplete[len(incomplete) // 2 :]):
+        if half:
+            half_responses = answer_group([group[i] for i in half], pinned, np_users, np_users_logs, deadline)
+            for i, response in zip(half, half_responses):
+                responses[i] = response
+    return responses
+
+
+def error_response(reasoner_query, error, status="Bad Request"):
+    """Create the TRAPI response of a query of the batch which could not be answered"""
+    return {
+        "message": {"query_graph": reasoner_query["message"]["query_graph"]},
+        "status": status,
+        "description": str(error),
+        "logs": [trapi_log("ERROR", str(error))],
+    }
+
+
+def answer_batch(reasoner_queries, deadline):
+    """Answer a list of TRAPI queries, merging the compatible ones (see get_merge_key)
+
+    The groups of compatible queries and the other queries are answered concurrently.
+
+    :param reasoner_queries: List of TRAPI queries, each with a message containing a query_graph
+    :param deadline: Deadline of the whole batch
+    :return: List of the TRAPI responses, one for each query in the same order. The queries which are not valid
+        (e.g. with an invalid cursor) get a response with the status "Bad Request", the queries which failed
+        (e.g. all their SPARQL queries failed) a response with the status "Error"
+    """
+    np_users, np_users_logs = load_np_users(deadline)
+    groups = {}
+    singles = []
+    for i, reasoner_query in enumerate(reasoner_queries):
+        key, pinned = get_merge_key(reasoner_query)
+        if key is None:
+            singles.append(i)
+        else:
+            groups.setdefault(key, (pinned, []))[1].append(i)
+
+    def run_group(pinned, indexes):
+        return answer_group([reasoner_queries[i] for i in indexes], pinned, np_users, np_users_logs, deadline)
+
+    def run_single(i):
+        return [answer_reasoner_query(reasoner_queries[i], np_users, deadline, np_users_logs)]
+
+    responses = [None] * len(reasoner_queries)
+    with ThreadPoolExecutor(max_workers=settings.TRAPI_MAX_PARALLEL_QUERIES) as executor:
+        futures = [(indexes, executor.submit(run_group, pinned, indexes)) for pinned, indexes in groups.values()]
+        futures += [([i], executor.submit(run_single, i)) for i in singles]
+        for indexes, future in futures:
+            try:
+                group_responses = future.result()
+            except ValueError as e:
+                group_responses = [error_response(reasoner_queries[i], e) for i in indexes]
+            except Exception as e:
+                logger.error(f"Error while answering {len(indexes)} queries of a batch: {e}")
+                group_responses = [error_response(reasoner_queries[i], e, "Error") for i in indexes]
+            for i, response in zip(indexes, group_responses):
+                responses[i] = response
+    return responses
@@ -0,0 +1,174 @@
+"""Closure of the BioLink class and slot hierarchies, to expand the categories and predicates of TRAPI queries
+
+Following the TRAPI semantics, a query for a category also matches its descendants (e.g. biolink:ChemicalEntity
+matches biolink:Drug), and a query for a predicate matches its descendant predicates (e.g. biolink:related_to).
+The ancestors and descendants of the BioLink classes (rdfs:subClassOf) and slots (rdfs:subPropertyOf) are computed
+once per BIOLINK_VERSION from the BioLink OWL, and cached as JSON in BIOLINK_CLOSURE_PATH: the names of the terms,
+and the indexes of the descendants of each term. The categories and predicates are then expanded in the VALUES
+blocks of the queries, without any reasoning when answering them.
+"""
+import json
+import os
+import threading
+import time
+import urllib.request
+
+from app.config import logger, settings
+from rdflib import Graph
+from rdflib.namespace import RDFS
+
+BIOLINK_VOCAB = "https://w3id.org/biolink/vocab/"
+# Location of the BioLink OWL in the repository of the BioLink model, it moved in version 4
+OWL_URLS = [
+    "https://raw.githubusercontent.com/biolink/biolink-model/v{version}/biolink-model.owl.ttl",
+    "https://raw.githubusercontent.com/biolink/biolink-model/v{version}/project/owl/biolink_model.owl.ttl",
+]
+OWL_TIMEOUT = 60
+# Seconds before building the closure again when the BioLink OWL could not be retrieved
+RETRY_INTERVAL = 600
+
+
+class BiolinkClosure:
+    """Ancestors and descendants of the BioLink classes and slots, identified by their name (e.g. "Drug")
+
+    :param terms: Names of the terms
+    :param descendants: For each term, the indexes of its descendants (the term excluded)
+    """
+
+    __slots__ = ("terms", "descendants", "ancestors", "term_indexes")
+
+    def __init__(self, terms, descendants):
+        self.terms = terms
+        self.descendants = descendants
+        self.term_indexes = {term: i for i, term in enumerate(terms)}
+        self.ancestors = [[] for _ in terms]
+        for i, term_descendants in enumerate(descendants):
+            for descendant in term_descendants:
+                self.ancestors[descendant].append(i)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Compute the closure of the rdfs:subClassOf and rdfs:subPropertyOf hierarchies of the BioLink OWL"""
+        children = {}
+        for predicate in (RDFS.subClassOf, RDFS.subPropertyOf):
+            for child_node, parent_node in graph.subject_objects(predicate):
+                child, parent = str(child_node), str(parent_node)
+                if child != parent and child.startswith(BIOLINK_VOCAB) and parent.startswith(BIOLINK_VOCAB):
+                    children.setdefault(parent[len(BIOLINK_VOCAB) :], set()).add(child[len(BIOLINK_VOCAB) :])
+        terms = sorted(set(children) | {child for term_children in children.values() for child in term_children})
+        term_indexes = {term: i for i, term in enumerate(terms)}
+        descendants = []
+        for term in terms:
+            seen = set()
+            stack = list(children.get(term, ()))
+            while stack:
+                child = stack.pop()
+                if child not in seen and child != term:
+                    seen.add(child)
+                    stack.extend(children.get(child, ()))
+            descendants.append(sorted(term_indexes[descendant] for descendant in seen))
+        return cls(terms, descendants)
+
+    @classmethod
+    def load(cls, path, version):
+        """Load a closure saved by save(), None if the file does not exist or was built for another version"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("biolink_version") != version:
+            return None
+        return cls(data["terms"], data["descendants"])
+
+    def save(self, path, version):
+        """Save the closure as JSON, atomically replacing the previous file"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"biolink_version": version, "terms": self.terms, "descendants": self.descendants},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, path)
+
+    def get_descendants(self, uri):
+        """Get the URIs of the descendants of a BioLink term URI, empty if it is not a BioLink term"""
+        i = self.term_indexes.get(uri[len(BIOLINK_VOCAB) :]) if uri.startswith(BIOLINK_VOCAB) else None
+        return [] if i is None else [BIOLINK_VOCAB + self.terms[j] for j in self.descendants[i]]
+
+    def get_ancestors(self, uri):
+        """Get the URIs of the ancestors of a BioLink term URI, empty if it is not a BioLink term"""
+        i = self.term_indexes.get(uri[len(BIOLINK_VOCAB) :]) if uri.startswith(BIOLINK_VOCAB) else None
+        return [] if i is None else [BIOLINK_VOCAB + self.terms[j] for j in self.ancestors[i]]
+
+    def expand(self, uris):
+        """Get a list of URIs followed by the URIs of their descendants, without duplicates"""
+        expanded = dict.fromkeys(uris)
+        for uri in uris:
+            expanded.update(dict.fromkeys(self.get_descendants(uri)))
+        return list(expanded)
+
+
+def build_closure(version):
+    """Build the closure of the BioLink hierarchies from the BioLink OWL of a version
+
+    :raise OSError: if the BioLink OWL could not be retrieved
+    """
+    error = None
+    for url in OWL_URLS:
+        try:
+            # The OWL_URLS are HTTPS URLs
+            with urllib.request.urlopen(url.format(version=version), timeout=OWL_TIMEOUT) as response:  # noqa: S310
+                owl = response.read()
+        except OSError as e:
+            error = e
+            continue
+        graph = Graph()
+        graph.parse(data=owl, format="ttl")
+        return BiolinkClosure.from_graph(graph)
+    raise error
+
+
+closure = None
+closure_failed_at = None
+closure_lock = threading.Lock()
+
+
+def get_biolink_closure():
+    """Get the closure of the BioLink hierarchies of settings.BIOLINK_VERSION
+
+    It is loaded from settings.BIOLINK_CLOSURE_PATH, or built and saved there if the file is missing or was
+    built for another version. If the BioLink OWL cannot be retrieved, an empty closure is returned (the terms
+    are not expanded) until the next attempt, RETRY_INTERVAL seconds later.
+    """
+    global closure, closure_failed_at
+    if closure is not None:
+        return closure
+    with closure_lock:
+        if closure is not None:
+            return closure
+        if closure_failed_at is not None and time.monotonic() - closure_failed_at < RETRY_INTERVAL:
+            return BiolinkClosure([], [])
+        loaded = BiolinkClosure.load(settings.BIOLINK_CLOSURE_PATH, settings.BIOLINK_VERSION)
+        if loaded is None:
+            try:
+                loaded = build_closure(settings.BIOLINK_VERSION)
+            except Exception as e:
+                logger.warning(f"Error while building the closure of the BioLink {settings.BIOLINK_VERSION} model: {e}")
+                closure_failed_at = time.monotonic()
+                return BiolinkClosure([], [])
+            try:
+                loaded.save(settings.BIOLINK_CLOSURE_PATH, settings.BIOLINK_VERSION)
+            except OSError as e:
+                logger.warning(f"Error while saving the closure of the BioLink model: {e}")
+            logger.info(f"Built the closure of the BioLink {settings.BIOLINK_VERSION} model: {len(loaded.terms)} terms")
+        closure = loaded
+        return closure
+
+
+def expand_biolink_uris(uris):
+    """Expand the URIs of BioLink categories or predicates with the URIs of their descendants"""
+    if not uris or not settings.TRAPI_EXPAND_BIOLINK:
+        return uris
+    return get_biolink_closure().expand(uris)
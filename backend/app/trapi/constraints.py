@@ -0,0 +1,300 @@
+"""Qualifier and attribute constraints of the edges of a TRAPI query graph
+
+The constraints are pushed down in the association window of the one-hop SPARQL queries when they can be
+expressed in SPARQL (FILTER EXISTS blocks), so only the matching associations are retrieved and count in the
+LIMIT. The other attribute constraints (operators "matches" and "===", comparisons with strings, attributes not
+stored in the nanopubs like biolink:author) are checked on the assembled edges, as are all the constraints
+for the engines without SPARQL (edge store and CSR snapshot). CURIE values can be stored with different URIs,
+their SPARQL filter also matches the URIs ending with their local ID, and they are checked again on the edges.
+
+An edge matches the qualifier constraints if it has all the qualifiers of one of their qualifier sets,
+and it matches the attribute constraints if it matches each of them.
+"""
+import functools
+import json
+import re
+
+from app.trapi.sparql_builder import sparql_iri
+from app.trapi.workflow import filter_kgraph_orphans
+
+OPERATORS = ["==", ">", "<", "matches", "==="]
+# Operators which can be pushed down in SPARQL
+SPARQL_OPERATORS = ["==", ">", "<"]
+# Edge properties stored with a dedicated predicate: attribute type -> (predicate, predicate in the older model)
+DEDICATED_ATTRIBUTES = {
+    "biolink:publications": ("biolink:publications", "biolink:publications"),
+    "biolink:description": ("biolink:description", "biolink:description"),
+    "biolink:name": ("biolink:name", "rdfs:label"),
+    "biolink:provided_by": ("biolink:provided_by", "biolink:provided_by"),
+}
+# Attributes which are not a simple property of the association in the nanopubs
+IN_ENGINE_ATTRIBUTES = ["biolink:author", "biolink:population_context_qualifier", "biolink:has_phenotype"]
+CURIE_REGEX = re.compile(r"^[A-Za-z_][\w.-]*:[^\s/]")
+# Characters preceding the local ID of a CURIE in the URIs it can be stored as
+URI_SEPARATORS = ["/", ":", "_", "#", "="]
+# Cast to a number, the templates do not declare the xsd prefix
+XSD_DOUBLE = "<http://www.w3.org/2001/XMLSchema#double>"
+# Regular expressions of the "matches" operator are provided by the clients: they are limited in length, and the
+# quantified groups containing a quantifier (e.g. "(a+)+"), which backtrack exponentially, are rejected
+MAX_PATTERN_LENGTH = 256
+NESTED_QUANTIFIER_REGEX = re.compile(r"\((?:[^()\\]|\\.)*(?:[+*]|\{\d*,?\d*\})(?:[^()\\]|\\.)*\)(?:[+*]|\{\d*,\d*\})")
+
+
+class EdgeConstraints:
+    """Qualifier and attribute constraints of a query graph edge
+
+    :param qualifier_sets: List of qualifier sets, each a list of (qualifier type, qualifier value) tuples
+    :param attribute_constraints: List of TRAPI attribute constraints
+    """
+
+    __slots__ = ("qualifier_sets", "attribute_constraints")
+
+    def __init__(self, qualifier_sets=None, attribute_constraints=None):
+        self.qualifier_sets = qualifier_sets or []
+        self.attribute_constraints = attribute_constraints or []
+
+    def __bool__(self):
+        return bool(self.qualifier_sets or self.attribute_constraints)
+
+    @classmethod
+    def from_query_edge(cls, query_edge):
+        """Get the constraints of a TRAPI query graph edge
+
+        :raise ValueError: if the constraints are invalid, or use an operator which is not supported
+        """
+        qualifier_sets = []
+        for qualifier_constraint in query_edge.get("qualifier_constraints") or []:
+            try:
+                qualifier_set = [
+                    (str(qualifier["qualifier_type_id"]), str(qualifier["qualifier_value"]))
+                    for qualifier in qualifier_constraint["qualifier_set"]
+                ]
+            except (KeyError, TypeError):
+                raise ValueError(f"Invalid qualifier constraint: {qualifier_constraint}") from None
+            if not qualifier_set:
+                # An empty qualifier set is matched by all the edges
+                return cls(None, cls.parse_attribute_constraints(query_edge))
+            qualifier_sets.append(qualifier_set)
+        return cls(qualifier_sets, cls.parse_attribute_constraints(query_edge))
+
+    @staticmethod
+    def parse_attribute_constraints(query_edge):
+        attribute_constraints = query_edge.get("attribute_constraints") or []
+        for constraint in attribute_constraints:
+            if not isinstance(constraint, dict) or "id" not in constraint or "value" not in constraint:
+                raise ValueError(f"Invalid attribute constraint: {constraint}")
+            if constraint.get("operator") not in OPERATORS:
+                raise ValueError(
+                    f"Unsupported attribute constraint operator: {constraint.get('operator')}, "
+                    f"the supported operators are {', '.join(OPERATORS)}"
+                )
+            if constraint["operator"] == "matches":
+                values = constraint["value"] if isinstance(constraint["value"], list) else [constraint["value"]]
+                for value in values:
+                    compile_pattern(str(value))
+        return attribute_constraints
+
+    def split(self):
+        """Split the attribute constraints between the ones pushed down in SPARQL, and the ones checked on the edges
+
+        :return: Tuple with the list of constraints pushed down, and the list of constraints checked on the edges.
+            The constraints on CURIEs are in both, as their SPARQL filter can match other values
+        """
+        pushed = []
+        checked = []
+        for constraint in self.attribute_constraints:
+            values = constraint["value"] if isinstance(constraint["value"], list) else [constraint["value"]]
+            pushable = (
+                constraint["operator"] in SPARQL_OPERATORS
+                and constraint["id"] not in IN_ENGINE_ATTRIBUTES
+                and values
+                and (constraint["operator"] == "==" or all(is_number(value) for value in values))
+            )
+            if pushable:
+                pushed.append(constraint)
+            if not pushable or any(is_curie(value) for value in values):
+                checked.append(constraint)
+        return pushed, checked
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_curie(value):
+    return isinstance(value, str) and CURIE_REGEX.match(value) is not None
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    """Compile the regular expression of a "matches" attribute constraint
+
+    :raise ValueError: if the regular expression is invalid, too long, or can backtrack exponentially
+    """
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError(
+            f"Invalid attribute constraint: the regular expression is longer than {MAX_PATTERN_LENGTH} characters"
+        )
+    if NESTED_QUANTIFIER_REGEX.search(pattern):
+        raise ValueError(f"Invalid attribute constraint: the regular expression {pattern} has nested quantifiers")
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid attribute constraint: the regular expression {pattern} is invalid: {e}") from None
+
+
+def sparql_literal(value):
+    """Render a value as a SPARQL string literal"""
+    return json.dumps(value if isinstance(value, str) else json.dumps(value))
+
+
+def sparql_value_filter(var, operator, values, resolve_curie, match_local_ids=True):
+    """Render the FILTER checking a variable against the values of a constraint, any of them can match
+
+    :param match_local_ids: Also match the URIs ending with the local ID of the CURIE values
+    """
+    if operator == "==":
+        conditions = []
+        strings = []
+        for value in values:
+            if is_number(value):
+                conditions.append(f"{XSD_DOUBLE}(str({var})) = {float(value)!r}")
+                continue
+            strings.append(sparql_literal(value))
+            if is_curie(value):
+                strings.append(sparql_literal(resolve_curie(value)))
+                if not match_local_ids:
+                    continue
+                local_id = value.split(":", 1)[1]
+                conditions += [
+                    f"STRENDS(str({var}), {sparql_literal(separator + local_id)})" for separator in URI_SEPARATORS
+                ]
+            elif isinstance(value, str):
+                # Values of the BioLink enums (e.g. qualifier values) can be stored as URIs
+                strings.append(sparql_literal(resolve_curie(f"biolink:{value}")))
+        if strings:
+            conditions.append(f"str({var}) IN ({', '.join(strings)})")
+        return f"FILTER({' || '.join(conditions)})"
+    comparisons = [f"{XSD_DOUBLE}(str({var})) {operator} {float(value)!r}" for value in values]
+    return f"FILTER({' || '.join(comparisons)})"
+
+
+def sparql_constraint_filters(constraints, pushed, resolve_curie, old_model=False):
+    """Render the SPARQL filters of the constraints pushed down in the association window
+
+    :param constraints: Constraints of the edge
+    :param pushed: Attribute constraints pushed down, from constraints.split()
+    :param resolve_curie: Function converting a CURIE to an URI
+    :param old_model: Render the filters for the older BioLink model, whose associations have no qualifiers
+        nor biolink:has_attribute
+    :return: The SPARQL filters, to add in the graph of the associations
+    """
+    filters = []
+    if constraints.qualifier_sets:
+        if old_model:
+            return "FILTER(false)"
+        branches = []
+        for qualifier_set in constraints.qualifier_sets:
+            patterns = []
+            for qualifier_type, qualifier_value in qualifier_set:
+                var = f"?qualifier_constraint_{len(patterns)}"
+                patterns.append(
+                    f"?association {sparql_iri(resolve_curie(qualifier_type))} {var} . "
+                    + sparql_value_filter(var, "==", [qualifier_value], resolve_curie, match_local_ids=False)
+                )
+            branches.append("{ " + " ".join(patterns) + " }")
+        filters.append("FILTER EXISTS { " + " UNION ".join(branches) + " }")
+
+    for i, constraint in enumerate(pushed):
+        var = f"?attribute_constraint_{i}"
+        values = constraint["value"] if isinstance(constraint["value"], list) else [constraint["value"]]
+        patterns = []
+        dedicated = DEDICATED_ATTRIBUTES.get(constraint["id"])
+        if dedicated:
+            predicate = dedicated[1] if old_model else dedicated[0]
+            patterns.append(f"?association {predicate} {var} .")
+        if not old_model:
+            patterns.append(
+                f"?association biolink:has_attribute [ biolink:has_attribute_type "
+                f"{sparql_iri(resolve_curie(constraint['id']))} ; biolink:value {var} ] ."
+            )
+        negated = constraint.get("not", False)
+        if not patterns:
+            # The older model cannot have this attribute
+            if not negated:
+                return "FILTER(false)"
+            continue
+        pattern = " UNION ".join("{ " + pattern + " }" for pattern in patterns)
+        value_filter = sparql_value_filter(var, constraint["operator"], values, resolve_curie)
+        filters.append(f"FILTER {'NOT EXISTS' if negated else 'EXISTS'} {{ {pattern} {value_filter} }}")
+    return "\n        ".join(filters)
+
+
+def value_matches(operator, attribute_value, value):
+    """Check if the value of an attribute of an edge matches a value of a constraint"""
+    if operator == "===":
+        return attribute_value == value
+    if operator == "matches":
+        return compile_pattern(str(value)).search(str(attribute_value)) is not None
+    if is_number(value):
+        try:
+            attribute_number = float(attribute_value)
+        except (TypeError, ValueError):
+            return False
+        if operator == "==":
+            return attribute_number == value
+        return attribute_number > value if operator == ">" else attribute_number < value
+    if operator == "==":
+        return str(attribute_value) in (str(value), f"biolink:{value}")
+    return str(attribute_value) > str(value) if operator == ">" else str(attribute_value) < str(value)
+
+
+def edge_matches(edge, qualifier_sets, attribute_constraints):
+    """Check if a TRAPI edge matches qualifier sets (any of them) and attribute constraints (all of them)"""
+    if qualifier_sets:
+        qualifiers = [(q["qualifier_type_id"], q["qualifier_value"]) for q in edge.get("qualifiers") or []]
+        if not any(
+            all(
+                any(
+                    qualifier_type == edge_type and value_matches("==", edge_value, value)
+                    for edge_type, edge_value in qualifiers
+                )
+                for qualifier_type, value in qualifier_set
+            )
+            for qualifier_set in qualifier_sets
+        ):
+            return False
+    for constraint in attribute_constraints:
+        operator = constraint["operator"]
+        values = constraint["value"] if isinstance(constraint["value"], list) and operator != "===" else [
+            constraint["value"]
+        ]
+        matched = any(
+            value_matches(operator, attribute["value"], value)
+            for attribute in edge.get("attributes") or []
+            if attribute["attribute_type_id"] == constraint["id"]
+            for value in values
+        )
+        if matched == bool(constraint.get("not", False)):
+            return False
+    return True
+
+
+def filter_edges(knowledge_graph, results, edge_id, qualifier_sets, attribute_constraints):
+    """Remove the edges of a one-hop answer which do not match constraints, with their results and orphan nodes
+
+    :return: Tuple with the knowledge graph, the results, and the set of IDs of the edges removed
+    """
+    rejected = {
+        edge_uri
+        for edge_uri, edge in knowledge_graph["edges"].items()
+        if not edge_matches(edge, qualifier_sets, attribute_constraints)
+    }
+    if not rejected:
+        return knowledge_graph, results, rejected
+    results = [
+        result
+        for result in results
+        if all(binding["id"] not in rejected for binding in result["analyses"][0]["edge_bindings"][edge_id])
+    ]
+    return filter_kgraph_orphans(knowledge_graph, results), results, rejected
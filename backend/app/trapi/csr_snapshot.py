@@ -0,0 +1,373 @@
+"""Memory-mapped snapshot of the edge store, with CSR adjacency arrays for fast pinned-id one-hop lookups.
+
+Node URIs, categories and predicates are interned to integer ids. The snapshot file contains:
+- sorted string tables for nodes, categories and predicates (to resolve URIs to ids by binary search)
+- forward and reverse CSR adjacency arrays (node id -> edge ids)
+- the subject, predicate and object of each edge, and the categories of each node
+- offsets to the JSON serialized details (sources, attributes, qualifiers) of each edge
+
+The file is memory-mapped read-only, so all worker processes share the same pages from the OS cache.
+It is rebuilt in a temporary file and atomically moved in place, readers reopen it when it changes.
+The lookups use the snapshot through open_snapshot, which counts them: the memory map of a replaced snapshot is
+closed once the last lookup using it is done.
+"""
+import json
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import orjson
+from app.config import logger, settings
+from app.trapi import edge_store
+
+MAGIC = b"KCCSR001"
+ALIGNMENT = 8
+# Number of associations loaded from the edge store at once when building the snapshot
+BUILD_BATCH_SIZE = 5000
+
+
+class StringTable:
+    """Sorted table of strings stored as an offsets array and a UTF-8 blob"""
+
+    __slots__ = ("offsets", "blob", "size")
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.size = len(offsets) - 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return bytes(self.blob[self.offsets[index] : self.offsets[index + 1]]).decode()
+
+    def index(self, value):
+        """Get the id of a string by binary search, None if not in the table"""
+        index = bisect_left(self, value)
+        if index < self.size and self[index] == value:
+            return index
+        return None
+
+
+def encode_strings(strings):
+    offsets = array("q", [0])
+    blob = bytearray()
+    for string in strings:
+        blob.extend(string.encode())
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def build_csr(edge_nodes, nodes_count):
+    """Build the CSR offsets and edge ids arrays for a list of source node ids, indexed by edge id"""
+    offsets = array("q", [0] * (nodes_count + 1))
+    for node_id in edge_nodes:
+        offsets[node_id + 1] += 1
+    for node_id in range(nodes_count):
+        offsets[node_id + 1] += offsets[node_id]
+    positions = array("q", offsets[:-1])
+    edge_ids = array("i", [0] * len(edge_nodes))
+    for edge_id, node_id in enumerate(edge_nodes):
+        edge_ids[positions[node_id]] = edge_id
+        positions[node_id] += 1
+    return offsets, edge_ids
+
+
+def write_snapshot(path, sections, counts):
+    """Write the sections (name -> array or bytes) in a snapshot file, aligned for zero-copy reading"""
+    header = {"counts": counts, "sections": {}}
+    position = 0
+    layout = []
+    for name, data in sections.items():
+        raw = data.tobytes() if isinstance(data, array) else data
+        typecode = data.typecode if isinstance(data, array) else "B"
+        header["sections"][name] = [position, len(raw), typecode]
+        layout.append(raw)
+        position += len(raw) + (-len(raw) % ALIGNMENT)
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-len(header_bytes) % ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for raw in layout:
+            f.write(raw)
+            f.write(b"\0" * (-len(raw) % ALIGNMENT))
+
+
+def build_csr_snapshot(store_path=None, snapshot_path=None):
+    """Build the CSR snapshot from the edge store, and atomically replace the previous snapshot
+
+    :return: Number of edges in the snapshot
+    """
+    store_path = store_path or settings.EDGE_STORE_PATH
+    snapshot_path = snapshot_path or settings.CSR_SNAPSHOT_PATH
+    conn = edge_store.connect(store_path)
+    try:
+        edges = conn.execute(
+            "SELECT association, subject, predicate, object, np_uri, label, description, pubkey FROM associations "
+            "ORDER BY association"
+        ).fetchall()
+        node_categories = conn.execute("SELECT uri, category FROM nodes").fetchall()
+
+        nodes = sorted({uri for uri, _ in node_categories} | {e[1] for e in edges} | {e[3] for e in edges})
+        categories = sorted({category for _, category in node_categories})
+        predicates = sorted({e[2] for e in edges})
+        node_ids = {uri: i for i, uri in enumerate(nodes)}
+        category_ids = {uri: i for i, uri in enumerate(categories)}
+        predicate_ids = {uri: i for i, uri in enumerate(predicates)}
+
+        # Categories of each node, as CSR
+        categories_by_node = [[] for _ in nodes]
+        for uri, category in node_categories:
+            categories_by_node[node_ids[uri]].append(category_ids[category])
+        node_category_offsets = array("q", [0])
+        node_category_ids = array("i")
+        for node_category_list in categories_by_node:
+            node_category_ids.extend(sorted(node_category_list))
+            node_category_offsets.append(len(node_category_ids))
+
+        edge_subjects = array("i", (node_ids[e[1]] for e in edges))
+        edge_predicates = array("i", (predicate_ids[e[2]] for e in edges))
+        edge_objects = array("i", (node_ids[e[3]] for e in edges))
+        forward_offsets, forward_edges = build_csr(edge_subjects, len(nodes))
+        reverse_offsets, reverse_edges = build_csr(edge_objects, len(nodes))
+
+        # Details of each edge serialized as JSON: base bindings and one partial binding per detail row
+        edge_data_offsets = array("q", [0])
+        edge_data = bytearray()
+        for start in range(0, len(edges), BUILD_BATCH_SIZE):
+            batch = edges[start : start + BUILD_BATCH_SIZE]
+            details = {e[0]: [] for e in batch}
+            for association, detail in edge_store.select_details(conn, [e[0] for e in batch]):
+                details[association].append(detail)
+            for association, _subject, _predicate, _object, np_uri, label, description, pubkey in batch:
+                base = {"association": edge_store.uri_binding(association)}
+                if np_uri:
+                    base["np_uri"] = edge_store.uri_binding(np_uri)
+                if pubkey:
+                    base["pubkey"] = {"type": "literal", "value": pubkey}
+                if label:
+                    base["label"] = {"type": "literal", "value": label}
+                if description:
+                    base["description"] = {"type": "literal", "value": description}
+                edge_data.extend(orjson.dumps({"base": base, "details": details[association]}))
+                edge_data_offsets.append(len(edge_data))
+    finally:
+        conn.close()
+
+    node_offsets, node_blob = encode_strings(nodes)
+    category_offsets, category_blob = encode_strings(categories)
+    predicate_offsets, predicate_blob = encode_strings(predicates)
+    tmp_path = f"{snapshot_path}.tmp"
+    write_snapshot(
+        tmp_path,
+        {
+            "node_offsets": node_offsets,
+            "node_blob": node_blob,
+            "category_offsets": category_offsets,
+            "category_blob": category_blob,
+            "predicate_offsets": predicate_offsets,
+            "predicate_blob": predicate_blob,
+            "node_category_offsets": node_category_offsets,
+            "node_category_ids": node_category_ids,
+            "edge_subjects": edge_subjects,
+            "edge_predicates": edge_predicates,
+            "edge_objects": edge_objects,
+            "forward_offsets": forward_offsets,
+            "forward_edges": forward_edges,
+            "reverse_offsets": reverse_offsets,
+            "reverse_edges": reverse_edges,
+            "edge_data_offsets": edge_data_offsets,
+            "edge_data": bytes(edge_data),
+        },
+        {"nodes": len(nodes), "edges": len(edges)},
+    )
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"CSR snapshot built in {snapshot_path} with {len(nodes)} nodes and {len(edges)} edges")
+    return len(edges)
+
+
+class CsrSnapshot:
+    """Read-only memory-mapped CSR snapshot"""
+
+    def __init__(self, path):
+        self.path = path
+        # Number of lookups using the snapshot, and if it was replaced by a new snapshot (see open_snapshot)
+        self.readers = 0
+        self.retired = False
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.key = (stat.st_ino, stat.st_mtime_ns)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a CSR snapshot")
+        header_length = int.from_bytes(self.mmap[len(MAGIC) : len(MAGIC) + 8], "little")
+        data_start = len(MAGIC) + 8 + header_length
+        header = json.loads(self.mmap[len(MAGIC) + 8 : data_start])
+        self.view = view = memoryview(self.mmap)
+        self.sections = {}
+        for name, (offset, length, typecode) in header["sections"].items():
+            section = view[data_start + offset : data_start + offset + length]
+            self.sections[name] = section if typecode == "B" else section.cast(typecode)
+        self.counts = header["counts"]
+        self.nodes = StringTable(self.sections["node_offsets"], self.sections["node_blob"])
+        # Categories and predicates are small, they are kept in memory as dicts
+        categories = StringTable(self.sections["category_offsets"], self.sections["category_blob"])
+        predicates = StringTable(self.sections["predicate_offsets"], self.sections["predicate_blob"])
+        self.categories = [categories[i] for i in range(len(categories))]
+        self.category_ids = {uri: i for i, uri in enumerate(self.categories)}
+        self.predicates = [predicates[i] for i in range(len(predicates))]
+        self.predicate_ids = {uri: i for i, uri in enumerate(self.predicates)}
+
+    def close(self):
+        """Release the views of the sections and close the memory map, the snapshot cannot be used anymore"""
+        for section in self.sections.values():
+            section.release()
+        self.view.release()
+        self.mmap.close()
+
+    def node_categories(self, node_id):
+        offsets = self.sections["node_category_offsets"]
+        return self.sections["node_category_ids"][offsets[node_id] : offsets[node_id + 1]]
+
+    def edges_of(self, node_id, reverse=False):
+        """Get the ids of the edges starting from (or ending at, if reverse) a node"""
+        prefix = "reverse" if reverse else "forward"
+        offsets = self.sections[f"{prefix}_offsets"]
+        return self.sections[f"{prefix}_edges"][offsets[node_id] : offsets[node_id + 1]]
+
+    def edge_data(self, edge_id):
+        offsets = self.sections["edge_data_offsets"]
+        return orjson.loads(self.sections["edge_data"][offsets[edge_id] : offsets[edge_id + 1]])
+
+    def select_one_hop(
+        self,
+        predicates=None,
+        subject_categories=None,
+        object_categories=None,
+        subject_ids=None,
+        object_ids=None,
+        limit=None,
+        offset=0,
+    ):
+        """Get the associations matching a one-hop query with at least one pinned node.
+
+        Same constraints, pagination and output format as edge_store.select_one_hop.
+        """
+        subject_node_ids = {self.nodes.index(uri) for uri in subject_ids or []} - {None}
+        object_node_ids = {self.nodes.index(uri) for uri in object_ids or []} - {None}
+        predicate_ids = {self.predicate_ids.get(uri) for uri in predicates or []} - {None}
+        subject_category_ids = {self.category_ids.get(uri) for uri in subject_categories or []} - {None}
+        object_category_ids = {self.category_ids.get(uri) for uri in object_categories or []} - {None}
+        if (
+            (subject_ids and not subject_node_ids)
+            or (object_ids and not object_node_ids)
+            or (predicates and not predicate_ids)
+            or (subject_categories and not subject_category_ids)
+            or (object_categories and not object_category_ids)
+        ):
+            return []
+
+        # Start from the pinned side with the fewest nodes
+        reverse = not subject_node_ids or (object_node_ids and len(object_node_ids) < len(subject_node_ids))
+        start_nodes = object_node_ids if reverse else subject_node_ids
+        edge_subjects = self.sections["edge_subjects"]
+        edge_objects = self.sections["edge_objects"]
+        edge_predicates = self.sections["edge_predicates"]
+        matched_edges = set()
+        for node_id in start_nodes:
+            for edge_id in self.edges_of(node_id, reverse):
+                if predicate_ids and edge_predicates[edge_id] not in predicate_ids:
+                    continue
+                if subject_node_ids and edge_subjects[edge_id] not in subject_node_ids:
+                    continue
+                if object_node_ids and edge_objects[edge_id] not in object_node_ids:
+                    continue
+                matched_edges.add(edge_id)
+
+        bindings = []
+        edges_count = 0
+        skipped = 0
+        # Edges are ordered by association URI, since the snapshot edges are built sorted by association
+        for edge_id in sorted(matched_edges):
+            subject_id = edge_subjects[edge_id]
+            object_id = edge_objects[edge_id]
+            subject_cats = [c for c in self.node_categories(subject_id) if not subject_category_ids or c in subject_category_ids]
+            object_cats = [c for c in self.node_categories(object_id) if not object_category_ids or c in object_category_ids]
+            if not subject_cats or not object_cats:
+                continue
+            if skipped < (offset or 0):
+                skipped += 1
+                continue
+            if limit and edges_count >= limit:
+                break
+            edges_count += 1
+            data = self.edge_data(edge_id)
+            core = {
+                **data["base"],
+                "subject": edge_store.uri_binding(self.nodes[subject_id]),
+                "predicate": edge_store.uri_binding(self.predicates[edge_predicates[edge_id]]),
+                "object": edge_store.uri_binding(self.nodes[object_id]),
+            }
+            for subject_cat in subject_cats:
+                for object_cat in object_cats:
+                    bindings.append({
+                        **core,
+                        "subject_category": edge_store.uri_binding(self.categories[subject_cat]),
+                        "object_category": edge_store.uri_binding(self.categories[object_cat]),
+                    })
+            # Details rows reuse the first categories, without label and description
+            first_row = {var: value for var, value in bindings[-1].items() if var not in ("label", "description")}
+            bindings.extend({**first_row, **detail} for detail in data["details"])
+        return bindings
+
+
+snapshot = None
+# Reentrant, as open_snapshot gets the snapshot while holding it
+snapshot_lock = threading.RLock()
+
+
+def get_snapshot(path=None):
+    """Get the current CSR snapshot, reopened when the file has been replaced by a new build
+
+    The snapshot returned is closed when it is replaced, the lookups should use open_snapshot.
+    """
+    global snapshot
+    path = path or settings.CSR_SNAPSHOT_PATH
+    stat = os.stat(path)
+    if snapshot is None or snapshot.path != path or snapshot.key != (stat.st_ino, stat.st_mtime_ns):
+        with snapshot_lock:
+            if snapshot is None or snapshot.path != path or snapshot.key != (stat.st_ino, stat.st_mtime_ns):
+                previous = snapshot
+                snapshot = CsrSnapshot(path)
+                if previous is not None:
+                    # Closed now, or by the last lookup running on it
+                    previous.retired = True
+                    if not previous.readers:
+                        previous.close()
+    return snapshot
+
+
+@contextmanager
+def open_snapshot(path=None):
+    """Use the current CSR snapshot for a lookup, it is not closed before the lookup is done"""
+    with snapshot_lock:
+        current = get_snapshot(path)
+        current.readers += 1
+    try:
+        yield current
+    finally:
+        with snapshot_lock:
+            current.readers -= 1
+            if current.retired and not current.readers:
+                current.close()
+
+
+if __name__ == "__main__":
+    build_csr_snapshot()
@@ -0,0 +1,53 @@
+"""Batched retrieval of the properties of the associations, for TRAPI_DETAILS_MODE="batched"
+
+The core queries only retrieve the associations matching a one-hop query with their subject, predicate and object.
+Their properties are then retrieved by details queries, for batches of DETAILS_BATCH_SIZE associations bound with
+VALUES, and the detail rows are merged with the core bindings of their association.
+"""
+from app.trapi.sparql_builder import sparql_iri
+from app.trapi.sparql_templates import details_templates
+
+# Number of associations retrieved by each details query
+DETAILS_BATCH_SIZE = 500
+
+
+def build_details_queries(source_results, n_results):
+    """Generate the batched queries retrieving the properties of the associations returned by the core queries
+
+    Only the first n_results associations are kept when building the knowledge graph, the others are not queried.
+
+    :param source_results: Rows returned by each core query, one for each (chunk, template)
+    :return: List of SPARQL queries
+    """
+    associations_by_template = [{} for _ in details_templates]
+    kept = set()
+    for i, rows in enumerate(source_results):
+        for row in rows:
+            association = row["association"]["value"]
+            if association not in kept:
+                if len(kept) >= n_results:
+                    continue
+                kept.add(association)
+            key = (sparql_iri(association), sparql_iri(row["np_assertion"]["value"]))
+            associations_by_template[i % len(details_templates)][key] = None
+
+    queries = []
+    for template, template_associations in zip(details_templates, associations_by_template):
+        associations = list(template_associations)
+        for start in range(0, len(associations), DETAILS_BATCH_SIZE):
+            batch = associations[start : start + DETAILS_BATCH_SIZE]
+            queries.append(template.render(associations=" ".join(f"({a} {g})" for a, g in batch)))
+    return queries
+
+
+def merge_detail_rows(core_rows, detail_rows):
+    """Yield the core rows, then the detail rows completed with the core bindings of their association,
+    so they can be processed like the rows of the main queries"""
+    core_by_association = {}
+    for row in core_rows:
+        core_by_association.setdefault(row["association"]["value"], row)
+        yield row
+    for row in detail_rows:
+        core = core_by_association.get(row["association"]["value"])
+        if core:
+            yield {**core, **row}
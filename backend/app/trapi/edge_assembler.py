@@ -0,0 +1,206 @@
+"""Assemble the TRAPI knowledge graph and results of a one-hop query from SPARQL result rows
+
+Rows are accumulated in compact objects, deduplicated with sets keyed on tuples, and each distinct URI is
+resolved to a CURIE only once per query. The TRAPI dicts are only built at the end.
+"""
+
+# Edge properties added as attributes: (SPARQL variable, BioLink attribute type)
+ROW_ATTRIBUTES = [
+    ("label", "biolink:name"),
+    ("description", "biolink:description"),
+    ("publications", "biolink:publications"),
+    ("has_population_context", "biolink:population_context_qualifier"),
+    ("population_has_phenotype", "biolink:has_phenotype"),
+    ("provided_by", "biolink:provided_by"),
+]
+# Knowledge sources: (resource role, SPARQL variables prefix)
+ROW_SOURCES = [
+    ("primary_knowledge_source", "primary"),
+    ("supporting_data_source", "supporting"),
+]
+
+
+class SourceAccumulator:
+    """Knowledge source of an edge, with its upstream resources and record URLs"""
+
+    __slots__ = ("resource_role", "upstream_resource_ids", "source_record_urls")
+
+    def __init__(self, resource_role):
+        self.resource_role = resource_role
+        # Dicts are used as insertion-ordered sets
+        self.upstream_resource_ids = {}
+        self.source_record_urls = {}
+
+
+class EdgeAccumulator:
+    """Edge of the knowledge graph, with its attributes, qualifiers and sources"""
+
+    __slots__ = ("predicate", "subject", "object", "attributes", "qualifiers", "sources")
+
+    def __init__(self, predicate, subject, obj):
+        self.predicate = predicate
+        self.subject = subject
+        self.object = obj
+        # (attribute_type_id, value, attribute_source)
+        self.attributes = {}
+        # (qualifier_type_id, qualifier_value)
+        self.qualifiers = {}
+        # resource_id: SourceAccumulator
+        self.sources = {}
+
+    def to_trapi(self):
+        sources = []
+        for resource_id, source in self.sources.items():
+            trapi_source = {"resource_id": resource_id, "resource_role": source.resource_role}
+            if source.upstream_resource_ids:
+                trapi_source["upstream_resource_ids"] = list(source.upstream_resource_ids)
+            if source.source_record_urls:
+                trapi_source["source_record_urls"] = list(source.source_record_urls)
+            sources.append(trapi_source)
+        attributes = []
+        for attribute_type_id, value, attribute_source in self.attributes:
+            attribute = {"attribute_type_id": attribute_type_id, "value": value}
+            if attribute_source is not None:
+                attribute["attribute_source"] = attribute_source
+            attributes.append(attribute)
+        return {
+            "predicate": [self.predicate],
+            "subject": self.subject,
+            "object": self.object,
+            "attributes": attributes,
+            "qualifiers": [
+                {"qualifier_type_id": qualifier_type_id, "qualifier_value": qualifier_value}
+                for qualifier_type_id, qualifier_value in self.qualifiers
+            ],
+            "sources": sources,
+        }
+
+
+class EdgeAssembler:
+    """Build the TRAPI knowledge graph and results of a query graph edge from SPARQL result rows
+
+    :param edge_id: ID of the query graph edge
+    :param subject_node_id: ID of the query graph subject node
+    :param object_node_id: ID of the query graph object node
+    :param resolve_uri: Function converting an URI to a CURIE
+    :param np_users: Nanopublication users indexed by their public key, to add the author of the edges
+    :param max_edges: Maximum number of edges, the rows of other edges are ignored
+    :param projection: Projection of the edge properties (see app.trapi.projection), the attributes and qualifiers
+        it does not keep are not assembled. None to keep all of them
+    """
+
+    def __init__(
+        self, edge_id, subject_node_id, object_node_id, resolve_uri, np_users=None, max_edges=None, projection=None
+    ):
+        self.edge_id = edge_id
+        self.subject_node_id = subject_node_id
+        self.object_node_id = object_node_id
+        self.resolve_uri = resolve_uri
+        self.np_users = np_users or {}
+        self.max_edges = max_edges
+        self.projection = projection
+        # Resolved once, instead of checking the projection for each row
+        keeps = projection.keeps_attribute if projection else lambda attribute_type_id: True
+        self.row_attributes = [(var, type_id) for var, type_id in ROW_ATTRIBUTES if keeps(type_id)]
+        self.keep_author = keeps("biolink:author")
+        self.keep_qualifiers = projection is None or projection.qualifiers
+        self.curies = {}
+        self.edges = {}
+        # Node CURIE: categories (as an insertion-ordered set)
+        self.nodes = {}
+        # Node CURIE: URIs resolved to this CURIE (as an insertion-ordered set)
+        self.node_uris = {}
+
+    def __contains__(self, edge_uri):
+        return edge_uri in self.edges
+
+    def curie(self, binding):
+        uri = binding["value"]
+        curie = self.curies.get(uri)
+        if curie is None:
+            curie = self.curies[uri] = self.resolve_uri(uri)
+        return curie
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row)
+
+    def add_row(self, row):
+        edge_uri = row["association"]["value"]
+        edge = self.edges.get(edge_uri)
+        if edge is None:
+            if self.max_edges is not None and len(self.edges) >= self.max_edges:
+                return
+            edge = self.edges[edge_uri] = EdgeAccumulator(
+                self.curie(row["predicate"]), self.curie(row["subject"]), self.curie(row["object"])
+            )
+            self.node_uris.setdefault(edge.subject, {}).setdefault(row["subject"]["value"])
+            self.node_uris.setdefault(edge.object, {}).setdefault(row["object"]["value"])
+        curie = self.curie
+
+        # Author based on the nanopub pubkey
+        if "pubkey" in row and self.keep_author:
+            user = self.np_users.get(row["pubkey"]["value"], {}).get("user")
+            if user:
+                edge.attributes.setdefault(("biolink:author", user["value"], None))
+
+        for resource_role, prefix in ROW_SOURCES:
+            if resource_role in row:
+                source = edge.sources.get(curie(row[resource_role]))
+                if source is None:
+                    source = edge.sources[curie(row[resource_role])] = SourceAccumulator(resource_role)
+                elif source.resource_role != resource_role:
+                    # The first role found for a resource is kept
+                    continue
+                if f"{prefix}_upstream_resource_ids" in row:
+                    source.upstream_resource_ids.setdefault(curie(row[f"{prefix}_upstream_resource_ids"]))
+                if f"{prefix}_source_record_urls" in row:
+                    source.source_record_urls.setdefault(curie(row[f"{prefix}_source_record_urls"]))
+
+        if "attribute_type" in row:
+            attribute_type_id = curie(row["attribute_type"])
+            if self.projection is None or self.projection.keeps_attribute(attribute_type_id):
+                edge.attributes.setdefault(
+                    (attribute_type_id, curie(row["attribute_value"]), curie(row["attribute_provider"]))
+                )
+        if "qualifier_value" in row and self.keep_qualifiers:
+            edge.qualifiers.setdefault((curie(row["qualifier"]), curie(row["qualifier_value"])))
+        for var, attribute_type_id in self.row_attributes:
+            if var in row:
+                edge.attributes.setdefault((attribute_type_id, curie(row[var]), None))
+
+        self.nodes.setdefault(edge.subject, {}).setdefault(curie(row["subject_category"]))
+        self.nodes.setdefault(edge.object, {}).setdefault(curie(row["object_category"]))
+
+    def get_node_uris(self, node_curies):
+        """Get the URIs of nodes as stored in the nanopubs, as resolving their CURIE back may give another URI
+
+        :return: Dict with the list of URIs of each node CURIE
+        """
+        return {curie: list(self.node_uris[curie]) for curie in node_curies if curie in self.node_uris}
+
+    def to_trapi(self):
+        """Get the TRAPI knowledge graph, and the results (one for each edge)
+
+        :return: Tuple with the knowledge graph and the list of results
+        """
+        kg = {
+            "nodes": {node: {"categories": list(categories)} for node, categories in self.nodes.items()},
+            "edges": {edge_uri: edge.to_trapi() for edge_uri, edge in self.edges.items()},
+        }
+        results = [
+            {
+                "node_bindings": {
+                    self.subject_node_id: [{"id": edge.subject}],
+                    self.object_node_id: [{"id": edge.object}],
+                },
+                "analyses": [
+                    {
+                        "resource_id": "infores:knowledge-collaboratory",
+                        "edge_bindings": {self.edge_id: [{"id": edge_uri}]},
+                    }
+                ],
+            }
+            for edge_uri, edge in self.edges.items()
+        ]
+        return kg, results
@@ -0,0 +1,581 @@
+"""Local SQLite mirror of the associations published in the Nanopublication network.
+
+The store is populated from the same SPARQL templates used to answer TRAPI queries (see sync_edge_store),
+and returns rows in the SPARQL JSON bindings format, so they can be turned into a TRAPI knowledge graph
+the same way as the results of the SPARQL endpoint.
+"""
+import fcntl
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from app.config import logger, settings
+from app.governor import background_priority
+from app.metrics import counter, gauge
+from app.trapi.sparql_templates import one_hop_templates, retraction_filter_block
+
+# Number of rows retrieved from the SPARQL endpoint for each page during a sync
+SYNC_PAGE_SIZE = 10000
+# Number of associations whose rows are retrieved by each one-hop query during a sync
+SYNC_WINDOW_SIZE = 1000
+# Maximum number of parameters in a single SQLite IN (...) clause
+SQL_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS associations (
+    association TEXT PRIMARY KEY,
+    np_uri TEXT NOT NULL DEFAULT '',
+    subject TEXT NOT NULL,
+    predicate TEXT NOT NULL,
+    object TEXT NOT NULL,
+    label TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    pubkey TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    uri TEXT NOT NULL,
+    category TEXT NOT NULL,
+    PRIMARY KEY (uri, category)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    association TEXT NOT NULL,
+    resource_role TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    upstream_resource_id TEXT NOT NULL DEFAULT '',
+    source_record_url TEXT NOT NULL DEFAULT '',
+    UNIQUE (association, resource_role, resource_id, upstream_resource_id, source_record_url)
+);
+CREATE TABLE IF NOT EXISTS attributes (
+    association TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    attribute_type TEXT NOT NULL DEFAULT '',
+    value TEXT NOT NULL,
+    attribute_source TEXT NOT NULL DEFAULT '',
+    UNIQUE (association, kind, attribute_type, value, attribute_source)
+);
+CREATE TABLE IF NOT EXISTS qualifiers (
+    association TEXT NOT NULL,
+    qualifier_type TEXT NOT NULL,
+    qualifier_value TEXT NOT NULL,
+    UNIQUE (association, qualifier_type, qualifier_value)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_associations_subject ON associations (subject);
+CREATE INDEX IF NOT EXISTS idx_associations_object ON associations (object);
+CREATE INDEX IF NOT EXISTS idx_associations_predicate ON associations (predicate);
+CREATE INDEX IF NOT EXISTS idx_associations_np_uri ON associations (np_uri);
+CREATE INDEX IF NOT EXISTS idx_nodes_category ON nodes (category, uri);
+CREATE INDEX IF NOT EXISTS idx_sources_association ON sources (association);
+CREATE INDEX IF NOT EXISTS idx_attributes_association ON attributes (association);
+CREATE INDEX IF NOT EXISTS idx_qualifiers_association ON qualifiers (association);
+"""
+
+# Attributes retrieved as a single SPARQL variable, stored with the variable name as kind
+FLAT_ATTRIBUTES = ["publications", "provided_by", "has_population_context", "population_has_phenotype"]
+SOURCE_ROLES = {
+    "primary_knowledge_source": "primary",
+    "supporting_data_source": "supporting",
+}
+
+# Date of the most recent nanopublication published in the network
+get_latest_created_query = """PREFIX dct: <http://purl.org/dc/terms/>
+PREFIX npa: <http://purl.org/nanopub/admin/>
+SELECT (MAX(?created) AS ?latest_created)
+WHERE {
+  graph npa:graph {
+    ?np_uri dct:created ?created .
+  }
+}"""
+
+# Nanopublications retracted or superseded by a nanopublication published in a time window.
+# Retractions are stated in the assertion of the retracting nanopub, new versions state npx:supersedes in their
+# publication info, and are only valid when signed with the same key as the nanopub they supersede
+get_invalidated_nanopubs_query = """PREFIX np: <http://www.nanopub.org/nschema#>
+PREFIX npx: <http://purl.org/nanopub/x/>
+PREFIX npa: <http://purl.org/nanopub/admin/>
+PREFIX dct: <http://purl.org/dc/terms/>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+SELECT DISTINCT ?np_uri
+WHERE {
+  {
+    graph ?invalidating_head {
+      ?invalidating_np np:hasAssertion ?invalidating_graph .
+    }
+    graph ?invalidating_graph {
+      ?creator npx:retracts ?np_uri .
+    }
+  } UNION {
+    graph ?invalidating_head {
+      ?invalidating_np np:hasPublicationInfo ?invalidating_graph .
+    }
+    graph ?invalidating_graph {
+      ?invalidating_np npx:supersedes ?np_uri .
+    }
+    graph npa:graph {
+      ?invalidating_np npa:hasValidSignatureForPublicKey ?pubkey .
+      ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
+    }
+  }
+  graph npa:graph {
+    ?invalidating_np dct:created ?created .
+  }
+  ?_created_filter
+}"""
+
+# Restrict the nanopubs retrieved by the TRAPI templates to the ones published in a time window
+created_window_block = """graph npa:graph {
+    ?np_uri dct:created ?np_created .
+  }
+  FILTER (?np_created > "?_since"^^xsd:dateTime && ?np_created <= "?_until"^^xsd:dateTime)"""
+
+sync_count = counter("edge_store_syncs_total", "Number of successful edge store synchronizations")
+sync_lock = threading.Lock()
+
+
+def binding_value(row, var):
+    """Get the value of a variable in a SPARQL JSON binding, empty string if unbound"""
+    return row[var]["value"] if var in row else ""
+
+
+def uri_binding(value):
+    return {"type": "uri", "value": value}
+
+
+def connect(path=None, read_only=True):
+    """Open a connection to the edge store, one connection should be used per thread"""
+    path = path or settings.EDGE_STORE_PATH
+    if read_only:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def insert_bindings(conn, bindings):
+    """Insert rows returned by the TRAPI SPARQL templates in the edge store
+
+    :param conn: Connection to the edge store
+    :param bindings: List of SPARQL JSON bindings
+    """
+    for row in bindings:
+        association = row["association"]["value"]
+        conn.execute(
+            "INSERT OR IGNORE INTO associations (association, np_uri, subject, predicate, object, label, description, "
+            "pubkey) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                association,
+                binding_value(row, "np_uri"),
+                row["subject"]["value"],
+                row["predicate"]["value"],
+                row["object"]["value"],
+                binding_value(row, "label"),
+                binding_value(row, "description"),
+                binding_value(row, "pubkey"),
+            ),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO nodes VALUES (?, ?)",
+            [
+                (row["subject"]["value"], row["subject_category"]["value"]),
+                (row["object"]["value"], row["object_category"]["value"]),
+            ],
+        )
+        for role, prefix in SOURCE_ROLES.items():
+            if role in row:
+                conn.execute(
+                    "INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?)",
+                    (
+                        association,
+                        role,
+                        row[role]["value"],
+                        binding_value(row, f"{prefix}_upstream_resource_ids"),
+                        binding_value(row, f"{prefix}_source_record_urls"),
+                    ),
+                )
+        if "attribute_type" in row:
+            conn.execute(
+                "INSERT OR IGNORE INTO attributes VALUES (?, 'attribute', ?, ?, ?)",
+                (
+                    association,
+                    row["attribute_type"]["value"],
+                    row["attribute_value"]["value"],
+                    binding_value(row, "attribute_provider"),
+                ),
+            )
+        for var in FLAT_ATTRIBUTES:
+            if var in row:
+                conn.execute(
+                    "INSERT OR IGNORE INTO attributes VALUES (?, ?, '', ?, '')",
+                    (association, var, row[var]["value"]),
+                )
+        if "qualifier_value" in row:
+            conn.execute(
+                "INSERT OR IGNORE INTO qualifiers VALUES (?, ?, ?)",
+                (association, row["qualifier"]["value"], row["qualifier_value"]["value"]),
+            )
+
+
+def get_sync_query(template, limit, offset=0, since=None, until=None):
+    """Get the query retrieving a page of all the associations of a one-hop template, with all their properties
+
+    :param template: One-hop template, rendered without constraints nor projection
+    :param limit: Number of distinct associations in the page
+    :param offset: Number of associations to skip
+    :param since: Only retrieve the nanopubs created after this date (xsd:dateTime), and until the until date
+    """
+    np_filter = ""
+    if since:
+        np_filter = created_window_block.replace("?_since", since).replace("?_until", until)
+    query = template.render({}, limit, offset, np_index_filter=np_filter, retraction_filter=retraction_filter_block)
+    return query.replace(
+        "PREFIX np: ", "PREFIX dct: <http://purl.org/dc/terms/>\nPREFIX xsd: <http://www.w3.org/2001/XMLSchema#>\nPREFIX np: ", 1
+    )
+
+
+def fetch_bindings(run_sparql_query, since=None, until=None):
+    """Retrieve all rows of the one-hop templates, by pages of SYNC_WINDOW_SIZE associations
+
+    The pages are windows of distinct associations ordered by URI, and all the rows of their associations are
+    retrieved, so the rows of an association are never split between 2 pages.
+    """
+    for template in one_hop_templates:
+        offset = 0
+        while True:
+            bindings = run_sparql_query(get_sync_query(template, SYNC_WINDOW_SIZE, offset, since, until))
+            yield bindings
+            if len({row["association"]["value"] for row in bindings}) < SYNC_WINDOW_SIZE:
+                break
+            offset += SYNC_WINDOW_SIZE
+
+
+def get_state(conn, key):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", (key, str(value)))
+
+
+def delete_nanopubs(conn, np_uris):
+    """Delete all associations published by the given nanopubs from the edge store"""
+    np_uris = list(np_uris)
+    for start in range(0, len(np_uris), SQL_BATCH_SIZE):
+        condition, params = sql_in("np_uri", np_uris[start : start + SQL_BATCH_SIZE])
+        associations = f"SELECT association FROM associations WHERE {condition}"  # noqa: S608
+        for table in ("sources", "attributes", "qualifiers"):
+            conn.execute(f"DELETE FROM {table} WHERE association IN ({associations})", params)  # noqa: S608
+        conn.execute(f"DELETE FROM associations WHERE {condition}", params)  # noqa: S608
+
+
+def sync_edge_store(path=None, run_sparql_query=None):
+    """Rebuild the edge store from the Nanopublication network SPARQL endpoint.
+
+    The store is built in a temporary file, then atomically moved in place of the previous one.
+
+    :param path: Path to the SQLite file, defaults to settings.EDGE_STORE_PATH
+    :param run_sparql_query: Function running a SPARQL query and returning its bindings, defaults to the one
+        of the TRAPI engine
+    :return: Number of associations in the store
+    """
+    if run_sparql_query is None:
+        from app.trapi.reasonerapi_parser import run_sparql_query
+
+    path = path or settings.EDGE_STORE_PATH
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = connect(tmp_path, read_only=False)
+    # Get the high-water mark before downloading, nanopubs published during the download will be synced next time
+    latest_created = run_sparql_query(get_latest_created_query)[0]["latest_created"]["value"]
+    for bindings in fetch_bindings(run_sparql_query):
+        insert_bindings(conn, bindings)
+        conn.commit()
+    set_state(conn, "latest_created", latest_created)
+    set_state(conn, "network_latest_created", latest_created)
+    set_state(conn, "last_sync", time.time())
+    conn.commit()
+    associations_count = conn.execute("SELECT COUNT(*) FROM associations").fetchone()[0]
+    conn.close()
+    os.replace(tmp_path, path)
+    sync_count.inc()
+    logger.info(f"Edge store synchronized in {path} with {associations_count} associations")
+    return associations_count
+
+
+def sync_edge_store_incremental(path=None, run_sparql_query=None):
+    """Update the edge store with the nanopubs published since the last sync.
+
+    New associations are inserted, and the associations of retracted or superseded nanopubs are deleted.
+    All changes of a sync are applied in a single transaction.
+
+    :param path: Path to the SQLite file, defaults to settings.EDGE_STORE_PATH
+    :param run_sparql_query: Function running a SPARQL query and returning its bindings, defaults to the one
+        of the TRAPI engine
+    :return: Tuple with the number of rows inserted and nanopubs deleted
+    """
+    if run_sparql_query is None:
+        from app.trapi.reasonerapi_parser import run_sparql_query
+
+    path = path or settings.EDGE_STORE_PATH
+    if not os.path.exists(path):
+        sync_edge_store(path, run_sparql_query)
+        return (0, 0)
+    conn = connect(path, read_only=False)
+    try:
+        since = get_state(conn, "latest_created")
+        if not since:
+            conn.close()
+            sync_edge_store(path, run_sparql_query)
+            return (0, 0)
+        until = run_sparql_query(get_latest_created_query)[0]["latest_created"]["value"]
+        # Recorded before the sync, so the lag keeps growing if the sync fails
+        with conn:
+            set_state(conn, "network_latest_created", until)
+        created_filter = f'FILTER (?created > "{since}"^^xsd:dateTime && ?created <= "{until}"^^xsd:dateTime)'
+        invalidated = {
+            row["np_uri"]["value"]
+            for row in run_sparql_query(get_invalidated_nanopubs_query.replace("?_created_filter", created_filter))
+        }
+        new_bindings = [
+            row
+            for bindings in fetch_bindings(run_sparql_query, since, until)
+            for row in bindings
+            if row.get("np_uri", {}).get("value") not in invalidated
+        ]
+        # Apply the whole batch atomically: deletes first, in case a new version reuses an association URI
+        with conn:
+            delete_nanopubs(conn, invalidated)
+            insert_bindings(conn, new_bindings)
+            set_state(conn, "latest_created", until)
+            set_state(conn, "last_sync", time.time())
+    finally:
+        conn.close()
+    sync_count.inc()
+    logger.info(
+        f"Edge store synchronized up to {until}: {len(new_bindings)} rows inserted, {len(invalidated)} nanopubs removed"
+    )
+    return (len(new_bindings), len(invalidated))
+
+
+def parse_created(value):
+    """Parse a xsd:dateTime value of dct:created to a timestamp, naive dates are considered UTC"""
+    value = re.sub(r"Z$", "+00:00", value.strip())
+    # Python < 3.11 only parses fractional seconds of 3 or 6 digits
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), value)
+    created = datetime.fromisoformat(value)
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.timestamp()
+
+
+def get_freshness_lag(path=None):
+    """Number of seconds between the latest nanopub published in the Nanopublication network (as of the last
+    sync attempt) and the latest nanopub synchronized in the edge store, NaN if unknown"""
+    try:
+        conn = connect(path)
+        try:
+            store_latest = get_state(conn, "latest_created")
+            network_latest = get_state(conn, "network_latest_created") or store_latest
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return float("nan")
+    if not store_latest:
+        return float("nan")
+    try:
+        return max(parse_created(network_latest) - parse_created(store_latest), 0.0)
+    except ValueError:
+        return float("nan")
+
+
+gauge(
+    "edge_store_freshness_lag_seconds",
+    "Seconds between the latest nanopub of the Nanopublication network and the latest nanopub in the edge store",
+    callback=get_freshness_lag,
+)
+
+
+def start_sync_thread(interval=None, on_sync=None):
+    """Periodically synchronize the edge store in a background thread.
+
+    A lock file makes sure only one worker process syncs the store at a time.
+
+    :param interval: Seconds between 2 syncs, defaults to settings.EDGE_STORE_SYNC_INTERVAL
+    :param on_sync: Function called after each successful sync, e.g. to rebuild a snapshot of the store
+    """
+    interval = interval or settings.EDGE_STORE_SYNC_INTERVAL
+
+    def sync_loop():
+        while True:
+            try:
+                with open(f"{settings.EDGE_STORE_PATH}.lock", "w") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Another worker is already syncing
+                        pass
+                    else:
+                        # The sync queries wait behind the ones sent for TRAPI queries
+                        with sync_lock, background_priority():
+                            sync_edge_store_incremental()
+                            if on_sync:
+                                on_sync()
+            except Exception as e:
+                logger.error(f"Error while synchronizing the edge store: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=sync_loop, name="edge-store-sync", daemon=True)
+    thread.start()
+    return thread
+
+
+def sql_in(column, values):
+    """Generate a SQL IN clause with its parameters
+
+    The queries built with f-strings only interpolate table and column names, and clauses of ? placeholders
+    generated by this function: the values are always passed as parameters (hence the noqa: S608).
+    """
+    return f"{column} IN ({', '.join('?' * len(values))})", list(values)
+
+
+def select_one_hop(
+    conn,
+    predicates=None,
+    subject_categories=None,
+    object_categories=None,
+    subject_ids=None,
+    object_ids=None,
+    limit=None,
+    offset=0,
+):
+    """Get the associations matching a one-hop query from the edge store.
+
+    All constraints are lists of URIs, a constraint is ignored if None or empty.
+    limit and offset apply to the distinct associations, ordered by URI.
+
+    :return: List of rows in the SPARQL JSON bindings format, as returned by the TRAPI SPARQL templates
+    """
+    association_conditions, association_params = [], []
+    for column, values in (("a.predicate", predicates), ("a.subject", subject_ids), ("a.object", object_ids)):
+        if values:
+            condition, condition_params = sql_in(column, values)
+            association_conditions.append(condition)
+            association_params.extend(condition_params)
+    # Categories are also checked on the returned rows, since nodes can have multiple categories
+    category_conditions, category_params = [], []
+    for column, values in (("sc.category", subject_categories), ("oc.category", object_categories)):
+        if values:
+            condition, condition_params = sql_in(column, values)
+            category_conditions.append(condition)
+            category_params.extend(condition_params)
+
+    conditions = association_conditions + category_conditions
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    category_where = f"AND {' AND '.join(category_conditions)}" if category_conditions else ""
+    limit_clause = f"LIMIT {int(limit) if limit else -1} OFFSET {int(offset or 0)}"
+    rows = conn.execute(
+        f"""SELECT a.association, a.subject, a.predicate, a.object, sc.category, oc.category,
+            a.np_uri, a.label, a.description, a.pubkey
+        FROM associations a
+        JOIN nodes sc ON sc.uri = a.subject
+        JOIN nodes oc ON oc.uri = a.object
+        WHERE a.association IN (
+            SELECT DISTINCT a.association FROM associations a
+            JOIN nodes sc ON sc.uri = a.subject
+            JOIN nodes oc ON oc.uri = a.object
+            {where}
+            ORDER BY a.association {limit_clause}
+        ) {category_where}
+        ORDER BY a.association""",  # noqa: S608
+        association_params + category_params + category_params,
+    ).fetchall()
+
+    bindings = []
+    associations = []
+    for (
+        association, subject, predicate, obj, subject_category, object_category, np_uri, label, description, pubkey
+    ) in rows:
+        row = {
+            "association": uri_binding(association),
+            "subject": uri_binding(subject),
+            "predicate": uri_binding(predicate),
+            "object": uri_binding(obj),
+            "subject_category": uri_binding(subject_category),
+            "object_category": uri_binding(object_category),
+        }
+        if np_uri:
+            row["np_uri"] = uri_binding(np_uri)
+        if pubkey:
+            row["pubkey"] = {"type": "literal", "value": pubkey}
+        if label:
+            row["label"] = {"type": "literal", "value": label}
+        if description:
+            row["description"] = {"type": "literal", "value": description}
+        if not associations or associations[-1] != association:
+            associations.append(association)
+        bindings.append(row)
+
+    # Add one row for each source, attribute and qualifier of the retrieved associations
+    base_rows = {}
+    for row in bindings:
+        if row["association"]["value"] not in base_rows:
+            # Label and description are only kept in the first row of the association
+            base_rows[row["association"]["value"]] = {
+                var: value for var, value in row.items() if var not in ("label", "description")
+            }
+    for association, detail in select_details(conn, associations):
+        bindings.append({**base_rows[association], **detail})
+    return bindings
+
+
+def select_details(conn, associations):
+    """Get the sources, attributes and qualifiers of associations from the edge store
+
+    :param conn: Connection to the edge store
+    :param associations: List of association URIs
+    :return: Iterator of (association URI, partial SPARQL JSON binding) tuples, one for each detail
+    """
+    for start in range(0, len(associations), SQL_BATCH_SIZE):
+        batch = associations[start : start + SQL_BATCH_SIZE]
+        condition, batch_params = sql_in("association", batch)
+        for association, role, resource_id, upstream_id, record_url in conn.execute(
+            f"SELECT association, resource_role, resource_id, upstream_resource_id, source_record_url FROM sources WHERE {condition}",  # noqa: S608
+            batch_params,
+        ):
+            prefix = SOURCE_ROLES[role]
+            detail = {role: uri_binding(resource_id)}
+            if upstream_id:
+                detail[f"{prefix}_upstream_resource_ids"] = uri_binding(upstream_id)
+            if record_url:
+                detail[f"{prefix}_source_record_urls"] = uri_binding(record_url)
+            yield association, detail
+        for association, kind, attribute_type, value, attribute_source in conn.execute(
+            f"SELECT association, kind, attribute_type, value, attribute_source FROM attributes WHERE {condition}",  # noqa: S608
+            batch_params,
+        ):
+            if kind == "attribute":
+                yield association, {
+                    "attribute_type": uri_binding(attribute_type),
+                    "attribute_value": {"type": "literal", "value": value},
+                    "attribute_provider": uri_binding(attribute_source),
+                }
+            else:
+                yield association, {kind: {"type": "literal", "value": value}}
+        for association, qualifier_type, qualifier_value in conn.execute(
+            f"SELECT association, qualifier_type, qualifier_value FROM qualifiers WHERE {condition}",  # noqa: S608
+            batch_params,
+        ):
+            yield association, {
+                "qualifier": uri_binding(qualifier_type),
+                "qualifier_value": uri_binding(qualifier_value),
+            }
+
+if __name__ == "__main__":
+    sync_edge_store()
@@ -0,0 +1,103 @@
+"""Cache the nanopublications included in nanopub indexes, to avoid traversing npx:appendsIndex* in each query
+
+Index nanopubs are immutable: a new version of an index appends the previous one. The members of an index are
+resolved once, then the chain of appended indexes is checked every NP_INDEX_CACHE_TTL seconds, and only the
+members of indexes that were not seen before are retrieved.
+The members of small indexes are sent in the VALUES block of the queries, the ones of larger indexes are checked
+on the rows returned instead (see get_index_constraint), so the queries stay small.
+"""
+import threading
+import time
+
+from app.config import settings
+from app.metrics import counter
+from app.trapi.sparql_builder import QueryTemplate, sparql_iri
+
+get_appended_indexes_query = QueryTemplate(
+    """PREFIX npx: <http://purl.org/nanopub/x/>
+SELECT DISTINCT ?index WHERE {
+  graph ?indexAssertionGraph {
+    ?_index npx:appendsIndex* ?index .
+  }
+}"""
+)
+
+get_index_elements_query = QueryTemplate(
+    """PREFIX npx: <http://purl.org/nanopub/x/>
+SELECT DISTINCT ?np WHERE {
+  VALUES ?index { ?_indexes }
+  graph ?indexAssertionGraph {
+    ?index npx:includesElement ?np .
+  }
+}"""
+)
+
+# Number of indexes whose elements are retrieved by each query
+INDEX_BATCH_SIZE = 100
+
+cache_hits = counter("np_index_cache_hits_total", "Number of nanopub index members served from the cache")
+cache_refreshes = counter(
+    "np_index_cache_refreshes_total", "Number of nanopub index members resolutions against the SPARQL endpoint"
+)
+
+
+class IndexMembers:
+    """Nanopubs included in an index and the indexes it appends"""
+
+    __slots__ = ("indexes", "members", "checked_at", "lock")
+
+    def __init__(self):
+        self.indexes = set()
+        self.members = frozenset()
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+
+index_cache = {}
+index_cache_lock = threading.Lock()
+
+
+def get_index_members(index_uri, run_sparql_query):
+    """Get the URIs of the nanopubs included in an index, or in the indexes it appends
+
+    :param index_uri: URI of the nanopub index
+    :param run_sparql_query: Function running a SPARQL query and returning its bindings
+    :return: Frozen set of nanopub URIs
+    """
+    with index_cache_lock:
+        entry = index_cache.setdefault(index_uri, IndexMembers())
+    # Concurrent requests for the same index wait for a single resolution
+    with entry.lock:
+        if entry.checked_at is not None and time.monotonic() - entry.checked_at < settings.NP_INDEX_CACHE_TTL:
+            cache_hits.inc()
+            return entry.members
+
+        bindings = run_sparql_query(get_appended_indexes_query.render(index=sparql_iri(index_uri)))
+        indexes = {row["index"]["value"] for row in bindings} | {index_uri}
+        new_indexes = sorted(indexes - entry.indexes)
+        if new_indexes:
+            cache_refreshes.inc()
+            members = set(entry.members)
+            for start in range(0, len(new_indexes), INDEX_BATCH_SIZE):
+                batch = new_indexes[start : start + INDEX_BATCH_SIZE]
+                query = get_index_elements_query.render(indexes=" ".join(sparql_iri(uri) for uri in batch))
+                members.update(row["np"]["value"] for row in run_sparql_query(query))
+            entry.members = frozenset(members)
+            entry.indexes = indexes
+        entry.checked_at = time.monotonic()
+        return entry.members
+
+
+def get_index_constraint(index_uri, run_sparql_query):
+    """Get how the nanopubs retrieved by a query are restricted to the members of an index
+
+    Indexes with at most settings.TRAPI_ID_CHUNK_SIZE members are sent in the queries, the rows of the queries
+    for larger indexes are filtered client-side, like the rows of retracted nanopubs.
+
+    :return: Tuple with the sorted list of members to send in the queries (None if checked on the rows),
+        and the set of members to check on the rows (None if sent in the queries)
+    """
+    members = get_index_members(index_uri, run_sparql_query)
+    if len(members) <= settings.TRAPI_ID_CHUNK_SIZE:
+        return sorted(members), None
+    return None, members
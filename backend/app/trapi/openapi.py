@@ -156,9 +156,11 @@ This service is supported by the [NIH NCATS Biomedical Data Translator project](
         }
         openapi_schema["info"]["x-trapi"] = {
             "version": settings.TRAPI_VERSION,
-            "asyncquery": False,
+            "asyncquery": True,
             "operations": [
                 "lookup",
+                "filter_results_top_n",
+                "filter_kgraph_orphans",
             ],
             "externalDocs": {
                 "description": "The values for version are restricted according to the regex in this external JSON schema. See schema and examples at url",
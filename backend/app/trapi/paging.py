@@ -0,0 +1,45 @@
+"""Pages of the results of one-hop queries, resumed with a cursor
+
+n_results is pushed down in the queries: each source (SPARQL template and chunk of ids, or local store) returns a
+window of at most n_results distinct associations from its offset. The cursor of the next page holds the offset
+of each source, past the associations consumed by the page.
+"""
+import base64
+import json
+
+
+def encode_cursor(offsets):
+    """Encode the offsets of the next page of results in an opaque cursor string"""
+    return base64.urlsafe_b64encode(json.dumps({"offsets": offsets}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode the offsets of a page of results from a cursor string"""
+    try:
+        offsets = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offsets"]
+        return [int(offset) for offset in offsets]
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def get_next_offsets(offsets, source_associations, dropped_counts, consumed_associations, n_results, truncated):
+    """Compute where the next page of each source starts
+
+    :param offsets: Offset of the page of each source
+    :param source_associations: Associations returned by each source, and kept
+    :param dropped_counts: Number of associations returned by each source but filtered out client-side, or None
+    :param consumed_associations: Associations added to the knowledge graph, or rejected by the constraints
+    :param n_results: Maximum number of associations returned by each source
+    :param truncated: Some sources were cancelled by the deadline
+    :return: Offsets of the next page of each source, None if there are no more results
+    """
+    next_offsets = []
+    has_more = False
+    for i, (offset, returned) in enumerate(zip(offsets, source_associations)):
+        dropped = dropped_counts[i] if dropped_counts else 0
+        consumed = len([association for association in returned if association in consumed_associations])
+        next_offsets.append(offset + consumed + dropped)
+        # A full window, or associations left out of the page (beyond n_results)
+        has_more = has_more or len(returned) + dropped >= n_results or consumed < len(returned)
+    # Sources cancelled by the deadline returned nothing, the next page resumes them
+    return next_offsets if has_more or truncated else None
@@ -0,0 +1,227 @@
+"""Plan and execute multi-hop TRAPI query graphs as a sequence of one-hop queries.
+
+The query graph is decomposed in one-hop sub-queries (one per edge), ordered by their estimated selectivity,
+the ids bound by a hop are passed to the next hops, and the answers of all hops are joined in memory.
+The hops are joined on the CURIEs of their results, and the next hops are pinned on the URIs these CURIEs were
+resolved from (when a hop returns them), as resolving a CURIE back does not always give the URI in the nanopubs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_selectivity(query_graph, edge_id, bound_counts):
+    """Estimate how selective a one-hop query is, lower is more selective
+
+    :param query_graph: TRAPI query graph
+    :param edge_id: ID of the query graph edge
+    :param bound_counts: Number of CURIEs known for each bound query node
+    :return: Tuple that can be used to sort edges, from the most to the least selective
+    """
+    edge = query_graph["edges"][edge_id]
+    ids_count = [
+        bound_counts[node_id]
+        for node_id in (edge["subject"], edge["object"])
+        if node_id in bound_counts
+    ]
+    # Edges with both ends pinned first, then one end pinned (fewer ids first), then unconstrained edges
+    return (2 - len(ids_count), min(ids_count) if ids_count else 0, edge_id)
+
+
+def plan_query_graph(query_graph):
+    """Order the edges of a query graph in waves of one-hop queries.
+
+    The edges in a wave are independent from each other and can be executed concurrently,
+    each wave uses the ids bound by the previous waves.
+
+    :param query_graph: TRAPI query graph
+    :return: List of waves, each wave is a list of edge IDs
+    """
+    # Pinned ids are known upfront, ids bound by a previous wave are unknown until execution
+    bound_counts = {
+        node_id: len(node["ids"]) for node_id, node in query_graph["nodes"].items() if node.get("ids")
+    }
+    remaining = set(query_graph["edges"].keys())
+    waves = []
+    while remaining:
+        wave = [
+            edge_id
+            for edge_id in remaining
+            if query_graph["edges"][edge_id]["subject"] in bound_counts
+            or query_graph["edges"][edge_id]["object"] in bound_counts
+        ]
+        if not wave:
+            # Nothing is pinned: start from a single edge, the next ones will use its ids
+            wave = [min(remaining, key=lambda edge_id: estimate_selectivity(query_graph, edge_id, bound_counts))]
+        wave.sort(key=lambda edge_id: estimate_selectivity(query_graph, edge_id, bound_counts))
+        for edge_id in wave:
+            for node_id in (query_graph["edges"][edge_id]["subject"], query_graph["edges"][edge_id]["object"]):
+                bound_counts.setdefault(node_id, float("inf"))
+        remaining.difference_update(wave)
+        waves.append(wave)
+    return waves
+
+
+def get_hop_graph(query_graph, edge_id, bound_ids, node_uris=None):
+    """Build the one-hop query graph for an edge, with the ids bound by previous hops pinned on its nodes
+
+    :param node_uris: URIs of the CURIEs returned by the previous hops, pinned instead of the CURIEs
+    """
+    node_uris = node_uris or {}
+    edge = query_graph["edges"][edge_id]
+    hop_nodes = {}
+    for node_id in (edge["subject"], edge["object"]):
+        hop_nodes[node_id] = dict(query_graph["nodes"][node_id])
+        if node_id in bound_ids:
+            hop_nodes[node_id]["ids"] = sorted(
+                {uri for curie in bound_ids[node_id] for uri in node_uris.get(curie, [curie])}
+            )
+    return {"nodes": hop_nodes, "edges": {edge_id: edge}}
+
+
+def chunk_one_hop_graph(query_graph, edge_id, chunk_size):
+    """Split the largest list of ids pinned on the nodes of an edge in chunks of at most chunk_size ids
+
+    :return: List of one-hop query graphs, one for each chunk (just the query graph if no split is needed)
+    """
+    edge_props = query_graph["edges"][edge_id]
+    node_id = max(
+        (edge_props["subject"], edge_props["object"]),
+        key=lambda node_id: len(query_graph["nodes"][node_id].get("ids") or []),
+    )
+    ids = query_graph["nodes"][node_id].get("ids") or []
+    if len(ids) <= chunk_size:
+        return [query_graph]
+    hop_graphs = []
+    for start in range(0, len(ids), chunk_size):
+        chunk_node = {**query_graph["nodes"][node_id], "ids": ids[start : start + chunk_size]}
+        hop_graphs.append({"nodes": {**query_graph["nodes"], node_id: chunk_node}, "edges": query_graph["edges"]})
+    return hop_graphs
+
+
+def get_hop_rows(hop_answer, query_graph, edge_id):
+    """Extract (subject ID, object ID, knowledge graph edge ID) rows from the results of a one-hop query"""
+    edge = query_graph["edges"][edge_id]
+    rows = []
+    for result in hop_answer["results"]:
+        subject_ids = [binding["id"] for binding in result["node_bindings"][edge["subject"]]]
+        object_ids = [binding["id"] for binding in result["node_bindings"][edge["object"]]]
+        for analysis in result["analyses"]:
+            for edge_binding in analysis["edge_bindings"].get(edge_id, []):
+                for subject_id in subject_ids:
+                    for object_id in object_ids:
+                        rows.append((subject_id, object_id, edge_binding["id"]))
+    return rows
+
+
+def join_hop_rows(query_graph, plan, hop_rows):
+    """Join the rows returned by each hop on their shared query nodes
+
+    :return: List of solutions, each solution is a tuple (node bindings dict, edge bindings dict)
+    """
+    solutions = [({}, {})]
+    joined_nodes = set()
+    for edge_id in [edge_id for wave in plan for edge_id in wave]:
+        edge = query_graph["edges"][edge_id]
+        # Hash join: index the rows of this hop by the query nodes already bound in the partial solutions
+        join_on = [
+            position for position, node_id in enumerate((edge["subject"], edge["object"])) if node_id in joined_nodes
+        ]
+        index = {}
+        for subject_id, object_id, kg_edge_id in hop_rows[edge_id]:
+            node_pair = (subject_id, object_id)
+            join_key = tuple(node_pair[position] for position in join_on)
+            index.setdefault(join_key, {}).setdefault(node_pair, []).append(kg_edge_id)
+        joined = []
+        for nodes, edges in solutions:
+            join_key = tuple(nodes[(edge["subject"], edge["object"])[position]] for position in join_on)
+            for (subject_id, object_id), kg_edge_ids in index.get(join_key, {}).items():
+                new_nodes = {**nodes, edge["subject"]: subject_id, edge["object"]: object_id}
+                joined.append((new_nodes, {**edges, edge_id: kg_edge_ids}))
+        solutions = joined
+        joined_nodes.update((edge["subject"], edge["object"]))
+        if not solutions:
+            break
+    return solutions
+
+
+def execute_query_graph(query_graph, run_hop, n_results=None, max_workers=4):
+    """Execute a multi-hop TRAPI query graph by decomposing it in one-hop queries
+
+    :param query_graph: TRAPI query graph
+    :param run_hop: Function taking a one-hop query graph and the ID of its edge, and returning a dict with the
+        TRAPI knowledge_graph and results (and optionally logs, and node_uris the URIs of the nodes by CURIE)
+        for this edge
+    :param n_results: Maximum number of results to return, no limit if None
+    :param max_workers: Maximum number of one-hop queries running concurrently
+    :return: Dict with the TRAPI knowledge_graph, results and logs for the whole query graph,
+        and truncated, True if results were left out because of n_results
+    """
+    plan = plan_query_graph(query_graph)
+    bound_ids = {
+        node_id: set(node["ids"]) for node_id, node in query_graph["nodes"].items() if node.get("ids")
+    }
+    hop_kg = {"nodes": {}, "edges": {}}
+    hop_rows = {}
+    node_uris = {}
+    logs = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for wave in plan:
+            futures = {
+                edge_id: executor.submit(run_hop, get_hop_graph(query_graph, edge_id, bound_ids, node_uris), edge_id)
+                for edge_id in wave
+            }
+            for edge_id, future in futures.items():
+                hop_answer = future.result()
+                hop_kg["nodes"].update(hop_answer["knowledge_graph"]["nodes"])
+                hop_kg["edges"].update(hop_answer["knowledge_graph"]["edges"])
+                hop_rows[edge_id] = get_hop_rows(hop_answer, query_graph, edge_id)
+                logs.extend(hop_answer.get("logs", []))
+                for curie, uris in hop_answer.get("node_uris", {}).items():
+                    node_uris.setdefault(curie, {}).update(dict.fromkeys(uris))
+
+            # Bind the nodes touched by this wave to the ids actually found (resolved as returned in the KG)
+            wave_ids = {}
+            for edge_id in wave:
+                edge = query_graph["edges"][edge_id]
+                for position, node_id in enumerate((edge["subject"], edge["object"])):
+                    found_ids = {row[position] for row in hop_rows[edge_id]}
+                    wave_ids[node_id] = wave_ids[node_id] & found_ids if node_id in wave_ids else found_ids
+            bound_ids.update(wave_ids)
+            if any(not ids for ids in wave_ids.values()):
+                # All edges are required: an empty hop, or hops binding disjoint ids on a shared node, means no
+                # results (pinning no ids on the next hops would leave them unconstrained)
+                return {"knowledge_graph": {"nodes": {}, "edges": {}}, "results": [], "logs": logs, "truncated": False}
+
+    # Merge solutions sharing the same node bindings, and keep only the KG elements used by the results
+    results = {}
+    truncated = False
+    for nodes, edges in join_hop_rows(query_graph, plan, hop_rows):
+        key = tuple(sorted(nodes.items()))
+        if key not in results:
+            if n_results is not None and len(results) >= n_results:
+                truncated = True
+                continue
+            results[key] = (nodes, {})
+        for edge_id, kg_edge_ids in edges.items():
+            edge_bindings = results[key][1].setdefault(edge_id, [])
+            edge_bindings.extend(kg_edge_id for kg_edge_id in kg_edge_ids if kg_edge_id not in edge_bindings)
+
+    kg = {"nodes": {}, "edges": {}}
+    trapi_results = []
+    for nodes, edges in results.values():
+        for kg_edge_ids in edges.values():
+            for kg_edge_id in kg_edge_ids:
+                kg["edges"][kg_edge_id] = hop_kg["edges"][kg_edge_id]
+        for node_id in nodes.values():
+            kg["nodes"][node_id] = hop_kg["nodes"].get(node_id, {"categories": []})
+        trapi_results.append({
+            "node_bindings": {node_id: [{"id": curie}] for node_id, curie in nodes.items()},
+            "analyses": [{
+                "resource_id": "infores:knowledge-collaboratory",
+                "edge_bindings": {
+                    edge_id: [{"id": kg_edge_id} for kg_edge_id in kg_edge_ids]
+                    for edge_id, kg_edge_ids in edges.items()
+                },
+            }],
+        })
+    return {"knowledge_graph": kg, "results": trapi_results, "logs": logs, "truncated": truncated}
@@ -0,0 +1,77 @@
+"""Projection of the edge properties returned by a TRAPI query, to shrink the responses
+
+Clients list the attribute types they need in query_options.attributes (e.g. ["biolink:publications"], or []
+for none), and can set query_options.qualifiers to false. The OPTIONAL blocks of the SPARQL queries retrieving
+the other properties are dropped, and the edge assembler ignores them (e.g. in the rows of the edge store).
+The knowledge sources are always returned, as they are required by TRAPI.
+"""
+from app.trapi.edge_assembler import ROW_ATTRIBUTES
+
+# Value of the properties provided by an OPTIONAL block retrieving the qualifiers of the edges
+QUALIFIERS = "qualifiers"
+# Attribute types retrieved by a dedicated SPARQL variable, or added from the nanopub signature (author)
+ROW_ATTRIBUTE_TYPES = frozenset(attribute_type_id for _var, attribute_type_id in ROW_ATTRIBUTES) | {"biolink:author"}
+
+
+class Projection:
+    """Edge properties to retrieve and return
+
+    :param attribute_types: Attribute type IDs to return, None for all
+    :param qualifiers: Return the qualifiers of the edges
+    """
+
+    __slots__ = ("attribute_types", "qualifiers")
+
+    def __init__(self, attribute_types=None, qualifiers=True):
+        self.attribute_types = None if attribute_types is None else frozenset(attribute_types)
+        self.qualifiers = qualifiers
+
+    @classmethod
+    def from_query_options(cls, query_options):
+        """Get the projection defined by the attributes and qualifiers of the TRAPI query_options
+
+        :return: The projection, None if all the properties are returned
+        :raise ValueError: if the options are invalid
+        """
+        attribute_types = query_options.get("attributes")
+        qualifiers = query_options.get("qualifiers", True)
+        if attribute_types is not None and (
+            not isinstance(attribute_types, list) or not all(isinstance(t, str) for t in attribute_types)
+        ):
+            raise ValueError("The attributes query option should be a list of attribute type IDs")
+        if not isinstance(qualifiers, bool):
+            raise ValueError("The qualifiers query option should be a boolean")
+        if attribute_types is None and qualifiers:
+            return None
+        return cls(attribute_types, qualifiers)
+
+    def including(self, attribute_types=(), qualifiers=False):
+        """Get the projection also retrieving some attribute types, and the qualifiers if needed"""
+        return Projection(
+            None if self.attribute_types is None else self.attribute_types | frozenset(attribute_types),
+            self.qualifiers or qualifiers,
+        )
+
+    def apply(self, edge):
+        """Remove the properties which are not projected from a TRAPI edge"""
+        edge["attributes"] = [
+            attribute for attribute in edge["attributes"] if self.keeps_attribute(attribute["attribute_type_id"])
+        ]
+        if not self.qualifiers:
+            edge["qualifiers"] = []
+
+    def keeps_attribute(self, attribute_type_id):
+        return self.attribute_types is None or attribute_type_id in self.attribute_types
+
+    def keeps(self, provides):
+        """Check if an OPTIONAL block of a SPARQL query is needed
+
+        :param provides: Properties retrieved by the block: QUALIFIERS, a tuple of attribute type IDs,
+            or None for the attributes of any type (biolink:has_attribute)
+        """
+        if provides == QUALIFIERS:
+            return self.qualifiers
+        if provides is None:
+            # Needed unless only the attribute types with a dedicated variable are requested
+            return self.attribute_types is None or not self.attribute_types <= ROW_ATTRIBUTE_TYPES
+        return any(self.keeps_attribute(attribute_type_id) for attribute_type_id in provides)
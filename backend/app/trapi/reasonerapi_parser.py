@@ -1,165 +1,42 @@
 import json
+import threading
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from queue import Empty, Full, Queue
 
 import requests
-from app.config import settings
-from SPARQLWrapper import JSON, SPARQLWrapper
-
-KNOWLEDGE_PROVIDER = "https://w3id.org/biolink/infores/knowledge-collaboratory"
-
-
-# Query to get nanopublications that uses the older BioLink model (NeuroDKG)
-select_np_query_old = (
-    """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX biolink: <https://w3id.org/biolink/vocab/>
-PREFIX infores: <https://w3id.org/biolink/infores/>
-PREFIX np: <http://www.nanopub.org/nschema#>
-PREFIX npx: <http://purl.org/nanopub/x/>
-PREFIX npa: <http://purl.org/nanopub/admin/>
-SELECT DISTINCT ?association ?subject ?predicate ?object ?subject_category ?object_category
-    ?primary_knowledge_source ?provided_by ?publications
-    ?label ?description ?population_has_phenotype ?has_population_context
-WHERE {
-  graph ?np_assertion {
-    ?association
-      biolink:aggregator_knowledge_source <"""
-    + KNOWLEDGE_PROVIDER
-    + """> ;
-      rdf:subject ?subject ;
-      rdf:predicate ?predicate ;
-      rdf:object ?object .
-    OPTIONAL {
-      ?association biolink:primary_knowledge_source ?primary_knowledge_source .
-    }
-    OPTIONAL {
-      ?association biolink:provided_by ?provided_by .
-    }
-    OPTIONAL {
-      ?association biolink:publications ?publications .
-    }
-    OPTIONAL {
-      ?association rdfs:label ?label .
-    }
-    OPTIONAL {
-      ?association biolink:description ?description .
-    }
-    OPTIONAL {
-      ?association biolink:has_population_context|biolink:population_context_qualifier [
-        rdfs:label ?has_population_context ;
-        biolink:has_phenotype ?population_has_phenotype ;
-      ] .
-    }
-    {
-      ?subject a ?subject_category .
-      ?object a ?object_category .
-    } UNION {
-      ?subject biolink:category ?subject_category .
-      ?object biolink:category ?object_category .
-    }
-  }
-  ?_entity_filters
-  ?_prov_block
-  ?_np_index_filter
-  graph ?np_head {
-    ?np_uri np:hasAssertion ?np_assertion ;
-      np:hasProvenance ?np_prov .
-  }
-  graph npa:graph {
-    ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
-  }
-  FILTER NOT EXISTS { ?creator npx:retracts ?np_uri }
-}"""
-)
-
-select_np_query = (
-    """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX biolink: <https://w3id.org/biolink/vocab/>
-PREFIX infores: <https://w3id.org/biolink/infores/>
-PREFIX np: <http://www.nanopub.org/nschema#>
-PREFIX npx: <http://purl.org/nanopub/x/>
-PREFIX npa: <http://purl.org/nanopub/admin/>
-SELECT DISTINCT ?association ?subject ?predicate ?object ?subject_category ?object_category
-    ?primary_knowledge_source ?primary_upstream_resource_ids ?primary_source_record_urls
-    ?supporting_data_source ?supporting_upstream_resource_ids ?supporting_source_record_urls
-    ?attribute_type ?attribute_provider ?attribute_value
-    ?qualifier ?qualifier_value
-    ?label ?description ?population_has_phenotype ?has_population_context ?provided_by ?publications
-WHERE {
-  graph ?np_assertion {
-    ?association biolink:subject ?subject ;
-      biolink:predicate ?predicate ;
-      biolink:object ?object .
-    OPTIONAL {
-      ?association biolink:primary_knowledge_source ?pks .
-      ?pks biolink:resource_id ?primary_knowledge_source .
-      OPTIONAL { ?pks biolink:upstream_resource_ids ?primary_upstream_resource_ids . }
-      OPTIONAL { ?pks biolink:source_record_urls ?primary_source_record_urls . }
-    }
-    OPTIONAL {
-      ?association biolink:supporting_data_source ?sks .
-      ?sds biolink:resource_id ?supporting_data_source .
-      OPTIONAL { ?sds biolink:upstream_resource_ids ?supporting_upstream_resource_ids . }
-      OPTIONAL { ?sds biolink:source_record_urls ?supporting_source_record_urls . }
-    }
-    OPTIONAL {
-      ?association biolink:has_attribute [
-        biolink:has_attribute_type ?attribute_type ;
-        biolink:provided_by ?attribute_provider ;
-        biolink:value ?attribute_value
-      ]
-    }
-    OPTIONAL {
-      ?association biolink:publications ?publications .
-    }
-    OPTIONAL {
-      ?association biolink:provided_by ?provided_by .
-    }
-    OPTIONAL {
-      ?association biolink:publications ?publications .
-    }
-    OPTIONAL {
-      ?association biolink:name ?label .
-    }
-    OPTIONAL {
-      ?association biolink:description ?description .
-    }
-    OPTIONAL {
-      ?association biolink:has_population_context|biolink:population_context_qualifier [
-        rdfs:label ?has_population_context ;
-        biolink:has_phenotype ?population_has_phenotype ;
-      ] .
-    }
-    {
-      ?subject a ?subject_category .
-      ?object a ?object_category .
-    } UNION {
-      ?subject biolink:category ?subject_category .
-      ?object biolink:category ?object_category .
-    }
-    VALUES ?qualifier {
-        biolink:qualified_predicate biolink:subject_aspect_qualifier biolink:object_aspect_qualifier biolink:subject_direction_qualifier biolink:object_direction_qualifier
-        biolink:subject_part_qualifier biolink:object_part_qualifier biolink:subject_context_qualifier biolink:subject_part_qualifier biolink:object_part_qualifier biolink:object_context_qualifier
-        biolink:population_context_qualifier biolink:temporal_context_qualifier biolink:form_or_variant_qualifier
-        biolink:derivative_qualifier biolink:statement_qualifier
-        biolink:frequency_qualifier biolink:severity_qualifier biolink:sex_qualifier biolink:onset_qualifier
-    }
-    OPTIONAL { ?association ?qualifier ?qualifier_value . }
-  }
-  ?_entity_filters
-  ?_prov_block
-  ?_np_index_filter
-  graph ?np_head {
-    ?np_uri np:hasAssertion ?np_assertion ;
-      np:hasProvenance ?np_prov .
-  }
-  graph npa:graph {
-    ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
-  }
-  FILTER NOT EXISTS { ?creator npx:retracts ?np_uri }
-}"""
+from app.circuit_breaker import CircuitBreaker, StaleCache
+from app.config import logger, settings
+from app.deadline import POLL_INTERVAL, Deadline
+from app.governor import background_priority, call_with_priority, current_priority, get_governor
+from app.singleflight import coalesce
+from app.trapi import edge_store
+from app.trapi.biolink_closure import expand_biolink_uris
+from app.trapi.constraints import EdgeConstraints, filter_edges, sparql_constraint_filters
+from app.trapi.csr_snapshot import open_snapshot
+from app.trapi.details import build_details_queries, merge_detail_rows
+from app.trapi.edge_assembler import EdgeAssembler
+from app.trapi.np_index import get_index_constraint
+from app.trapi.paging import decode_cursor, encode_cursor, get_next_offsets
+from app.trapi.planner import chunk_one_hop_graph, execute_query_graph
+from app.trapi.projection import Projection
+from app.trapi.retractions import invalidated_nanopubs
+from app.trapi.sparql_client import QueryCancelledError, get_sparql_client
+from app.trapi.sparql_templates import one_hop_core_templates, one_hop_templates, retraction_filter_block
+from app.trapi.workflow import filter_kgraph_orphans, parse_workflow
+
+# Maximum number of streamed rows waiting to be assembled, the queries are paused when it is reached
+STREAM_QUEUE_SIZE = 1000
+# Results with more rows than this are not kept to be served stale, to bound the memory used by the cache
+STALE_CACHE_MAX_ROWS = 5000
+
+# Last good results of the TRAPI and meta-KG SPARQL queries, served when the endpoints fail
+sparql_stale_cache = StaleCache(
+    settings.STALE_CACHE_SIZE, ignored_exceptions=(QueryCancelledError,), max_size=STALE_CACHE_MAX_ROWS
 )
+grlc_breaker = CircuitBreaker("grlc")
+np_users_stale_cache = StaleCache(1)
 
 get_metakg_edges_query = (
     """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -304,11 +181,7 @@ def get_predicates_from_nanopubs():
     # TODO: Update to the meta_knowledge_graph for TRAPI 3.1.0
     predicates = {}
     # Run query to get types and relations between them
-    sparql = SPARQLWrapper(settings.NANOPUB_SPARQL_URL)
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(get_metakg_edges_query)
-    sparqlwrapper_results = sparql.query().convert()
-    sparql_results = sparqlwrapper_results["results"]["bindings"]
+    sparql_results = run_sparql_query(get_metakg_edges_query)
     for result in sparql_results:
         np_subject = resolve_uri(result["subject_category"]["value"])
         np_predicate = resolve_uri(result["predicate_category"]["value"])
@@ -324,17 +197,17 @@ def get_predicates_from_nanopubs():
     return predicates
 
 
+@coalesce
 def get_metakg_from_nanopubs():
     """Query the Nanopublications network to get BioLink entity categories and the relation between them
     Formatted for the Translator TRAPI /predicate get call
     """
     # TODO: Update to the meta_knowledge_graph for TRAPI 3.1.0
-    # Run query to get types and relations between them
-    sparql = SPARQLWrapper(settings.NANOPUB_SPARQL_URL)
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(get_metakg_edges_query)
-    sparqlwrapper_results = sparql.query().convert()
-    sparql_results = sparqlwrapper_results["results"]["bindings"]
+    # Run query to get types and relations between them, it should not slow down the queries sent for TRAPI queries
+    with background_priority():
+        sparql_results, edges_age = sparql_stale_cache.call(
+            get_metakg_edges_query, run_sparql_query, get_metakg_edges_query
+        )
     if settings.DEV_MODE:
         print(get_metakg_edges_query)
         print(sparql_results)
@@ -353,9 +226,11 @@ def get_metakg_from_nanopubs():
         )
 
     # print(get_metakg_prefixes_query)
-    sparql.setQuery(get_metakg_prefixes_query)
-    sparqlwrapper_results = sparql.query().convert()
-    prefixes_results = sparqlwrapper_results["results"]["bindings"]
+    prefixes_results, prefixes_age = sparql_stale_cache.call(
+        get_metakg_prefixes_query, run_sparql_query, get_metakg_prefixes_query
+    )
+    if edges_age is not None or prefixes_age is not None:
+        logger.warning("The SPARQL endpoints are failing, serving a cached meta knowledge graph")
     nodes_obj = {}
     for result in prefixes_results:
         node_category = resolve_uri(result["node_category"]["value"])
@@ -369,12 +244,15 @@ def get_metakg_from_nanopubs():
     return {"edges": edges_array, "nodes": nodes_obj}
 
 
-def get_np_users():
+def get_np_users(deadline=None):
+    """Get the nanopub users indexed by their public key, from the grlc API (through its governor and breaker)"""
     pubkeys = {}
     headers = {"Accept": "application/json"}
-    res = requests.get(
-        f"{settings.NANOPUB_GRLC_URL}/get_all_users", headers=headers
-    ).json()
+    with get_governor(settings.NANOPUB_GRLC_URL).slot(deadline=deadline):
+        timeout = deadline.timeout(settings.GRLC_TIMEOUT) if deadline else settings.GRLC_TIMEOUT
+        res = grlc_breaker.call(
+            requests.get, f"{settings.NANOPUB_GRLC_URL}/get_all_users", headers=headers, timeout=timeout
+        ).json()
     for user in res["results"]["bindings"]:
         # print(user)
         # Remove bad ORCID URLs
@@ -387,392 +265,687 @@ def get_np_users():
     return pubkeys
 
 
-def reasonerapi_to_sparql(reasoner_query):
-    """Convert an array of predictions objects to ReasonerAPI format
-    Run the get_predict to get the QueryGraph edges and nodes
-    {disease: OMIM:1567, drug: DRUGBANK:DB0001, score: 0.9}
-
-    :param: reasoner_query Query from Reasoner API
-    :return: Results as ReasonerAPI object
+def build_one_hop_queries(
+    query_graph, edge_id, in_index=None, limit=None, offsets=None, templates=None, projection=None
+):
+    """Generate the SPARQL queries to retrieve the associations matching one edge of a TRAPI query graph
+
+    :param query_graph: TRAPI query graph
+    :param edge_id: ID of the query graph edge to translate
+    :param in_index: URI of a nanopub index the associations should be part of
+    :param limit: Maximum number of distinct associations retrieved by each query
+    :param offsets: Number of associations to skip for each query, to get the next pages
+    :param templates: One-hop templates to render, one_hop_templates by default
+    :param projection: Projection of the edge properties, the OPTIONAL blocks it does not need are dropped
+    :return: List of SPARQL queries, one for each template
+    :raise ValueError: if the qualifier or attribute constraints of the edge are invalid
     """
-    np_users = get_np_users()
-    # print(np_users)
-    query_graph = reasoner_query["message"]["query_graph"]
-    query_options = {}
-    n_results = None
-    in_index = None
-    if "query_options" in reasoner_query:
-        query_options = reasoner_query["query_options"]
-        if "n_results" in query_options:
-            n_results = int(query_options["n_results"])
-        if "in_index" in query_options:
-            in_index = str(query_options["in_index"])
-
-    if len(query_graph["edges"]) != 1:
-        return {
-            "error": len(query_graph["edges"])
-            + """ edges have been provided.
-            This API currently only implements 1 hop queries (with 1 edge query_graph).
-            Contact us if you are interested in running multiple hop queries"""
-        }
-
-    sparql_queries = [
-        select_np_query_old,
-        select_np_query,
-    ]
-    predicate_edge_id = ""
-    subject_node_id = ""
-    object_node_id = ""
+    templates = templates or one_hop_templates
+    limit = limit or settings.TRAPI_MAX_RESULTS
+    offsets = offsets or [0] * len(templates)
     prov_block = ""
     np_index_block = ""
-    transformed_queries = []
-
-    for query_template in sparql_queries:
-        if in_index == "infores:knowledge-collaboratory":
-            # TODO: filter just on nanopubs created via annotate tool, maybe use prov?
-            # knowledge_source_block = f"biolink:primary_knowledge_source <{KNOWLEDGE_PROVIDER}> ;"
-            prov_block = """graph ?np_prov {
+    if in_index == "infores:knowledge-collaboratory":
+        # TODO: filter just on nanopubs created via annotate tool, maybe use prov?
+        # knowledge_source_block = f"biolink:primary_knowledge_source <{KNOWLEDGE_PROVIDER}> ;"
+        prov_block = """graph ?np_prov {
             ?np_assertion prov:wasQuotedFrom ?wasQuotedFrom .
         }"""
-        elif in_index:
-            np_index_block = f"""graph ?indexAssertionGraph {{
-                {{
-                    <{in_index}> npx:appendsIndex* ?index .
-                    ?index npx:includesElement ?np .
-                }} UNION {{
-                    <{in_index}> npx:includesElement ?np .
-                }}
-            }}"""
-
-        query = query_template.replace(
-            "?_np_index_filter", np_index_block
+
+    # Resolve provided CURIEs to the BioLink context and https://identifiers.org/CURIE:ID
+    constraints = get_one_hop_constraints(query_graph, edge_id)
+    values = {}
+    if in_index and in_index != "infores:knowledge-collaboratory":
+        # The nanopubs of the index are resolved once and cached, instead of traversing the index in each query.
+        # The members of large indexes are checked on the rows by query_one_hop
+        index_values, _index_members = get_index_constraint(in_index, run_sparql_query)
+        if index_values is not None:
+            values["np_uri"] = index_values
+            if not index_values:
+                np_index_block = "FILTER(false)"
+    values.update({
+        "predicate": constraints["predicates"],
+        "subject": constraints["subject_ids"],
+        "object": constraints["object_ids"],
+        "subject_category": constraints["subject_categories"],
+        "object_category": constraints["object_categories"],
+    })
+    # Retracted nanopubs are filtered client-side once their set is loaded
+    retraction_filter = "" if invalidated_nanopubs.loaded else retraction_filter_block
+    # The constraints which can be expressed in SPARQL filter the window of associations, the others are checked
+    # by query_one_hop. The first template queries the older BioLink model, without qualifiers nor has_attribute
+    edge_constraints = EdgeConstraints.from_query_edge(query_graph["edges"][edge_id])
+    pushed, _checked = edge_constraints.split()
+    return [
+        template.render(
+            values,
+            limit,
+            offset,
+            projection,
+            prov_block=prov_block,
+            np_index_filter=np_index_block,
+            retraction_filter=retraction_filter,
+            constraint_filters=sparql_constraint_filters(edge_constraints, pushed, resolve_curie, old_model=i == 0)
+            if edge_constraints
+            else "",
         )
-        query = query.replace(
-            "?_prov_block", prov_block
+        for i, (template, offset) in enumerate(zip(templates, offsets))
+    ]
+
+
+def is_excluded(np_uri, index_members=None):
+    """Check if the rows of a nanopub are filtered out client-side: the nanopub was retracted or superseded,
+    or it is not a member of the index of the query (when the members are checked on the rows)"""
+    if invalidated_nanopubs.loaded and np_uri in invalidated_nanopubs:
+        return True
+    return index_members is not None and np_uri not in index_members
+
+
+def filter_excluded_rows(source_results, index_members=None):
+    """Remove the rows of the nanopubs filtered out client-side (see is_excluded) from the results of each source
+
+    :return: Tuple with the filtered results of each source,
+        and the number of associations dropped from each source (to compute the offsets of the next page)
+    """
+    filtered_results = []
+    dropped_counts = []
+    for rows in source_results:
+        filtered = [row for row in rows if not is_excluded(row["np_uri"]["value"], index_members)]
+        dropped = {row["association"]["value"] for row in rows} - {row["association"]["value"] for row in filtered}
+        filtered_results.append(filtered)
+        dropped_counts.append(len(dropped))
+    return filtered_results, dropped_counts
+
+
+def get_one_hop_constraints(query_graph, edge_id):
+    """Resolve the predicates, categories and ids constraining one edge of a TRAPI query graph to URIs
+
+    The predicates and categories are expanded with their BioLink descendants (see app.trapi.biolink_closure).
+
+    :return: Dict of lists of URIs, with the keys expected by edge_store.select_one_hop
+    """
+    edge_props = query_graph["edges"][edge_id]
+    subject_node = query_graph["nodes"][edge_props["subject"]]
+    object_node = query_graph["nodes"][edge_props["object"]]
+
+    def as_list(value):
+        if not value:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def resolve_ids(ids):
+        # URIs (e.g. bound by a previous hop of a multi-hop query) are used as they are
+        return [
+            uri for node_id in as_list(ids)
+            for uri in (
+                [node_id] if node_id.startswith(("http://", "https://"))
+                else [resolve_curie(node_id), resolve_curie_identifiersorg(node_id)]
+            )
+        ]
+
+    return {
+        "predicates": expand_biolink_uris([resolve_curie(curie) for curie in as_list(edge_props.get("predicates"))]),
+        "subject_categories": expand_biolink_uris(
+            [resolve_curie(curie) for curie in as_list(subject_node.get("categories"))]
+        ),
+        "object_categories": expand_biolink_uris(
+            [resolve_curie(curie) for curie in as_list(object_node.get("categories"))]
+        ),
+        "subject_ids": resolve_ids(subject_node.get("ids")),
+        "object_ids": resolve_ids(object_node.get("ids")),
+    }
+
+
+def trapi_log(level, message):
+    """Create a TRAPI log entry"""
+    return {"timestamp": datetime.now().isoformat(), "level": level, "code": None, "message": message}
+
+
+def run_sparql_query(query, deadline=None):
+    """Run a SPARQL SELECT query against the Nanopublication network and return its bindings
+
+    :param deadline: Deadline of the TRAPI query, QueryCancelledError is raised once it expired
+    """
+    if settings.DEV_MODE is True:
+        print(
+            f"Running the following SPARQL query to retrieve nanopublications from {settings.NANOPUB_SPARQL_URL}"
         )
-        # else:
-        #   knowledge_source_block = f"biolink:aggregator_knowledge_source <{KNOWLEDGE_PROVIDER}> ;"
-        #   sparql_query_get_nanopubs = sparql_query_get_nanopubs.replace('?_knowledge_source', knowledge_source_block)
-
-        for edge_id in query_graph["edges"]:
-            edge_props = query_graph["edges"][edge_id]
-            predicate_edge_id = edge_id
-            subject_node_id = edge_props["subject"]
-            object_node_id = edge_props["object"]
-
-            entity_filters = ""
-            # Generate SPARQL query filters based on TRAPI query graph
-            try:
-                predicate_curies = edge_props["predicates"]
-                if not isinstance(predicate_curies, list):
-                    predicate_curies = [predicate_curies]
-                predicate_curies = ["?predicate = " + curie for curie in predicate_curies]
-                predicate_curies = " || ".join("?predicate = " + predicate_curies)
-                entity_filters = entity_filters + "FILTER ( " + predicate_curies + " )\n"
-            except Exception:
-                pass
+        print(query)
+    return get_sparql_client().query(query, deadline)
+
+
+def run_sparql_stream(query, deadline=None):
+    """Run a SPARQL SELECT query against the Nanopublication network and iterate over its bindings as they are parsed
+
+    :param deadline: Deadline of the TRAPI query, QueryCancelledError is raised once it expired
+    """
+    if settings.DEV_MODE is True:
+        print(f"Streaming the results of the following SPARQL query from {settings.NANOPUB_SPARQL_URL}")
+        print(query)
+    return get_sparql_client().stream(query, deadline)
+
+
+def run_sparql_queries(queries, deadline=None):
+    """Run SPARQL queries concurrently, at most settings.TRAPI_MAX_PARALLEL_QUERIES at a time
+
+    A failed query returns the last good results of the same query if they are cached (reported as stale in the
+    logs), or no rows otherwise. An error is raised only if all queries failed without cached results.
+    The queries not done when the deadline expires are cancelled and return no rows, the deadline is marked truncated.
+
+    :return: Tuple with the list of bindings of each query, and the list of TRAPI logs
+    """
+    results = []
+    logs = []
+    errors = []
+    # The queries run in the executor threads, with the priority of the calling thread
+    priority = current_priority()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(settings.TRAPI_MAX_PARALLEL_QUERIES, len(queries))))
+    try:
+        futures = [
+            executor.submit(
+                call_with_priority, priority, sparql_stale_cache.call, query, run_sparql_query, query, deadline
+            )
+            for query in queries
+        ]
+        done = deadline.wait(futures) if deadline else futures
+        for i, future in enumerate(futures):
+            if future not in done:
+                results.append([])
+                continue
             try:
-                subject_categories = query_graph["nodes"][edge_props["subject"]][
-                    "categories"
-                ]
-                if not isinstance(subject_categories, list):
-                    subject_categories = [subject_categories]
-                subject_categories = ["?subject_category = " + curie for curie in subject_categories]
-                subject_categories = " || ".join(subject_categories)
-                entity_filters = entity_filters + "FILTER ( " + subject_categories + " )\n"
-            except Exception:
-                pass
+                bindings, age = future.result()
+                results.append(bindings)
+                if age is not None:
+                    logs.append(
+                        trapi_log(
+                            "WARNING",
+                            f"SPARQL query {i + 1}/{len(queries)} failed, its results are stale: "
+                            f"served from the cache of {age:.0f} seconds ago",
+                        )
+                    )
+            except QueryCancelledError:
+                # Stopped by the deadline while reading its results
+                if deadline is not None:
+                    deadline.truncated = True
+                results.append([])
+            except Exception as e:
+                errors.append(e)
+                results.append([])
+                logs.append(
+                    trapi_log("WARNING", f"SPARQL query {i + 1}/{len(queries)} failed, its results are missing: {e}")
+                )
+    finally:
+        # Do not wait for the queries cancelled by the deadline, they stop reading their response by themselves
+        executor.shutdown(wait=False, cancel_futures=True)
+    if errors and len(errors) == len(queries):
+        raise errors[0]
+    return results, logs
+
+
+def stream_sparql_queries(queries, logs, deadline=None):
+    """Run SPARQL queries concurrently, and yield the rows of each query with its index as they are parsed
+
+    The rows go through a bounded queue: the queries stop reading their response while the consumer is busy.
+    Like run_sparql_queries, a query failing before its first row returns the last good results of the same query
+    if they are cached (only results with at most STALE_CACHE_MAX_ROWS rows are), the queries not done
+    when the deadline expires are cancelled, and an error is raised only if all queries failed.
+
+    :param logs: List the TRAPI logs are added to
+    :return: Iterator over tuples (index of the query, row)
+    """
+    rows_queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(message):
+        """Put a message in the queue, return False if the consumer stopped"""
+        while not stop.is_set():
             try:
-                object_categories = query_graph["nodes"][edge_props["object"]]["categories"]
-                if not isinstance(object_categories, list):
-                    object_categories = [object_categories]
-                object_categories = ["?object_category = " + curie for curie in object_categories]
-                object_categories = " || ".join(object_categories)
-                entity_filters = entity_filters + "FILTER ( " + object_categories + " )\n"
-            except Exception:
+                rows_queue.put(message, timeout=POLL_INTERVAL)
+                return True
+            except Full:
                 pass
-            # Resolve provided CURIE to the BioLink context and https://identifiers.org/CURIE:ID
+        return False
+
+    def run(i, query):
+        # Rows kept for the stale cache, None when there are too many
+        rows = []
+        try:
+            for row in run_sparql_stream(query, deadline):
+                if rows is not None:
+                    rows.append(row)
+                    if len(rows) > STALE_CACHE_MAX_ROWS:
+                        rows = None
+                if not put(("row", i, row)):
+                    return
+        except QueryCancelledError as e:
+            put(("done", i, e))
+            return
+        except Exception as e:
+            stale = sparql_stale_cache.get(query) if rows == [] else None
+            if stale is None:
+                put(("done", i, e))
+                return
+            put(("stale", i, stale[1]))
+            for row in stale[0]:
+                if not put(("row", i, row)):
+                    return
+            put(("done", i, None))
+            return
+        if rows is not None:
+            sparql_stale_cache.put(query, rows)
+        put(("done", i, None))
+
+    errors = []
+    running = len(queries)
+    priority = current_priority()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(settings.TRAPI_MAX_PARALLEL_QUERIES, len(queries))))
+    try:
+        for i, query in enumerate(queries):
+            executor.submit(call_with_priority, priority, run, i, query)
+        while running:
+            if deadline is not None and deadline.expired:
+                deadline.truncated = True
+                break
             try:
-                subject_curies = query_graph["nodes"][edge_props["subject"]]["ids"]
-                subject_curies = [f"?subject = <{resolve_curie(curie)}> || ?subject =<{resolve_curie_identifiersorg(curie)}>" for curie in subject_curies]
-                subject_curies = " || ".join(subject_curies)
-                entity_filters = entity_filters + "FILTER ( " + subject_curies + " )\n"
-            except Exception:
-                pass
+                kind, i, value = rows_queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            if kind == "row":
+                yield i, value
+            elif kind == "stale":
+                logs.append(
+                    trapi_log(
+                        "WARNING",
+                        f"SPARQL query {i + 1}/{len(queries)} failed, its results are stale: "
+                        f"served from the cache of {value:.0f} seconds ago",
+                    )
+                )
+            else:
+                running -= 1
+                if isinstance(value, QueryCancelledError):
+                    # Stopped by the deadline while reading its results
+                    if deadline is not None:
+                        deadline.truncated = True
+                elif value is not None:
+                    errors.append(value)
+                    logs.append(
+                        trapi_log(
+                            "WARNING",
+                            f"SPARQL query {i + 1}/{len(queries)} failed, "
+                            f"its results are missing or incomplete: {value}",
+                        )
+                    )
+        if errors and len(errors) == len(queries):
+            raise errors[0]
+    finally:
+        # Stop the queries still running, they are blocked on the queue or stop reading at the deadline
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def query_one_hop(
+    query_graph,
+    edge_id,
+    np_users,
+    in_index=None,
+    n_results=None,
+    engine="sparql",
+    offsets=None,
+    deadline=None,
+    projection=None,
+):
+    """Retrieve the knowledge graph and results for one edge of a TRAPI query graph
+
+    :param query_graph: TRAPI query graph
+    :param edge_id: ID of the query graph edge to resolve
+    :param np_users: Nanopublication users indexed by their public key, from get_np_users()
+    :param in_index: URI of a nanopub index the associations should be part of
+    :param n_results: Maximum number of edges to return, settings.TRAPI_MAX_RESULTS if None
+    :param engine: "sparql" to query the Nanopublication network, "sqlite" to use the local edge store,
+        or "csr" to use the memory-mapped snapshot of the edge store (for queries with pinned ids)
+    :param offsets: Number of associations to skip for each source (SPARQL template or local store), from a cursor
+    :param deadline: Deadline of the TRAPI query, the SPARQL queries not done when it expires return no rows
+    :param projection: Projection of the edge properties to retrieve and return (see app.trapi.projection),
+        None for all of them
+    :return: Dict with the TRAPI knowledge_graph and results for this edge, the TRAPI logs, the offsets to get
+        the next page (None if there are no more results), and the URIs of the nodes of the knowledge graph
+        indexed by their CURIE
+    :raise ValueError: if the cursor, or the qualifier and attribute constraints of the edge are invalid
+    """
+    subject_node_id = query_graph["edges"][edge_id]["subject"]
+    object_node_id = query_graph["edges"][edge_id]["object"]
+    n_results = min(n_results or settings.TRAPI_MAX_RESULTS, settings.TRAPI_MAX_RESULTS)
+    uses_store = engine in ("sqlite", "csr") and not in_index
+
+    # Constraints checked on the assembled edges: all of them for the edge store, the ones which cannot be
+    # expressed exactly in SPARQL otherwise (see app.trapi.constraints)
+    edge_constraints = EdgeConstraints.from_query_edge(query_graph["edges"][edge_id])
+    qualifier_sets = edge_constraints.qualifier_sets if uses_store else []
+    attribute_constraints = edge_constraints.attribute_constraints if uses_store else edge_constraints.split()[1]
+    # The properties checked are retrieved even if they are not projected, they are removed once checked
+    fetch_projection = projection
+    if projection is not None and (qualifier_sets or attribute_constraints):
+        fetch_projection = projection.including(
+            [constraint["id"] for constraint in attribute_constraints], bool(qualifier_sets)
+        )
+
+    # Rows retrieved from each source, in the order they are added to the knowledge graph
+    source_results = []
+    # Rows to process, when they are not just the concatenation of the source results
+    source_results_rows = None
+    # Associations returned by each source, when the rows of the source results are not kept
+    source_associations = None
+    # Associations of the nanopubs filtered out client-side returned by each streamed source
+    excluded_associations = None
+    # Number of associations returned by each source but filtered out, as they count in the offsets
+    dropped_counts = None
+    logs = []
+    # The edge store does not mirror nanopub indexes, queries filtered by index always use SPARQL
+    if uses_store:
+        offsets = offsets or [0]
+        constraints = get_one_hop_constraints(query_graph, edge_id)
+        if engine == "csr" and (constraints["subject_ids"] or constraints["object_ids"]):
+            with open_snapshot() as snapshot:
+                source_results.append(snapshot.select_one_hop(**constraints, limit=n_results, offset=offsets[0]))
+        else:
+            conn = edge_store.connect()
             try:
-                object_curies = query_graph["nodes"][edge_props["object"]]["ids"]
-                object_curies = [f"?object = <{resolve_curie(curie)}> || ?object =<{resolve_curie_identifiersorg(curie)}>" for curie in object_curies]
-                object_curies = " || ".join(object_curies)
-                entity_filters = entity_filters + "FILTER ( " + object_curies + " )\n"
-            except Exception:
-                pass
-            query = query.replace(
-                "?_entity_filters", entity_filters
+                source_results.append(
+                    edge_store.select_one_hop(conn, **constraints, limit=n_results, offset=offsets[0])
+                )
+            finally:
+                conn.close()
+    else:
+        # Large lists of ids are split in chunks, each (chunk, template) is a source with its own offset
+        hop_graphs = chunk_one_hop_graph(query_graph, edge_id, settings.TRAPI_ID_CHUNK_SIZE)
+        n_templates = len(one_hop_templates)
+        offsets = offsets or [0] * n_templates * len(hop_graphs)
+        if len(offsets) != count_cursor_sources(query_graph, edge_id, in_index, engine):
+            raise ValueError("Invalid cursor: it does not match the query graph")
+        batched = settings.TRAPI_DETAILS_MODE == "batched"
+        index_members = None
+        if in_index and in_index != "infores:knowledge-collaboratory":
+            _index_values, index_members = get_index_constraint(in_index, run_sparql_query)
+        queries = [
+            query
+            for i, hop_graph in enumerate(hop_graphs)
+            for query in build_one_hop_queries(
+                hop_graph,
+                edge_id,
+                in_index,
+                n_results,
+                offsets[i * n_templates : (i + 1) * n_templates],
+                one_hop_core_templates if batched else one_hop_templates,
+                fetch_projection,
             )
-            query = query.replace(
-                "?_prov_block", prov_block
+        ]
+        if settings.TRAPI_STREAM_RESULTS and not batched:
+            # The rows are assembled as they are parsed, the results of the queries are not kept in memory
+            source_associations = [set() for _ in queries]
+            excluded_associations = [set() for _ in queries]
+
+            def stream_rows():
+                for i, row in stream_sparql_queries(queries, logs, deadline):
+                    association = row["association"]["value"]
+                    if is_excluded(row["np_uri"]["value"], index_members):
+                        excluded_associations[i].add(association)
+                        continue
+                    source_associations[i].add(association)
+                    yield row
+
+            source_results_rows = stream_rows()
+        else:
+            source_results, logs = run_sparql_queries(queries, deadline)
+            if invalidated_nanopubs.loaded or index_members is not None:
+                source_results, dropped_counts = filter_excluded_rows(source_results, index_members)
+        if batched:
+            details_queries = build_details_queries(source_results, n_results)
+            detail_results, details_logs = (
+                run_sparql_queries(details_queries, deadline) if details_queries else ([], [])
             )
-        # NOTE: arbitrary limit to prevent requesting too much from the SPARQL endpoint
-        query = query + " LIMIT 10000"
-        transformed_queries.append(query)
-
-    kg = {"nodes": {}, "edges": {}}
-    query_results = []
-    kg_edge_count = 0
-
-    sparql = SPARQLWrapper(settings.NANOPUB_SPARQL_URL)
-    sparql.setReturnFormat(JSON)
-    sparql_results = []
-    for query in transformed_queries:
-        if settings.DEV_MODE is True:
-            print(
-                f"Running the following SPARQL query to retrieve nanopublications from {settings.NANOPUB_SPARQL_URL}"
+            logs.extend(details_logs)
+            source_results_rows = merge_detail_rows(
+                [row for rows in source_results for row in rows], [row for rows in detail_results for row in rows]
             )
-            print(query)
-        sparql.setQuery(query)
-        sparqlwrapper_results = sparql.query().convert()
-        sparql_results.extend(sparqlwrapper_results["results"]["bindings"])
+    if source_results_rows is None:
+        source_results_rows = (row for rows in source_results for row in rows)
 
-    # Build TRAPI KG from SPARQL results
+    # Build TRAPI KG from SPARQL results, duplicated rows (e.g. from different chunks) are merged by the assembler
     # Check current official example of Reasoner query results: https://github.com/NCATSTranslator/ReasonerAPI/blob/master/examples/Message/simple.json
-    # Now iterates the Nanopubs SPARQL query results:
-    for edge_result in sparql_results:
-        # print(edge_result)
-        if kg_edge_count >= n_results:
-            break
-        edge_uri = edge_result["association"]["value"]
-        # Conflict when multiple nanopubs use the same edge ID: edge_uri = edge_result["association"]["value"].split("#")[-1]
-        # Create edge object in knowledge_graph
-        add_binding = False
-        if edge_uri not in kg["edges"]:
-            add_binding = True
-            kg["edges"][edge_uri] = {
-                "predicate": [resolve_uri(edge_result["predicate"]["value"])],
-                "subject": resolve_uri(edge_result["subject"]["value"]),
-                "object": resolve_uri(edge_result["object"]["value"]),
-                "attributes": [],
-                "qualifiers": [],
-                "sources": [],
-            }
+    assembler = EdgeAssembler(
+        edge_id, subject_node_id, object_node_id, resolve_uri, np_users, n_results, fetch_projection
+    )
+    assembler.add_rows(source_results_rows)
+    kg, query_results = assembler.to_trapi()
+    rejected = set()
+    if qualifier_sets or attribute_constraints:
+        kg, query_results, rejected = filter_edges(kg, query_results, edge_id, qualifier_sets, attribute_constraints)
+        if fetch_projection is not projection:
+            for edge in kg["edges"].values():
+                projection.apply(edge)
+
+    if source_associations is None:
+        source_associations = [{row["association"]["value"] for row in rows} for rows in source_results]
+    if excluded_associations is not None:
+        dropped_counts = [
+            len(excluded - returned) for excluded, returned in zip(excluded_associations, source_associations)
+        ]
+    # Each source returned a window of at most n_results associations, compute where the next page starts
+    # Associations filtered out by the constraints were consumed too
+    next_offsets = get_next_offsets(
+        offsets,
+        source_associations,
+        dropped_counts,
+        kg["edges"].keys() | rejected,
+        n_results,
+        deadline is not None and deadline.truncated,
+    )
 
-        # Get author based on nanopub pubkey?
-        if (
-            "pubkey" in edge_result
-            and "user" in np_users[edge_result["pubkey"]["value"]]
-        ):
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:author",
-                    "value": np_users[edge_result["pubkey"]["value"]]["user"]["value"],
-                }
-            )
+    return {
+        "knowledge_graph": kg,
+        "results": query_results,
+        "next_offsets": next_offsets,
+        "logs": logs,
+        "node_uris": assembler.get_node_uris(kg["nodes"]),
+    }
 
-        # Add Sources
-        if "primary_knowledge_source" in edge_result:
-            new_src = {
-                "resource_id": resolve_uri(edge_result["primary_knowledge_source"]["value"]),
-                "resource_role": "primary_knowledge_source",
-            }
-            if "primary_upstream_resource_ids" in edge_result:
-                if "upstream_resource_ids" not in new_src:
-                    new_src["upstream_resource_ids"] = []
-                new_src["upstream_resource_ids"].append(resolve_uri(
-                    edge_result["primary_upstream_resource_ids"]["value"]
-                ))
-            if "primary_source_record_urls" in edge_result:
-                if "source_record_urls" not in new_src:
-                    new_src["source_record_urls"] = []
-                new_src["source_record_urls"].append(resolve_uri(
-                    edge_result["primary_source_record_urls"]["value"]
-                ))
-            if not any(
-                attribute for attribute in kg["edges"][edge_uri]["sources"]
-                if attribute["resource_id"] == new_src["resource_id"]
-            ):
-                kg["edges"][edge_uri]["sources"].append(new_src)
-
-        if "supporting_data_source" in edge_result:
-            new_src = {
-                "resource_id": resolve_uri(edge_result["supporting_data_source"]["value"]),
-                "resource_role": "supporting_data_source",
-            }
-            if "supporting_upstream_resource_ids" in edge_result:
-                if "upstream_resource_ids" not in new_src:
-                    new_src["upstream_resource_ids"] = []
-                new_src["upstream_resource_ids"].append(resolve_uri(
-                    edge_result["supporting_upstream_resource_ids"]["value"]
-                ))
-            if "supporting_source_record_urls" in edge_result:
-                if "source_record_urls" not in new_src:
-                    new_src["source_record_urls"] = []
-                new_src["source_record_urls"].append(resolve_uri(
-                    edge_result["supporting_source_record_urls"]["value"]
-                ))
-            if not any(
-                attribute for attribute in kg["edges"][edge_uri]["sources"]
-                if attribute["resource_id"] == new_src["resource_id"]
-            ):
-                kg["edges"][edge_uri]["sources"].append(new_src)
-
-        # Add Attributes
-        if "attribute_type" in edge_result:
-            new_attribute = {
-                "attribute_type_id": resolve_uri(edge_result["attribute_type"]["value"]),
-                "value": resolve_uri(edge_result["attribute_value"]["value"]),
-                "attribute_source": resolve_uri(edge_result["attribute_provider"]["value"])
-            }
-            if not any(
-                attribute for attribute in kg["edges"][edge_uri]["attributes"]
-                if attribute["attribute_type_id"] == new_attribute["attribute_type_id"] and attribute["value"] == new_attribute["value"]
-            ):
-                kg["edges"][edge_uri]["attributes"].append(new_attribute)
-
-        # Add Qualifiers
-        if "qualifier_value" in edge_result:
-            new_qualifier = {
-                "qualifier_type_id": resolve_uri(edge_result["qualifier"]["value"]),
-                "qualifier_value": resolve_uri(edge_result["qualifier_value"]["value"]),
-            }
-            if not any(
-                qualifier for qualifier in kg["edges"][edge_uri]["qualifiers"]
-                if qualifier["qualifier_type_id"] == new_qualifier["qualifier_type_id"] and qualifier["qualifier_value"] == new_qualifier["qualifier_value"]
-            ):
-                kg["edges"][edge_uri]["qualifiers"].append(new_qualifier)
-
-        if "label" in edge_result:
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:name",
-                    "value": resolve_uri(edge_result["label"]["value"]),
-                }
-            )
-        if "description" in edge_result:
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:description",
-                    "value": resolve_uri(
-                        edge_result["description"]["value"]
-                    ),
-                    # 'value_type_id': 'biolink:Cohort',
-                }
-            )
 
-        # NOTE: below properties are mainly for the old query
-        # TODO: refactor to use a list and a loop?
-        # extract_attributes = [
-        #   'relation', 'publications', 'knowledge_source', 'label', 'provided_by',
-        #   'description', 'has_population_context', 'population_has_phenotype'
-        # ]
-        # if "relation" in edge_result:
-        #     # knowledge_graph['edges'][edge_uri]['relation'] = resolve_uri_with_context(edge_result['relation']['value'])
-        #     knowledge_graph["edges"][edge_uri]["attributes"].append(
-        #         {
-        #             "attribute_type_id": "biolink:relation",
-        #             "value": resolve_uri_with_context(edge_result["relation"]["value"]),
-        #         }
-        #     )
-        if "publications" in edge_result:
-            # Only for the old query
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:publications",
-                    "value": resolve_uri(
-                        edge_result["publications"]["value"]
-                    ),
-                }
-            )
-        if "has_population_context" in edge_result:
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:population_context_qualifier",
-                    "value": resolve_uri(
-                        edge_result["has_population_context"]["value"]
-                    ),
-                    # 'value_type_id': 'biolink:Cohort',
-                }
-            )
-        if "population_has_phenotype" in edge_result:
-            # TODO: fix the key
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:has_phenotype",
-                    "value": resolve_uri(
-                        edge_result["population_has_phenotype"]["value"]
-                    ),
-                    # 'value_type_id': 'biolink:Phenotype',
-                }
-            )
-        if "provided_by" in edge_result:
-            # Add provided_by attribute
-            kg["edges"][edge_uri]["attributes"].append(
-                {
-                    "attribute_type_id": "biolink:provided_by",
-                    "value": resolve_uri(
-                        edge_result["provided_by"]["value"]
-                    ),
-                    # 'value_type_id': 'biolink:Agent',
-                }
+def get_query_deadline(reasoner_query, *timeouts):
+    """Create the deadline of a TRAPI query from the shortest of the timeouts provided (e.g. in a header)
+    and of its query_options timeout, in seconds, or settings.TRAPI_TIMEOUT
+
+    :raise ValueError: if a timeout is invalid
+    """
+    query_options = reasoner_query.get("query_options") or {}
+    return Deadline.from_timeouts(*timeouts, query_options.get("timeout"), default=settings.TRAPI_TIMEOUT)
+
+
+def load_np_users(deadline=None):
+    """Get the nanopub users, served stale from the last successful call if the grlc API fails
+
+    :return: Tuple with the users indexed by their public key, and the TRAPI logs to add to the response
+    """
+    np_users, np_users_age = np_users_stale_cache.call("users", get_np_users, deadline)
+    logs = []
+    if np_users_age is not None:
+        logs.append(
+            trapi_log(
+                "WARNING",
+                f"The nanopub users could not be retrieved, their names are stale: "
+                f"served from the cache of {np_users_age:.0f} seconds ago",
             )
+        )
+    return np_users, logs
 
-        # Add nodes to the knowledge_graph
-        kg["nodes"][
-            resolve_uri(edge_result["subject"]["value"])
-        ] = {
-            "categories": [
-                resolve_uri(edge_result["subject_category"]["value"])
-            ]
-        }
-        kg["nodes"][
-            resolve_uri(edge_result["object"]["value"])
-        ] = {
-            "categories": [
-                resolve_uri(edge_result["object_category"]["value"])
-            ]
-        }
-
-        # Add the bindings to the results object
-        if add_binding:
-            result = {
-                'node_bindings': {},
-                'analyses': [{
-                    "resource_id": "infores:knowledge-collaboratory",
-                    "edge_bindings": {
-                        predicate_edge_id: [
-                            {
-                                "id": edge_uri
-                            }
-                        ]
-                    }
-                }],
-                # 'edge_bindings': {},
-            }
-            # result["edge_bindings"][predicate_edge_id] = [{"id": edge_uri}]
-            result["node_bindings"][subject_node_id] = [
-                {"id": resolve_uri(edge_result["subject"]["value"])}
-            ]
-            result["node_bindings"][object_node_id] = [
-                {"id": resolve_uri(edge_result["object"]["value"])}
-            ]
-            query_results.append(result)
-            kg_edge_count += 1
 
-    return {
+def parse_query_options(reasoner_query):
+    """Get the query_options of a TRAPI query, without the next_cursor of a previous response
+
+    :return: Tuple with the query_options to return in the response, n_results, in_index, engine
+        and the offsets decoded from the cursor
+    """
+    query_options = {}
+    n_results = None
+    in_index = None
+    engine = settings.TRAPI_ENGINE
+    offsets = None
+    if reasoner_query.get("query_options"):
+        query_options = dict(reasoner_query["query_options"])
+        if "n_results" in query_options:
+            n_results = int(query_options["n_results"])
+        if "in_index" in query_options:
+            in_index = str(query_options["in_index"])
+        if "engine" in query_options:
+            engine = str(query_options["engine"])
+        if "cursor" in query_options:
+            offsets = decode_cursor(str(query_options["cursor"]))
+    query_options.pop("next_cursor", None)
+    return query_options, n_results, in_index, engine, offsets
+
+
+def count_cursor_sources(query_graph, edge_id, in_index, engine):
+    """Get the number of sources of a one-hop query, each with its own offset in the cursor"""
+    if engine in ("sqlite", "csr") and not in_index:
+        return 1
+    return len(one_hop_templates) * len(chunk_one_hop_graph(query_graph, edge_id, settings.TRAPI_ID_CHUNK_SIZE))
+
+
+def check_reasoner_query(reasoner_query):
+    """Check a TRAPI query can be answered, before sending anything to the client (e.g. when streaming)
+
+    The query_options (with the cursor), the workflow, and the constraints of the query graph are parsed as they
+    are when answering the query, so a query passing this check does not raise a ValueError when answered.
+
+    :raise ValueError: if the query cannot be answered
+    """
+    query_graph = reasoner_query["message"]["query_graph"]
+    query_options, _n_results, in_index, engine, offsets = parse_query_options(reasoner_query)
+    Projection.from_query_options(query_options)
+    parse_workflow(reasoner_query)
+    for edge_id, edge in query_graph["edges"].items():
+        if not isinstance(edge, dict) or any(
+            edge.get(role) not in query_graph["nodes"] for role in ("subject", "object")
+        ):
+            raise ValueError(f"The subject and object of the edge {edge_id} should be nodes of the query graph")
+        EdgeConstraints.from_query_edge(edge)
+    if offsets is not None and len(query_graph["edges"]) != 1:
+        raise ValueError("Invalid cursor: the results can only be paged for query graphs with one edge")
+    if offsets is not None:
+        edge_id = next(iter(query_graph["edges"]))
+        if len(offsets) != count_cursor_sources(query_graph, edge_id, in_index, engine):
+            raise ValueError("Invalid cursor: it does not match the query graph")
+
+
+def trapi_response(query_graph, answer, query_options, logs, deadline, workflow=None):
+    """Create the TRAPI response of a query from its answer, with a log if the deadline truncated the results
+
+    :param workflow: Workflow of the query, returned in the response
+    """
+    if deadline.truncated:
+        logs = [
+            *logs,
+            trapi_log(
+                "WARNING",
+                f"The query ran out of its time budget of {deadline.seconds:g} seconds, the results are truncated",
+            ),
+        ]
+    response = {
         "message": {
-            "knowledge_graph": kg,
+            "knowledge_graph": answer["knowledge_graph"],
             "query_graph": query_graph,
-            "results": query_results,
+            "results": answer["results"],
         },
         "query_options": query_options,
         "reasoner_id": "infores:knowledge-collaboratory",
         "schema_version": settings.TRAPI_VERSION,
         "biolink_version": settings.BIOLINK_VERSION,
         "status": "Success",
-        # "logs": [
-        #     {
-        #         "code": None,
-        #         "level": "INFO",
-        #         "message": "No descendants found from Ontology KP for QNode 'n00'.",
-        #         "timestamp": "2023-04-05T07:24:26.646711"
-        #     },
-        # ]
+        "logs": logs + answer["logs"],
     }
+    if workflow is not None:
+        response["workflow"] = workflow
+    return response
+
+
+def answer_reasoner_query(reasoner_query, np_users, deadline, logs=None):
+    """Answer a TRAPI query with the nanopub users already retrieved, see reasonerapi_to_sparql
+
+    The workflow operations and the projection of the edge properties (query_options attributes and qualifiers)
+    are applied by the engine, see app.trapi.workflow and app.trapi.projection.
+
+    :param logs: TRAPI logs to add to the response, e.g. from load_np_users
+    :raise ValueError: if the query cannot be answered, see check_reasoner_query
+    """
+    check_reasoner_query(reasoner_query)
+    query_graph = reasoner_query["message"]["query_graph"]
+    query_options, n_results, in_index, engine, offsets = parse_query_options(reasoner_query)
+    projection = Projection.from_query_options(query_options)
+    max_results, filter_orphans = parse_workflow(reasoner_query)
+    if max_results is not None:
+        n_results = min(n_results, max_results) if n_results else max_results
+
+    if len(query_graph["edges"]) == 1:
+        answer = query_one_hop(
+            query_graph,
+            next(iter(query_graph["edges"])),
+            np_users,
+            in_index,
+            n_results,
+            engine,
+            offsets,
+            deadline,
+            projection,
+        )
+        if answer["next_offsets"]:
+            query_options["next_cursor"] = encode_cursor(answer["next_offsets"])
+    else:
+
+        def run_hop(hop_graph, edge_id):
+            hop_answer = query_one_hop(
+                hop_graph, edge_id, np_users, in_index, engine=engine, deadline=deadline, projection=projection
+            )
+            if hop_answer["next_offsets"]:
+                hop_answer["logs"].append(
+                    trapi_log(
+                        "WARNING",
+                        f"The one-hop query of the edge {edge_id} has more than {settings.TRAPI_MAX_RESULTS} "
+                        "results, only these ones are joined: the results of the query graph may be incomplete",
+                    )
+                )
+            return hop_answer
+
+        answer = execute_query_graph(
+            query_graph, run_hop, n_results=n_results, max_workers=settings.TRAPI_MAX_PARALLEL_QUERIES
+        )
+        if answer["truncated"]:
+            answer["logs"].append(
+                trapi_log(
+                    "WARNING",
+                    f"The query graph has more than {n_results} results, only the first ones are returned: "
+                    "the results of query graphs with multiple edges cannot be paged with a cursor",
+                )
+            )
+    if filter_orphans:
+        answer = {**answer, "knowledge_graph": filter_kgraph_orphans(answer["knowledge_graph"], answer["results"])}
+    return trapi_response(
+        query_graph, answer, query_options, logs or [], deadline, reasoner_query.get("workflow")
+    )
+
+
+# Concurrent identical queries share the deadline of the first one
+@coalesce(ignore=("deadline",))
+def reasonerapi_to_sparql(reasoner_query, deadline=None):
+    """Convert an array of predictions objects to ReasonerAPI format
+    Run the get_predict to get the QueryGraph edges and nodes
+    {disease: OMIM:1567, drug: DRUGBANK:DB0001, score: 0.9}
+
+    Query graphs with multiple edges are decomposed in one-hop queries by the planner.
+    When the deadline expires, the edges already retrieved are returned, with a log saying the results are truncated.
+
+    :param: reasoner_query Query from Reasoner API
+    :param deadline: Deadline of the query, from get_query_deadline(reasoner_query) if None
+    :return: Results as ReasonerAPI object
+    """
+    deadline = deadline or get_query_deadline(reasoner_query)
+    np_users, logs = load_np_users(deadline)
+    return answer_reasoner_query(reasoner_query, np_users, deadline, logs)
@@ -0,0 +1,133 @@
+"""Retracted and superseded nanopublications, kept in memory to filter the SPARQL results client-side
+
+The set is loaded at startup and refreshed incrementally in a background thread, using the dct:created date of
+the invalidating nanopubs. URIs are stored as 64-bit hashes in a sorted array (8 bytes per nanopub).
+Until the set is loaded, the TRAPI templates keep filtering retracted nanopubs with FILTER NOT EXISTS.
+"""
+import hashlib
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from app.config import logger, settings
+from app.governor import background_priority
+from app.metrics import gauge
+from app.trapi.edge_store import SYNC_PAGE_SIZE, get_invalidated_nanopubs_query, get_latest_created_query
+
+# Number of recently added hashes kept in a set before being merged in the sorted array
+MERGE_THRESHOLD = 10000
+
+
+def hash_uri(uri):
+    return int.from_bytes(hashlib.blake2b(uri.encode(), digest_size=8).digest(), "little")
+
+
+class HashedUriSet:
+    """Compact set of URIs, stored as a sorted array of 64-bit hashes, and a small set of recent additions"""
+
+    __slots__ = ("hashes", "recent", "lock")
+
+    def __init__(self):
+        self.hashes = array("Q")
+        self.recent = set()
+        self.lock = threading.Lock()
+
+    def add_all(self, uris):
+        with self.lock:
+            self.recent.update(hash_uri(uri) for uri in uris)
+            if len(self.recent) > MERGE_THRESHOLD:
+                self.merge()
+
+    def merge(self):
+        """Merge the recent additions in the sorted array, the array is replaced so readers are not blocked"""
+        self.hashes = array("Q", sorted(set(self.hashes) | self.recent))
+        self.recent = set()
+
+    def __contains__(self, uri):
+        h = hash_uri(uri)
+        if h in self.recent:
+            return True
+        hashes = self.hashes
+        i = bisect_left(hashes, h)
+        return i < len(hashes) and hashes[i] == h
+
+    def __len__(self):
+        return len(self.hashes) + len(self.recent)
+
+
+class InvalidatedNanopubs:
+    """Nanopubs retracted or superseded by another nanopub"""
+
+    def __init__(self):
+        self.uris = HashedUriSet()
+        self.latest_created = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.latest_created is not None
+
+    def __contains__(self, uri):
+        return uri in self.uris
+
+    def __len__(self):
+        return len(self.uris)
+
+    def refresh(self, run_sparql_query):
+        """Retrieve the nanopubs invalidated since the last refresh (all of them on the first call)
+
+        :return: Number of invalidated nanopubs retrieved
+        """
+        with self.lock:
+            until = run_sparql_query(get_latest_created_query)[0]["latest_created"]["value"]
+            created_filter = ""
+            if self.latest_created:
+                created_filter = (
+                    f'FILTER (?created > "{self.latest_created}"^^xsd:dateTime && ?created <= "{until}"^^xsd:dateTime)'
+                )
+            query = get_invalidated_nanopubs_query.replace("?_created_filter", created_filter)
+            count = 0
+            offset = 0
+            while True:
+                bindings = run_sparql_query(f"{query} ORDER BY ?np_uri LIMIT {SYNC_PAGE_SIZE} OFFSET {offset}")
+                self.uris.add_all(row["np_uri"]["value"] for row in bindings)
+                count += len(bindings)
+                if len(bindings) < SYNC_PAGE_SIZE:
+                    break
+                offset += SYNC_PAGE_SIZE
+            self.latest_created = until
+            return count
+
+
+invalidated_nanopubs = InvalidatedNanopubs()
+
+gauge(
+    "invalidated_nanopubs",
+    "Number of retracted or superseded nanopubs filtered from the TRAPI results",
+    callback=lambda: len(invalidated_nanopubs),
+)
+
+
+def start_refresh_thread(interval=None):
+    """Load the invalidated nanopubs, then refresh them periodically in a background thread
+
+    :param interval: Seconds between 2 refreshes, defaults to settings.RETRACTIONS_REFRESH_INTERVAL
+    """
+    from app.trapi.reasonerapi_parser import run_sparql_query
+
+    interval = interval or settings.RETRACTIONS_REFRESH_INTERVAL
+
+    def refresh_loop():
+        while True:
+            try:
+                with background_priority():
+                    count = invalidated_nanopubs.refresh(run_sparql_query)
+                logger.info(f"{count} retracted or superseded nanopubs retrieved, {len(invalidated_nanopubs)} in total")
+            except Exception as e:
+                logger.error(f"Error while retrieving the retracted nanopubs: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh_loop, name="retractions-refresh", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,103 @@
+"""Build SPARQL queries from templates parsed once at import, with constraints rendered as VALUES blocks.
+
+Templates use ?_name placeholders. A one-hop query is rendered from a skeleton cached per constraint shape
+(which variables are constrained), so each query only needs to join the skeleton segments with the terms.
+"""
+import re
+
+PLACEHOLDER_REGEX = re.compile(r"\?_([a-zA-Z_]+)")
+INVALID_IRI_CHARS = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+# Variables that can be constrained in one-hop queries, in the order their VALUES blocks are rendered
+ONE_HOP_VARIABLES = ["np_uri", "predicate", "subject", "object", "subject_category", "object_category"]
+# Variables constrained again in the main query, since nodes can have multiple categories
+CATEGORY_VARIABLES = ["subject_category", "object_category"]
+
+
+def sparql_iri(uri):
+    """Render a URI as a SPARQL IRI, raise a ValueError if it cannot be safely included in a query"""
+    if not uri or INVALID_IRI_CHARS.search(uri):
+        raise ValueError(f"Invalid IRI: {uri}")
+    return f"<{uri}>"
+
+
+class QueryTemplate:
+    """SPARQL query template, parsed once in a list of literal segments and placeholder names"""
+
+    __slots__ = ("segments",)
+
+    def __init__(self, text):
+        # Literal segments are at even positions, placeholder names at odd positions
+        self.segments = PLACEHOLDER_REGEX.split(text)
+
+    def render(self, **values):
+        """Render the query, placeholders without value are replaced by an empty string"""
+        return "".join(
+            segment if i % 2 == 0 else values.get(segment, "") for i, segment in enumerate(self.segments)
+        )
+
+    def fill(self, **values):
+        """Get the text of the template with some placeholders filled, the others are kept"""
+        return "".join(
+            segment if i % 2 == 0 else values.get(segment, f"?_{segment}") for i, segment in enumerate(self.segments)
+        )
+
+    def partial(self, **values):
+        """Get a new template with some placeholders filled, the others are kept"""
+        return QueryTemplate(self.fill(**values))
+
+
+class OneHopTemplate:
+    """Template of a one-hop query, made of a main query and an association window subquery.
+
+    The window subquery selects the distinct associations matching the constraints (bound early with VALUES),
+    and the main query retrieves the details of these associations.
+
+    :param optional_blocks: OPTIONAL blocks of the main query which can be dropped by a projection, as a dict of
+        the name of their placeholder to a tuple with their text and the properties they provide
+    """
+
+    def __init__(self, query_text, window_text, optional_blocks=None):
+        self.query = QueryTemplate(query_text)
+        self.window = QueryTemplate(window_text)
+        self.optional_blocks = optional_blocks or {}
+        self.skeletons = {}
+
+    def skeleton(self, shape):
+        """Get the template of the full query for a constraint shape, with a ?_terms_<var> placeholder per VALUES block
+
+        :param shape: Tuple of the constrained variables
+        """
+        skeleton = self.skeletons.get(shape)
+        if skeleton is None:
+            window_values = "\n      ".join(f"VALUES ?{var} {{ ?_terms_{var} }}" for var in shape)
+            query_values = "\n  ".join(
+                f"VALUES ?{var} {{ ?_terms_{var} }}" for var in shape if var in CATEGORY_VARIABLES
+            )
+            skeleton = self.query.partial(
+                association_window=self.window.fill(values=window_values),
+                entity_filters=query_values,
+                prov_block="",
+                np_index_filter="",
+            )
+            # There are at most 2^6 shapes, no need to evict
+            self.skeletons[shape] = skeleton
+        return skeleton
+
+    def render(self, constraints, limit, offset=0, projection=None, **blocks):
+        """Render the SPARQL query for a one-hop query
+
+        :param constraints: Dict of variable name to list of URIs, empty lists are not constrained
+        :param limit: Maximum number of distinct associations to retrieve
+        :param offset: Number of associations to skip
+        :param projection: Projection of the edge properties (see app.trapi.projection), the optional blocks
+            it does not need are dropped. None to keep all of them
+        :param blocks: Additional graph patterns to add in the window (e.g. prov_block, np_index_filter)
+        """
+        shape = tuple(var for var in ONE_HOP_VARIABLES if constraints.get(var))
+        terms = {
+            f"terms_{var}": " ".join(sparql_iri(uri) for uri in dict.fromkeys(constraints[var])) for var in shape
+        }
+        for name, (text, provides) in self.optional_blocks.items():
+            blocks[name] = text if projection is None or projection.keeps(provides) else ""
+        return self.skeleton(shape).render(limit=str(int(limit)), offset=str(int(offset)), **terms, **blocks)
@@ -0,0 +1,282 @@
+"""Client for the SPARQL endpoints of the Nanopublication network, with hedged requests and failover
+
+The endpoints in settings.NANOPUB_SPARQL_URLS are equivalent. The primary is the healthy endpoint with the lowest
+median latency. When it does not answer within the SPARQL_HEDGE_PERCENTILE of its recent latencies, a hedged
+request is sent to the next endpoint: the first answer wins, and the other request is cancelled (it stops reading
+its response). Large results can be streamed instead, their bindings are parsed as they are received.
+Each endpoint has a circuit breaker: endpoints failing or slow are skipped while their circuit is
+open, and their requests fail over. When all circuits are open, queries fail immediately with CircuitOpenError.
+Each endpoint also has a governor (see app.governor) limiting the requests sent to it, they wait in its fair queue.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import orjson
+import requests
+from app.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.config import settings
+from app.deadline import DeadlineExceededError
+from app.governor import current_priority, get_governor
+from app.metrics import counter, get_metric
+from app.trapi.sparql_json import iter_bindings
+from requests.adapters import HTTPAdapter
+
+# Number of latencies kept for each endpoint
+LATENCY_WINDOW = 200
+# Minimum number of latencies before using their percentile as hedge delay
+MIN_LATENCY_SAMPLES = 20
+# Hedge delay in seconds until enough latencies are collected, and minimum hedge delay
+DEFAULT_HEDGE_DELAY = 2.0
+MIN_HEDGE_DELAY = 0.05
+CONNECT_TIMEOUT = 5
+READ_CHUNK_SIZE = 64 * 1024
+MAX_CONNECTIONS = 32
+
+hedged_requests = counter(
+    "sparql_hedged_requests_total", "Number of hedged SPARQL requests sent to a secondary endpoint"
+)
+failed_over_requests = counter(
+    "sparql_failed_over_requests_total", "Number of SPARQL requests sent to another endpoint after a failure"
+)
+
+
+class QueryCancelledError(Exception):
+    """The request lost the race against a hedged request, or the deadline of the query expired"""
+
+
+class Endpoint:
+    """SPARQL endpoint, with its recent latencies, circuit breaker and governor"""
+
+    __slots__ = ("url", "position", "latencies", "breaker", "governor", "session")
+
+    def __init__(self, url, position):
+        self.url = url
+        self.position = position
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.breaker = CircuitBreaker(f"sparql {url}", ignored_exceptions=(QueryCancelledError,))
+        self.governor = get_governor(url)
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+
+    def percentile(self, p):
+        """Get a percentile of the recent latencies, None if there are not enough of them"""
+        latencies = sorted(self.latencies)
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    def rank(self):
+        median = self.percentile(0.5)
+        return (median if median is not None else 0.0, self.position)
+
+
+class EndpointLatencies:
+    """Gauge of the latency percentiles of each endpoint, labelled by endpoint"""
+
+    kind = "gauge"
+
+    def __init__(self, name, description, client):
+        self.name = name
+        self.description = description
+        self.client = client
+
+    def samples(self):
+        samples = []
+        for endpoint in self.client.endpoints:
+            for quantile in (0.5, 0.95):
+                value = endpoint.percentile(quantile)
+                if value is not None:
+                    samples.append((f'{self.name}{{endpoint="{endpoint.url}",quantile="{quantile}"}}', value))
+        return samples
+
+
+class SparqlClient:
+    """Run SPARQL SELECT queries against equivalent endpoints"""
+
+    def __init__(self, urls, hedge_percentile=0.95, timeout=60):
+        self.endpoints = [Endpoint(url, position) for position, url in enumerate(urls)]
+        self.hedge_percentile = hedge_percentile
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS, thread_name_prefix="sparql")
+
+    def ranked_endpoints(self):
+        """Get the endpoints whose circuit is not open, fastest first"""
+        return sorted((endpoint for endpoint in self.endpoints if endpoint.breaker.available), key=Endpoint.rank)
+
+    def hedge_delay(self, endpoint):
+        delay = endpoint.percentile(self.hedge_percentile)
+        return DEFAULT_HEDGE_DELAY if delay is None else max(delay, MIN_HEDGE_DELAY)
+
+    def fetch(self, endpoint, query, cancel=None, deadline=None, priority=None):
+        """Send a query to an endpoint through its governor and circuit breaker and return its bindings
+
+        The time spent waiting for a slot of the governor is not part of the latency of the endpoint.
+
+        :param priority: Priority of the query in the governor queue, the one of the current thread by default
+        """
+        try:
+            with endpoint.governor.slot(priority, deadline, cancel):
+                start = time.monotonic()
+                bindings = endpoint.breaker.call(self.read_bindings, endpoint, query, cancel, deadline)
+                endpoint.latencies.append(time.monotonic() - start)
+        except DeadlineExceededError:
+            # Cancelled while waiting for a slot
+            raise QueryCancelledError() from None
+        return bindings
+
+    def read_bindings(self, endpoint, query, cancel, deadline):
+        return orjson.loads(b"".join(self.iter_chunks(endpoint, query, cancel, deadline)))["results"]["bindings"]
+
+    def iter_chunks(self, endpoint, query, cancel=None, deadline=None):
+        """Send a query to an endpoint and yield the chunks of its response
+
+        :param cancel: Event stopping the reading of the response when set
+        :param deadline: Deadline of the query, bounding the timeouts and stopping the reading once expired
+        """
+        timeout = deadline.timeout(self.timeout) if deadline else self.timeout
+        try:
+            with endpoint.session.post(
+                endpoint.url,
+                data={"query": query},
+                headers={"Accept": "application/sparql-results+json"},
+                stream=True,
+                timeout=(min(CONNECT_TIMEOUT, timeout), timeout),
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(READ_CHUNK_SIZE):
+                    if (cancel is not None and cancel.is_set()) or (deadline is not None and deadline.expired):
+                        raise QueryCancelledError()
+                    yield chunk
+        except requests.RequestException:
+            if deadline is not None and deadline.expired:
+                # The request timed out because of the query deadline, the endpoint is not at fault
+                raise QueryCancelledError() from None
+            raise
+
+    def query(self, query, deadline=None):
+        """Run a SPARQL SELECT query and return its bindings
+
+        The query is sent to the primary endpoint, hedged to the next one if it is slow, and failed over
+        to the next ones if it fails. The error of the last endpoint is raised if all of them failed,
+        and CircuitOpenError if all their circuits are open.
+
+        :param deadline: Deadline of the query, QueryCancelledError is raised once it expired
+        """
+        if deadline is not None and deadline.expired:
+            raise QueryCancelledError()
+        endpoints = self.ranked_endpoints()
+        if not endpoints:
+            raise CircuitOpenError("All the SPARQL endpoints are unavailable, their circuit breakers are open")
+        if len(endpoints) == 1:
+            return self.fetch(endpoints[0], query, deadline=deadline)
+
+        # The requests run in the executor threads, with the priority of the calling thread
+        priority = current_priority()
+        cancel = threading.Event()
+        remaining = iter(endpoints)
+        pending = {self.executor.submit(self.fetch, next(remaining), query, cancel, deadline, priority)}
+        primary = endpoints[0]
+        hedged = False
+        error = None
+        try:
+            while pending:
+                timeout = None if hedged else self.hedge_delay(primary)
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        error = e
+                if done and pending:
+                    # Still waiting for another endpoint
+                    continue
+                endpoint = next(remaining, None)
+                if endpoint is None or (deadline is not None and deadline.expired):
+                    continue
+                if done:
+                    failed_over_requests.inc()
+                else:
+                    # The primary is slower than usual: hedge the query to the next endpoint
+                    hedged = True
+                    hedged_requests.inc()
+                pending.add(self.executor.submit(self.fetch, endpoint, query, cancel, deadline, priority))
+            raise error
+        finally:
+            # Cancel the requests still running
+            cancel.set()
+
+    def stream(self, query, deadline=None):
+        """Run a SPARQL SELECT query and yield its bindings as they are parsed from the response
+
+        The query is failed over to the next endpoint if it fails before its first row, it is not hedged.
+        The latency recorded for the endpoint is the time to the first row.
+
+        :param deadline: Deadline of the query, QueryCancelledError is raised once it expired
+        """
+        if deadline is not None and deadline.expired:
+            raise QueryCancelledError()
+        error = CircuitOpenError("All the SPARQL endpoints are unavailable, their circuit breakers are open")
+        for endpoint in self.ranked_endpoints():
+            if not endpoint.breaker.acquire():
+                continue
+            if not isinstance(error, CircuitOpenError):
+                failed_over_requests.inc()
+            start = time.monotonic()
+            latency = None
+            try:
+                with endpoint.governor.slot(deadline=deadline):
+                    # The latency starts once the slot is granted
+                    start = time.monotonic()
+                    for binding in iter_bindings(self.iter_chunks(endpoint, query, deadline=deadline)):
+                        if latency is None:
+                            latency = time.monotonic() - start
+                            endpoint.breaker.record(False, latency)
+                            endpoint.latencies.append(latency)
+                        yield binding
+            except DeadlineExceededError:
+                # Cancelled while waiting for a slot
+                endpoint.breaker.release()
+                raise QueryCancelledError() from None
+            except (QueryCancelledError, GeneratorExit):
+                if latency is None:
+                    endpoint.breaker.release()
+                raise
+            except Exception as e:
+                if latency is not None:
+                    # Rows were already yielded, the query cannot be failed over
+                    raise
+                endpoint.breaker.record(True, time.monotonic() - start)
+                error = e
+                continue
+            if latency is None:
+                # No rows
+                latency = time.monotonic() - start
+                endpoint.breaker.record(False, latency)
+                endpoint.latencies.append(latency)
+            return
+        raise error
+
+
+sparql_client = None
+sparql_client_lock = threading.Lock()
+
+
+def get_sparql_client():
+    """Get the SPARQL client for the endpoints defined in the settings"""
+    global sparql_client
+    with sparql_client_lock:
+        if sparql_client is None:
+            sparql_client = SparqlClient(
+                settings.NANOPUB_SPARQL_URLS or [settings.NANOPUB_SPARQL_URL],
+                hedge_percentile=settings.SPARQL_HEDGE_PERCENTILE,
+                timeout=settings.SPARQL_TIMEOUT,
+            )
+            get_metric(
+                EndpointLatencies,
+                "sparql_endpoint_latency_seconds",
+                "Latency percentiles of the recent requests to each SPARQL endpoint",
+                client=sparql_client,
+            )
+        return sparql_client
@@ -0,0 +1,62 @@
+"""Incremental parser of SPARQL JSON results, yielding the bindings one by one as the response is received
+
+Only the bindings being parsed are kept in memory, instead of the whole response and all its rows, so large
+results can be consumed (e.g. by the edge assembler) with a memory bounded by the size of a row.
+"""
+import codecs
+import json
+import re
+
+BINDINGS_START_REGEX = re.compile(r'"bindings"\s*:\s*\[')
+SEPARATORS = " \t\r\n,"
+
+decoder = json.JSONDecoder()
+
+
+def iter_bindings(chunks):
+    """Parse SPARQL JSON results from a stream of bytes, and yield their bindings
+
+    :param chunks: Iterable of the bytes of the response, split anywhere
+    :return: Iterator over the bindings, as dicts
+    :raise ValueError: if the response is not valid SPARQL JSON results, or is truncated
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    # Position of the next binding in the buffer, None until the start of the bindings array is found
+    position = None
+    eof = False
+    while True:
+        if position is None:
+            match = BINDINGS_START_REGEX.search(buffer)
+            if match:
+                position = match.end()
+        if position is not None:
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+            if position < len(buffer):
+                if buffer[position] == "]":
+                    return
+                try:
+                    binding, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # The binding is not complete yet, read the next chunk
+                    if eof:
+                        raise
+                else:
+                    yield binding
+                    continue
+        if eof:
+            if position is None:
+                raise ValueError("The response does not contain SPARQL JSON results")
+            raise ValueError("The SPARQL results are truncated")
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer += text_decoder.decode(b"", final=True)
+            continue
+        if position is not None:
+            # Drop the bindings already parsed
+            buffer = buffer[position:]
+            position = 0
+        buffer += text_decoder.decode(chunk)
@@ -0,0 +1,379 @@
+"""SPARQL templates of the one-hop TRAPI queries against the Nanopublication network, parsed once at import
+
+Each one-hop query is rendered from the templates of the older BioLink model (NeuroDKG), then of the current one.
+They are used to answer TRAPI queries (see app.trapi.reasonerapi_parser), and to populate the edge store.
+"""
+from app.trapi.projection import QUALIFIERS
+from app.trapi.sparql_builder import OneHopTemplate, QueryTemplate
+
+KNOWLEDGE_PROVIDER = "https://w3id.org/biolink/infores/knowledge-collaboratory"
+# Filter retracted and superseded nanopubs in the TRAPI templates, used until the set of invalidated nanopubs
+# is loaded in memory. New versions state npx:supersedes in their publication info, signed with the same key
+retraction_filter_block = """FILTER NOT EXISTS { ?creator npx:retracts ?np_uri }
+  FILTER NOT EXISTS {
+    graph ?superseding_head {
+      ?superseding_np np:hasPublicationInfo ?superseding_pubinfo .
+    }
+    graph ?superseding_pubinfo {
+      ?superseding_np npx:supersedes ?np_uri .
+    }
+    graph npa:graph {
+      ?superseding_np npa:hasValidSignatureForPublicKey ?pubkey .
+    }
+  }"""
+
+
+# Query to get nanopublications that uses the older BioLink model (NeuroDKG)
+select_np_query_old = (
+    """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX biolink: <https://w3id.org/biolink/vocab/>
+PREFIX infores: <https://w3id.org/biolink/infores/>
+PREFIX np: <http://www.nanopub.org/nschema#>
+PREFIX npx: <http://purl.org/nanopub/x/>
+PREFIX npa: <http://purl.org/nanopub/admin/>
+SELECT DISTINCT ?association ?subject ?predicate ?object ?subject_category ?object_category
+    ?primary_knowledge_source ?provided_by ?publications
+    ?label ?description ?population_has_phenotype ?has_population_context ?np_uri ?pubkey
+WHERE {
+  ?_association_window
+  graph ?np_assertion {
+    ?association
+      biolink:aggregator_knowledge_source <"""
+    + KNOWLEDGE_PROVIDER
+    + """> ;
+      rdf:subject ?subject ;
+      rdf:predicate ?predicate ;
+      rdf:object ?object .
+    OPTIONAL {
+      ?association biolink:primary_knowledge_source ?primary_knowledge_source .
+    }
+    ?_provided_by_block
+    ?_publications_block
+    ?_label_block
+    ?_description_block
+    ?_population_block
+    {
+      ?subject a ?subject_category .
+      ?object a ?object_category .
+    } UNION {
+      ?subject biolink:category ?subject_category .
+      ?object biolink:category ?object_category .
+    }
+  }
+  ?_entity_filters
+  ?_prov_block
+  ?_np_index_filter
+  graph ?np_head {
+    ?np_uri np:hasAssertion ?np_assertion ;
+      np:hasProvenance ?np_prov .
+  }
+  graph npa:graph {
+    ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
+  }
+  ?_retraction_filter
+}"""
+)
+
+select_np_query = (
+    """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX biolink: <https://w3id.org/biolink/vocab/>
+PREFIX infores: <https://w3id.org/biolink/infores/>
+PREFIX np: <http://www.nanopub.org/nschema#>
+PREFIX npx: <http://purl.org/nanopub/x/>
+PREFIX npa: <http://purl.org/nanopub/admin/>
+SELECT DISTINCT ?association ?subject ?predicate ?object ?subject_category ?object_category
+    ?primary_knowledge_source ?primary_upstream_resource_ids ?primary_source_record_urls
+    ?supporting_data_source ?supporting_upstream_resource_ids ?supporting_source_record_urls
+    ?attribute_type ?attribute_provider ?attribute_value
+    ?qualifier ?qualifier_value
+    ?label ?description ?population_has_phenotype ?has_population_context ?provided_by ?publications ?np_uri ?pubkey
+WHERE {
+  ?_association_window
+  graph ?np_assertion {
+    ?association biolink:subject ?subject ;
+      biolink:predicate ?predicate ;
+      biolink:object ?object .
+    OPTIONAL {
+      ?association biolink:primary_knowledge_source ?pks .
+      ?pks biolink:resource_id ?primary_knowledge_source .
+      OPTIONAL { ?pks biolink:upstream_resource_ids ?primary_upstream_resource_ids . }
+      OPTIONAL { ?pks biolink:source_record_urls ?primary_source_record_urls . }
+    }
+    OPTIONAL {
+      ?association biolink:supporting_data_source ?sds .
+      ?sds biolink:resource_id ?supporting_data_source .
+      OPTIONAL { ?sds biolink:upstream_resource_ids ?supporting_upstream_resource_ids . }
+      OPTIONAL { ?sds biolink:source_record_urls ?supporting_source_record_urls . }
+    }
+    ?_attribute_block
+    ?_publications_block
+    ?_provided_by_block
+    ?_label_block
+    ?_description_block
+    ?_population_block
+    {
+      ?subject a ?subject_category .
+      ?object a ?object_category .
+    } UNION {
+      ?subject biolink:category ?subject_category .
+      ?object biolink:category ?object_category .
+    }
+    ?_qualifier_block
+  }
+  ?_entity_filters
+  ?_prov_block
+  ?_np_index_filter
+  graph ?np_head {
+    ?np_uri np:hasAssertion ?np_assertion ;
+      np:hasProvenance ?np_prov .
+  }
+  graph npa:graph {
+    ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
+  }
+  ?_retraction_filter
+}"""
+)
+
+# OPTIONAL blocks of the one-hop queries, dropped when the projection of the query does not need the properties
+# they provide (see app.trapi.projection): placeholder name -> (text, attribute types provided, QUALIFIERS,
+# or None for the attributes of any type)
+provided_by_block = """OPTIONAL {
+      ?association biolink:provided_by ?provided_by .
+    }"""
+publications_block = """OPTIONAL {
+      ?association biolink:publications ?publications .
+    }"""
+description_block = """OPTIONAL {
+      ?association biolink:description ?description .
+    }"""
+population_block = """OPTIONAL {
+      ?association biolink:has_population_context|biolink:population_context_qualifier [
+        rdfs:label ?has_population_context ;
+        biolink:has_phenotype ?population_has_phenotype ;
+      ] .
+    }"""
+population_attribute_types = ("biolink:population_context_qualifier", "biolink:has_phenotype")
+optional_blocks_old = {
+    "provided_by_block": (provided_by_block, ("biolink:provided_by",)),
+    "publications_block": (publications_block, ("biolink:publications",)),
+    "label_block": (
+        """OPTIONAL {
+      ?association rdfs:label ?label .
+    }""",
+        ("biolink:name",),
+    ),
+    "description_block": (description_block, ("biolink:description",)),
+    "population_block": (population_block, population_attribute_types),
+}
+optional_blocks = {
+    "attribute_block": (
+        """OPTIONAL {
+      ?association biolink:has_attribute [
+        biolink:has_attribute_type ?attribute_type ;
+        biolink:provided_by ?attribute_provider ;
+        biolink:value ?attribute_value
+      ]
+    }""",
+        None,
+    ),
+    "publications_block": (publications_block, ("biolink:publications",)),
+    "provided_by_block": (provided_by_block, ("biolink:provided_by",)),
+    "label_block": (
+        """OPTIONAL {
+      ?association biolink:name ?label .
+    }""",
+        ("biolink:name",),
+    ),
+    "description_block": (description_block, ("biolink:description",)),
+    "population_block": (population_block, population_attribute_types),
+    "qualifier_block": (
+        """VALUES ?qualifier {
+        biolink:qualified_predicate biolink:subject_aspect_qualifier biolink:object_aspect_qualifier biolink:subject_direction_qualifier biolink:object_direction_qualifier
+        biolink:subject_part_qualifier biolink:object_part_qualifier biolink:subject_context_qualifier biolink:subject_part_qualifier biolink:object_part_qualifier biolink:object_context_qualifier
+        biolink:population_context_qualifier biolink:temporal_context_qualifier biolink:form_or_variant_qualifier
+        biolink:derivative_qualifier biolink:statement_qualifier
+        biolink:frequency_qualifier biolink:severity_qualifier biolink:sex_qualifier biolink:onset_qualifier
+    }
+    OPTIONAL { ?association ?qualifier ?qualifier_value . }""",
+        QUALIFIERS,
+    ),
+}
+
+# Subqueries selecting the window of distinct associations to retrieve (LIMIT/OFFSET),
+# the full details of these associations are then retrieved by the main query
+association_window_block = """{
+    SELECT DISTINCT ?association WHERE {
+      ?_values
+      graph ?np_assertion {
+        ?_association_pattern
+        {
+          ?subject a ?subject_category .
+          ?object a ?object_category .
+        } UNION {
+          ?subject biolink:category ?subject_category .
+          ?object biolink:category ?object_category .
+        }
+        ?_constraint_filters
+      }
+      ?_prov_block
+      ?_np_index_filter
+      graph ?np_head {
+        ?np_uri np:hasAssertion ?np_assertion ;
+          np:hasProvenance ?np_prov .
+      }
+      graph npa:graph {
+        ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
+      }
+      ?_retraction_filter
+    }
+    ORDER BY ?association
+    LIMIT ?_limit OFFSET ?_offset
+  }"""
+
+association_pattern_old = f"""?association biolink:aggregator_knowledge_source <{KNOWLEDGE_PROVIDER}> ;
+          rdf:subject ?subject ;
+          rdf:predicate ?predicate ;
+          rdf:object ?object ."""
+
+association_pattern = """?association biolink:subject ?subject ;
+          biolink:predicate ?predicate ;
+          biolink:object ?object ."""
+
+association_window_old = association_window_block.replace("?_association_pattern", association_pattern_old)
+association_window = association_window_block.replace("?_association_pattern", association_pattern)
+
+# Alternative to the main queries for TRAPI_DETAILS_MODE="batched": the core query only retrieves the edges,
+# their multi-valued properties are then retrieved by batched details queries, one UNION branch per property,
+# to avoid the cartesian product of the OPTIONAL blocks
+select_core_query_block = """PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX biolink: <https://w3id.org/biolink/vocab/>
+PREFIX infores: <https://w3id.org/biolink/infores/>
+PREFIX np: <http://www.nanopub.org/nschema#>
+PREFIX npx: <http://purl.org/nanopub/x/>
+PREFIX npa: <http://purl.org/nanopub/admin/>
+SELECT DISTINCT ?association ?subject ?predicate ?object ?subject_category ?object_category ?np_uri ?np_assertion
+    ?pubkey
+WHERE {
+  ?_association_window
+  graph ?np_assertion {
+    ?_association_pattern
+    {
+      ?subject a ?subject_category .
+      ?object a ?object_category .
+    } UNION {
+      ?subject biolink:category ?subject_category .
+      ?object biolink:category ?object_category .
+    }
+  }
+  ?_entity_filters
+  ?_prov_block
+  ?_np_index_filter
+  graph ?np_head {
+    ?np_uri np:hasAssertion ?np_assertion ;
+      np:hasProvenance ?np_prov .
+  }
+  graph npa:graph {
+    ?np_uri npa:hasValidSignatureForPublicKey ?pubkey .
+  }
+  ?_retraction_filter
+}"""
+
+select_core_query_old = select_core_query_block.replace("?_association_pattern", association_pattern_old)
+select_core_query = select_core_query_block.replace("?_association_pattern", association_pattern)
+
+select_details_query_old = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX biolink: <https://w3id.org/biolink/vocab/>
+SELECT DISTINCT ?association ?primary_knowledge_source ?provided_by ?publications
+    ?label ?description ?population_has_phenotype ?has_population_context
+WHERE {
+  VALUES (?association ?np_assertion) { ?_associations }
+  graph ?np_assertion {
+    {
+      ?association biolink:primary_knowledge_source ?primary_knowledge_source .
+    } UNION {
+      ?association biolink:provided_by ?provided_by .
+    } UNION {
+      ?association biolink:publications ?publications .
+    } UNION {
+      ?association rdfs:label ?label .
+    } UNION {
+      ?association biolink:description ?description .
+    } UNION {
+      ?association biolink:has_population_context|biolink:population_context_qualifier [
+        rdfs:label ?has_population_context ;
+        biolink:has_phenotype ?population_has_phenotype ;
+      ] .
+    }
+  }
+}"""
+
+select_details_query = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX biolink: <https://w3id.org/biolink/vocab/>
+SELECT DISTINCT ?association ?primary_knowledge_source ?primary_upstream_resource_ids ?primary_source_record_urls
+    ?supporting_data_source ?supporting_upstream_resource_ids ?supporting_source_record_urls
+    ?attribute_type ?attribute_provider ?attribute_value
+    ?qualifier ?qualifier_value
+    ?label ?description ?population_has_phenotype ?has_population_context ?provided_by ?publications
+WHERE {
+  VALUES (?association ?np_assertion) { ?_associations }
+  graph ?np_assertion {
+    {
+      ?association biolink:primary_knowledge_source ?pks .
+      ?pks biolink:resource_id ?primary_knowledge_source .
+      OPTIONAL { ?pks biolink:upstream_resource_ids ?primary_upstream_resource_ids . }
+      OPTIONAL { ?pks biolink:source_record_urls ?primary_source_record_urls . }
+    } UNION {
+      ?association biolink:supporting_data_source ?sds .
+      ?sds biolink:resource_id ?supporting_data_source .
+      OPTIONAL { ?sds biolink:upstream_resource_ids ?supporting_upstream_resource_ids . }
+      OPTIONAL { ?sds biolink:source_record_urls ?supporting_source_record_urls . }
+    } UNION {
+      ?association biolink:has_attribute [
+        biolink:has_attribute_type ?attribute_type ;
+        biolink:provided_by ?attribute_provider ;
+        biolink:value ?attribute_value
+      ]
+    } UNION {
+      ?association biolink:publications ?publications .
+    } UNION {
+      ?association biolink:provided_by ?provided_by .
+    } UNION {
+      ?association biolink:name ?label .
+    } UNION {
+      ?association biolink:description ?description .
+    } UNION {
+      ?association biolink:has_population_context|biolink:population_context_qualifier [
+        rdfs:label ?has_population_context ;
+        biolink:has_phenotype ?population_has_phenotype ;
+      ] .
+    } UNION {
+      VALUES ?qualifier {
+        biolink:qualified_predicate biolink:subject_aspect_qualifier biolink:object_aspect_qualifier
+        biolink:subject_direction_qualifier biolink:object_direction_qualifier
+        biolink:subject_part_qualifier biolink:object_part_qualifier biolink:subject_context_qualifier
+        biolink:object_context_qualifier biolink:population_context_qualifier biolink:temporal_context_qualifier
+        biolink:form_or_variant_qualifier biolink:derivative_qualifier biolink:statement_qualifier
+        biolink:frequency_qualifier biolink:severity_qualifier biolink:sex_qualifier biolink:onset_qualifier
+      }
+      ?association ?qualifier ?qualifier_value .
+    }
+  }
+}"""
+
+# Templates parsed once, the full queries are rendered with the constraints as VALUES blocks
+one_hop_templates = [
+    OneHopTemplate(select_np_query_old, association_window_old, optional_blocks_old),
+    OneHopTemplate(select_np_query, association_window, optional_blocks),
+]
+# Core and details templates for TRAPI_DETAILS_MODE="batched", in the same order as one_hop_templates
+one_hop_core_templates = [
+    OneHopTemplate(select_core_query_old, association_window_old),
+    OneHopTemplate(select_core_query, association_window),
+]
+details_templates = [
+    QueryTemplate(select_details_query_old),
+    QueryTemplate(select_details_query),
+]
@@ -0,0 +1,82 @@
+"""Serialize TRAPI responses in chunks, instead of in a single JSON document
+
+The TRAPI response is still answered as a whole dict before being serialized: the memory of the answer is not
+bounded by the stream. Only the serialized response is never held entirely in memory, as each chunk is sent
+before the next one is serialized, and the nodes, edges and results are released once serialized.
+"""
+from datetime import datetime
+
+import orjson
+from app.config import logger
+
+# Number of nodes, edges or results serialized in each chunk
+CHUNK_SIZE = 1000
+
+
+def iter_json_object(obj, chunk_size=CHUNK_SIZE):
+    """Serialize the members of a JSON object in chunks, and drop them from the dict once serialized"""
+    chunk = []
+    while obj:
+        key, value = obj.popitem()
+        chunk.append(orjson.dumps(key) + b":" + orjson.dumps(value))
+        if len(chunk) >= chunk_size:
+            yield b",".join(chunk) + (b"," if obj else b"")
+            chunk = []
+    if chunk:
+        yield b",".join(chunk)
+
+
+def iter_json_array(array, chunk_size=CHUNK_SIZE):
+    """Serialize the items of a JSON array in chunks, and drop them from the list once serialized"""
+    # Replace each serialized chunk by None to release its items while the rest is streamed
+    for start in range(0, len(array), chunk_size):
+        chunk = array[start : start + chunk_size]
+        array[start : start + chunk_size] = [None] * len(chunk)
+        yield (b"," if start else b"") + orjson.dumps(chunk)[1:-1]
+
+
+def iter_trapi_response(reasoner_query, answer_query, chunk_size=CHUNK_SIZE):
+    """Stream the TRAPI response envelope, then the knowledge graph nodes and edges, then the results
+
+    The query graph is sent before the query is executed, so the client (and proxies) receive a first byte while
+    the query runs, the rest waits for the whole answer. The query should be checked before
+    (see reasonerapi_parser.check_reasoner_query), as the status code is already sent.
+    If answering the query fails, the response is completed with no results, an error status and log.
+
+    :param reasoner_query: TRAPI query
+    :param answer_query: Function taking the TRAPI query and returning the TRAPI response as a dict
+    :return: Iterator over the bytes of the JSON response
+    """
+    yield b'{"message":{"query_graph":' + orjson.dumps(reasoner_query["message"]["query_graph"])
+    try:
+        response = answer_query(reasoner_query)
+    except Exception as e:
+        logger.error(f"Error while answering a streamed TRAPI query: {e}")
+        response = {
+            "message": {},
+            "status": "Error",
+            "description": f"The query failed: {e}",
+            "logs": [
+                {
+                    "timestamp": datetime.now().isoformat(),
+                    "level": "ERROR",
+                    "code": None,
+                    "message": f"The query failed: {e}",
+                }
+            ],
+        }
+    message = response.pop("message")
+    kg = message.get("knowledge_graph") or {"nodes": {}, "edges": {}}
+
+    yield b',"knowledge_graph":{"nodes":{'
+    yield from iter_json_object(kg["nodes"], chunk_size)
+    yield b'},"edges":{'
+    yield from iter_json_object(kg["edges"], chunk_size)
+    yield b'}},"results":['
+    yield from iter_json_array(message.get("results") or [], chunk_size)
+    yield b"]}"
+
+    # Remaining fields of the envelope (status, logs, versions...)
+    for key, value in response.items():
+        yield b"," + orjson.dumps(key) + b":" + orjson.dumps(value)
+    yield b"}"
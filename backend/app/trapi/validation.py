@@ -0,0 +1,72 @@
+"""Sampled validation of TRAPI requests and responses against the reasoner-pydantic models
+
+/query handles requests and responses as plain dicts, building the pydantic models for large knowledge graphs
+costs more than answering the query. One in TRAPI_VALIDATION_SAMPLE_RATE queries (all of them in DEV_MODE)
+is validated, invalid messages are logged and counted, but still processed.
+The structure the query engine relies on (the message, its query graph, and the query_options) is always checked.
+"""
+import itertools
+
+from app.config import logger, settings
+from app.metrics import counter
+from pydantic import ValidationError
+from reasoner_pydantic import Query, Response
+
+query_counter = itertools.count()
+validation_failures = counter(
+    "trapi_validation_failures_total", "Number of sampled TRAPI requests or responses that are not valid"
+)
+
+
+def check_query(reasoner_query):
+    """Check the structure of a TRAPI query the query engine relies on, and get its query graph
+
+    :raise ValueError: if the query has no message with a query graph, if its nodes, edges or query_options
+        are not objects, or if it has no edges
+    """
+    message = reasoner_query.get("message") if isinstance(reasoner_query, dict) else None
+    query_graph = message.get("query_graph") if isinstance(message, dict) else None
+    if not isinstance(query_graph, dict) or not isinstance(query_graph.get("nodes"), dict):
+        raise ValueError("The query must contain a message with a query_graph")
+    edges = query_graph.get("edges")
+    if not edges:
+        raise ValueError("No edges")
+    if not isinstance(edges, dict) or not all(
+        isinstance(item, dict) for item in [*query_graph["nodes"].values(), *edges.values()]
+    ):
+        raise ValueError("The nodes and edges of the query graph should be objects")
+    if not isinstance(reasoner_query.get("query_options") or {}, dict):
+        raise ValueError("The query_options should be an object")
+    return query_graph
+
+
+def should_validate():
+    """Decide if the current query is part of the validated sample"""
+    if settings.DEV_MODE:
+        return True
+    rate = settings.TRAPI_VALIDATION_SAMPLE_RATE
+    return rate > 0 and next(query_counter) % rate == 0
+
+
+def validate_trapi(data, model):
+    """Validate a TRAPI message, log the errors
+
+    :param data: TRAPI request or response as a dict
+    :param model: reasoner-pydantic model to validate against
+    :return: True if the message is valid
+    """
+    try:
+        model.parse_obj(data)
+        return True
+    except ValidationError as e:
+        validation_failures.inc()
+        logger.warning(f"Invalid TRAPI {model.__name__}: {e}")
+        return False
+
+
+def validate_query(reasoner_query):
+    return validate_trapi(reasoner_query, Query)
+
+
+def validate_response(reasoner_response):
+    return validate_trapi(reasoner_response, Response)
@@ -0,0 +1,64 @@
+"""TRAPI workflow operations supported by the query engine
+
+A workflow is a list of operations applied to the message of the query. It must start with lookup, which answers
+the query graph. filter_results_top_n is applied inside the engine: it limits the number of results (like
+query_options.n_results), so the edges of the dropped results are never retrieved nor assembled.
+filter_kgraph_orphans removes the nodes and edges of the knowledge graph which are not bound in the results.
+"""
+
+LOOKUP = "lookup"
+FILTER_RESULTS_TOP_N = "filter_results_top_n"
+FILTER_KGRAPH_ORPHANS = "filter_kgraph_orphans"
+SUPPORTED_OPERATIONS = [LOOKUP, FILTER_RESULTS_TOP_N, FILTER_KGRAPH_ORPHANS]
+
+
+def parse_workflow(reasoner_query):
+    """Get how to execute the workflow of a TRAPI query
+
+    :return: Tuple with the maximum number of results (None if not limited),
+        and whether the orphans of the knowledge graph should be removed
+    :raise ValueError: if the workflow contains operations which are not supported, or invalid parameters
+    """
+    workflow = reasoner_query.get("workflow")
+    if workflow is None:
+        return None, False
+    if not isinstance(workflow, list) or not all(isinstance(operation, dict) for operation in workflow):
+        raise ValueError("The workflow should be a list of operations")
+    operation_ids = [operation.get("id") for operation in workflow]
+    unsupported = [operation_id for operation_id in operation_ids if operation_id not in SUPPORTED_OPERATIONS]
+    if unsupported:
+        raise ValueError(
+            f"Unsupported workflow operations: {', '.join(map(str, unsupported))}, "
+            f"the supported operations are {', '.join(SUPPORTED_OPERATIONS)}"
+        )
+    if operation_ids[:1] != [LOOKUP] or LOOKUP in operation_ids[1:]:
+        raise ValueError("The workflow should start with the lookup operation, and contain it once")
+    max_results = None
+    for operation in workflow:
+        if operation["id"] == FILTER_RESULTS_TOP_N:
+            value = (operation.get("parameters") or {}).get("max_results")
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError("The max_results parameter of filter_results_top_n should be a positive integer")
+            # Truncations of the results compose, the other operations do not change the results
+            max_results = value if max_results is None else min(max_results, value)
+    return max_results, FILTER_KGRAPH_ORPHANS in operation_ids
+
+
+def filter_kgraph_orphans(knowledge_graph, results):
+    """Get the knowledge graph without the nodes and edges which are not bound in the results"""
+    edge_ids = set()
+    node_ids = set()
+    for result in results:
+        for bindings in result["node_bindings"].values():
+            node_ids.update(binding["id"] for binding in bindings)
+        for analysis in result.get("analyses") or []:
+            for bindings in analysis["edge_bindings"].values():
+                edge_ids.update(binding["id"] for binding in bindings)
+    edges = {edge_id: edge for edge_id, edge in knowledge_graph["edges"].items() if edge_id in edge_ids}
+    for edge in edges.values():
+        node_ids.add(edge["subject"])
+        node_ids.add(edge["object"])
+    return {
+        "nodes": {node_id: node for node_id, node in knowledge_graph["nodes"].items() if node_id in node_ids},
+        "edges": edges,
+    }
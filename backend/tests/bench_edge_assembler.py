@@ -0,0 +1,176 @@
+"""Benchmark the edge assembler against the previous per-row loop, on 20k SPARQL result rows
+
+The rows reproduce the shape of the TRAPI templates results: each association returns the cartesian product
+of its sources, attributes, publications and qualifiers.
+
+Run from the backend folder (not collected by pytest):
+
+    python -m tests.bench_edge_assembler
+"""
+import itertools
+import time
+import tracemalloc
+
+from app.trapi.edge_assembler import EdgeAssembler
+
+PREFIXES = {
+    "https://w3id.org/biolink/vocab/": "biolink",
+    "https://w3id.org/biolink/infores/": "infores",
+    "http://identifiers.org/drugbank/": "DRUGBANK",
+    "http://purl.obolibrary.org/obo/MONDO_": "MONDO",
+    "http://www.ncbi.nlm.nih.gov/pubmed/": "PMID",
+}
+N_ASSOCIATIONS = 500
+BIOLINK = "https://w3id.org/biolink/vocab/"
+
+
+def resolve_uri(uri):
+    for ns, prefix in PREFIXES.items():
+        if uri.startswith(ns):
+            return uri.replace(ns, prefix + ":")
+    return uri
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def generate_rows(n_associations=N_ASSOCIATIONS):
+    """Generate 40 rows per association: 2 sources x 5 attributes x 2 publications x 2 qualifiers"""
+    rows = []
+    for i in range(n_associations):
+        core = {
+            "association": uri(f"http://purl.org/np/RA{i}#association"),
+            "subject": uri(f"http://identifiers.org/drugbank/DB{i % 100:05d}"),
+            "predicate": uri(BIOLINK + "treats"),
+            "object": uri(f"http://purl.obolibrary.org/obo/MONDO_{i % 50:07d}"),
+            "subject_category": uri(BIOLINK + "Drug"),
+            "object_category": uri(BIOLINK + "Disease"),
+            "np_uri": uri(f"http://purl.org/np/RA{i}"),
+            "label": {"type": "literal", "value": f"Association {i}"},
+        }
+        for source, attribute, publication, qualifier in itertools.product(range(2), range(5), range(2), range(2)):
+            rows.append({
+                **core,
+                "primary_knowledge_source": uri("https://w3id.org/biolink/infores/knowledge-collaboratory"),
+                "primary_upstream_resource_ids": uri(f"https://w3id.org/biolink/infores/upstream-{source}"),
+                "attribute_type": uri(BIOLINK + f"attribute_{attribute}"),
+                "attribute_value": {"type": "literal", "value": f"value {attribute}"},
+                "attribute_provider": uri("https://w3id.org/biolink/infores/knowledge-collaboratory"),
+                "publications": uri(f"http://www.ncbi.nlm.nih.gov/pubmed/{i * 10 + publication}"),
+                "qualifier": uri(BIOLINK + ["subject_aspect_qualifier", "object_aspect_qualifier"][qualifier]),
+                "qualifier_value": uri(BIOLINK + "activity"),
+            })
+    return rows
+
+
+def legacy_assemble(rows, edge_id="e0", subject_node_id="n0", object_node_id="n1"):
+    """Previous per-row loop: nested dicts, deduplication with any() scans, URIs resolved on every row"""
+    kg = {"nodes": {}, "edges": {}}
+    results = []
+    for row in rows:
+        edge_uri = row["association"]["value"]
+        add_binding = False
+        if edge_uri not in kg["edges"]:
+            add_binding = True
+            kg["edges"][edge_uri] = {
+                "predicate": [resolve_uri(row["predicate"]["value"])],
+                "subject": resolve_uri(row["subject"]["value"]),
+                "object": resolve_uri(row["object"]["value"]),
+                "attributes": [],
+                "qualifiers": [],
+                "sources": [],
+            }
+        edge = kg["edges"][edge_uri]
+        if "primary_knowledge_source" in row:
+            new_src = {
+                "resource_id": resolve_uri(row["primary_knowledge_source"]["value"]),
+                "resource_role": "primary_knowledge_source",
+            }
+            if "primary_upstream_resource_ids" in row:
+                new_src["upstream_resource_ids"] = [resolve_uri(row["primary_upstream_resource_ids"]["value"])]
+            if not any(src for src in edge["sources"] if src["resource_id"] == new_src["resource_id"]):
+                edge["sources"].append(new_src)
+        if "attribute_type" in row:
+            new_attribute = {
+                "attribute_type_id": resolve_uri(row["attribute_type"]["value"]),
+                "value": resolve_uri(row["attribute_value"]["value"]),
+                "attribute_source": resolve_uri(row["attribute_provider"]["value"]),
+            }
+            if not any(
+                attribute for attribute in edge["attributes"]
+                if attribute["attribute_type_id"] == new_attribute["attribute_type_id"]
+                and attribute["value"] == new_attribute["value"]
+            ):
+                edge["attributes"].append(new_attribute)
+        if "qualifier_value" in row:
+            new_qualifier = {
+                "qualifier_type_id": resolve_uri(row["qualifier"]["value"]),
+                "qualifier_value": resolve_uri(row["qualifier_value"]["value"]),
+            }
+            if not any(
+                qualifier for qualifier in edge["qualifiers"]
+                if qualifier["qualifier_type_id"] == new_qualifier["qualifier_type_id"]
+                and qualifier["qualifier_value"] == new_qualifier["qualifier_value"]
+            ):
+                edge["qualifiers"].append(new_qualifier)
+        if "label" in row:
+            edge["attributes"].append(
+                {"attribute_type_id": "biolink:name", "value": resolve_uri(row["label"]["value"])}
+            )
+        if "publications" in row:
+            edge["attributes"].append(
+                {"attribute_type_id": "biolink:publications", "value": resolve_uri(row["publications"]["value"])}
+            )
+        kg["nodes"][resolve_uri(row["subject"]["value"])] = {
+            "categories": [resolve_uri(row["subject_category"]["value"])]
+        }
+        kg["nodes"][resolve_uri(row["object"]["value"])] = {
+            "categories": [resolve_uri(row["object_category"]["value"])]
+        }
+        if add_binding:
+            results.append({
+                "node_bindings": {
+                    subject_node_id: [{"id": resolve_uri(row["subject"]["value"])}],
+                    object_node_id: [{"id": resolve_uri(row["object"]["value"])}],
+                },
+                "analyses": [{
+                    "resource_id": "infores:knowledge-collaboratory",
+                    "edge_bindings": {edge_id: [{"id": edge_uri}]},
+                }],
+            })
+    return kg, results
+
+
+def assemble(rows):
+    assembler = EdgeAssembler("e0", "n0", "n1", resolve_uri)
+    assembler.add_rows(rows)
+    return assembler.to_trapi()
+
+
+def measure(name, function, rows, repeat=5):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(rows)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    kg, _results = function(rows)
+    _current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    n_attributes = sum(len(edge["attributes"]) for edge in kg["edges"].values())
+    print(
+        f"{name:>10}: {min(durations) * 1000:8.1f} ms | peak {peak / 1024:8.0f} KiB | "
+        f"{blocks:7d} live blocks | {len(kg['edges'])} edges, {n_attributes} attributes"
+    )
+    return min(durations), peak
+
+
+if __name__ == "__main__":
+    rows = generate_rows()
+    print(f"Assembling {len(rows)} rows for {N_ASSOCIATIONS} associations")
+    legacy_time, legacy_peak = measure("legacy", legacy_assemble, rows)
+    time_, peak = measure("assembler", assemble, rows)
+    print(f"Speedup: x{legacy_time / time_:.1f}, peak memory: x{legacy_peak / peak:.1f} lower")
@@ -0,0 +1,71 @@
+"""Benchmark the incremental SPARQL JSON parser against loading the whole response, on 20k result rows
+
+Both feed the rows to the edge assembler. The response is read in 64 KiB chunks, like from the SPARQL endpoint.
+
+Run from the backend folder (not collected by pytest):
+
+    python -m tests.bench_sparql_json
+"""
+import time
+import tracemalloc
+
+import orjson
+from app.trapi.edge_assembler import EdgeAssembler
+from app.trapi.sparql_json import iter_bindings
+
+from tests.bench_edge_assembler import N_ASSOCIATIONS, generate_rows, resolve_uri
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(body):
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start : start + CHUNK_SIZE]
+
+
+def load_all(body):
+    """Previous behaviour: join the response, parse it, then assemble the rows"""
+    assembler = EdgeAssembler("e0", "n0", "n1", resolve_uri)
+    rows = orjson.loads(b"".join(iter_chunks(body)))["results"]["bindings"]
+    assembler.add_rows(rows)
+    return assembler
+
+
+def stream(body):
+    """Assemble the rows as they are parsed from the chunks of the response"""
+    assembler = EdgeAssembler("e0", "n0", "n1", resolve_uri)
+    assembler.add_rows(iter_bindings(iter_chunks(body)))
+    return assembler
+
+
+def time_to_first_row(body, parse):
+    start = time.perf_counter()
+    next(iter(parse(body)))
+    return time.perf_counter() - start
+
+
+def measure(name, function, body, repeat=3):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(body)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(body)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {min(durations) * 1000:8.1f} ms | peak {peak / 1024:8.0f} KiB")
+    return peak
+
+
+if __name__ == "__main__":
+    rows = generate_rows()
+    body = orjson.dumps({"head": {"vars": list(rows[0].keys())}, "results": {"bindings": rows}})
+    del rows
+    print(f"Parsing {len(body) / 1024 / 1024:.1f} MiB of SPARQL results for {N_ASSOCIATIONS} associations")
+    load_peak = measure("load all", load_all, body)
+    stream_peak = measure("stream", stream, body)
+    print(f"Peak memory: x{load_peak / stream_peak:.1f} lower")
+    first_load = time_to_first_row(body, lambda body: orjson.loads(b"".join(iter_chunks(body)))["results"]["bindings"])
+    first_stream = time_to_first_row(body, lambda body: iter_bindings(iter_chunks(body)))
+    print(f"Time to the first row: {first_load * 1000:.1f} ms loading all, {first_stream * 1000:.2f} ms streaming")
@@ -60,3 +60,199 @@ def test_trapi_empty_response():
     )
     # check_trapi_compliance(response)
     assert len(response.json()["message"]["results"]) == 0
+
+
+def test_trapi_multihop():
+    """Test a 2 hops query, decomposed in one-hop queries and joined by the planner"""
+    reasoner_query = {
+        "message": {
+            "query_graph": {
+                "edges": {
+                    "e0": {
+                        "subject": "n0",
+                        "object": "n1",
+                        "predicates": ["biolink:treats"],
+                    },
+                    "e1": {
+                        "subject": "n2",
+                        "object": "n1",
+                        "predicates": ["biolink:treats"],
+                    },
+                },
+                "nodes": {
+                    "n0": {"ids": ["DRUGBANK:DB00313"], "categories": ["biolink:Drug"]},
+                    "n1": {"categories": ["biolink:Disease"]},
+                    "n2": {"categories": ["biolink:Drug"]},
+                },
+            }
+        },
+        "query_options": {"n_results": 5},
+    }
+    response = client.post(
+        "/query",
+        data=json.dumps(reasoner_query),
+        headers={"Content-Type": "application/json"},
+    )
+    message = response.json()["message"]
+    assert 0 < len(message["results"]) <= 5
+    for result in message["results"]:
+        assert set(result["node_bindings"].keys()) == {"n0", "n1", "n2"}
+        assert set(result["analyses"][0]["edge_bindings"].keys()) == {"e0", "e1"}
+
+
+def test_post_trapi_stream():
+    """Test the streamed TRAPI response is the same JSON as the regular response"""
+    with open("tests/queries/trapi_drugbank_limit1.json") as f:
+        reasoner_query = f.read()
+    response = client.post(
+        "/query?stream=true", data=reasoner_query, headers={"Content-Type": "application/json"}
+    )
+    assert response.headers["content-type"] == "application/json"
+    message = response.json()["message"]
+    assert len(message["knowledge_graph"]["edges"]) == 1
+    assert len(message["results"]) == 1
+
+
+def test_trapi_pagination():
+    """Test getting the next page of results with the cursor returned in the query_options"""
+    reasoner_query = {
+        "message": {
+            "query_graph": {
+                "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:treats"]}},
+                "nodes": {
+                    "n0": {"categories": ["biolink:Drug"]},
+                    "n1": {"categories": ["biolink:Disease"]},
+                },
+            }
+        },
+        "query_options": {"n_results": 2},
+    }
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    first_page = response.json()
+    assert len(first_page["message"]["knowledge_graph"]["edges"]) == 2
+    assert "next_cursor" in first_page["query_options"]
+
+    reasoner_query["query_options"]["cursor"] = first_page["query_options"]["next_cursor"]
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    second_page = response.json()
+    assert len(second_page["message"]["knowledge_graph"]["edges"]) == 2
+    assert not set(first_page["message"]["knowledge_graph"]["edges"]) & set(second_page["message"]["knowledge_graph"]["edges"])
+
+
+def test_trapi_batched_details(monkeypatch):
+    """Test retrieving the edge properties with batched details queries returns the same edges"""
+    with open("tests/queries/trapi_drugbank_limit1.json") as f:
+        reasoner_query = f.read()
+    response = client.post("/query", data=reasoner_query, headers={"Content-Type": "application/json"})
+    optional_edges = response.json()["message"]["knowledge_graph"]["edges"]
+
+    monkeypatch.setattr(settings, "TRAPI_DETAILS_MODE", "batched")
+    response = client.post("/query", data=reasoner_query, headers={"Content-Type": "application/json"})
+    batched_edges = response.json()["message"]["knowledge_graph"]["edges"]
+    assert batched_edges.keys() == optional_edges.keys()
+    for edge_id, edge in batched_edges.items():
+        assert {s["resource_id"] for s in edge["sources"]} == {s["resource_id"] for s in optional_edges[edge_id]["sources"]}
+
+
+def test_trapi_batch_query():
+    """Test a batch of compatible one-hop queries returns the same results as the queries sent one by one"""
+    reasoner_queries = [
+        {
+            "message": {
+                "query_graph": {
+                    "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:treats"]}},
+                    "nodes": {"n0": {"ids": [drug_id]}, "n1": {"categories": ["biolink:Disease"]}},
+                }
+            }
+        }
+        for drug_id in ("DRUGBANK:DB00394", "DRUGBANK:DB00002", "DRUGBANK:DB00313")
+    ]
+    response = client.post(
+        "/batch_query", data=json.dumps(reasoner_queries), headers={"Content-Type": "application/json"}
+    )
+    batch_responses = response.json()
+    assert len(batch_responses) == len(reasoner_queries)
+    for reasoner_query, batch_response in zip(reasoner_queries, batch_responses):
+        response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+        edges = response.json()["message"]["knowledge_graph"]["edges"]
+        assert batch_response["message"]["knowledge_graph"]["edges"].keys() == edges.keys()
+
+
+def test_trapi_asyncquery(monkeypatch):
+    """Test an asynchronous query is queued, and its status can be retrieved"""
+    with open("tests/queries/trapi_drugbank_limit1.json") as f:
+        reasoner_query = json.load(f)
+    reasoner_query["callback"] = "http://localhost/callback"
+    response = client.post("/asyncquery", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
+    monkeypatch.setattr(settings, "ASYNC_QUERY_CALLBACK_HOSTS", ["localhost"])
+    response = client.post("/asyncquery", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    job_id = response.json()["job_id"]
+
+    response = client.get(f"/asyncquery_status/{job_id}")
+    assert response.json()["status"] in ("Queued", "Running", "Completed", "Failed")
+    assert client.get("/asyncquery_status/unknown").status_code == 404
+
+
+def test_trapi_workflow_and_projection():
+    """Test the results are limited by filter_results_top_n, and only the requested attributes are returned"""
+    with open("tests/queries/trapi_anydrugdisease_limitno.json") as f:
+        reasoner_query = json.load(f)
+    reasoner_query["workflow"] = [
+        {"id": "lookup"},
+        {"id": "filter_results_top_n", "parameters": {"max_results": 2}},
+        {"id": "filter_kgraph_orphans"},
+    ]
+    reasoner_query["query_options"] = {"attributes": ["biolink:publications"], "qualifiers": False}
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    message = response.json()["message"]
+    assert len(message["results"]) == 2
+    for edge in message["knowledge_graph"]["edges"].values():
+        assert {a["attribute_type_id"] for a in edge["attributes"]} <= {"biolink:publications"}
+        assert not edge["qualifiers"]
+
+    reasoner_query["workflow"] = [{"id": "lookup"}, {"id": "sort_results_score"}]
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
+
+def test_trapi_constraints():
+    """Test only the edges matching the attribute constraints of the query graph edge are returned"""
+    with open("tests/queries/trapi_anydrugdisease_limitno.json") as f:
+        reasoner_query = json.load(f)
+    edge = next(iter(reasoner_query["message"]["query_graph"]["edges"].values()))
+    edge["attribute_constraints"] = [
+        {"id": "biolink:publications", "name": "publications", "operator": "matches", "value": "^PMID:"}
+    ]
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    for kg_edge in response.json()["message"]["knowledge_graph"]["edges"].values():
+        publications = [a["value"] for a in kg_edge["attributes"] if a["attribute_type_id"] == "biolink:publications"]
+        assert any(str(publication).startswith("PMID:") for publication in publications)
+
+    edge["attribute_constraints"] = [
+        {"id": "biolink:publications", "name": "publications", "operator": "~", "value": 1}
+    ]
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
+
+def test_trapi_biolink_descendants():
+    """Test the categories of the query graph nodes also match their BioLink descendants"""
+    with open("tests/queries/trapi_anydrugdisease_limitno.json") as f:
+        reasoner_query = json.load(f)
+    reasoner_query["message"]["query_graph"]["nodes"]["n0"]["categories"] = ["biolink:ChemicalEntity"]
+    response = client.post("/query", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"})
+    nodes = response.json()["message"]["knowledge_graph"]["nodes"]
+    assert any("biolink:Drug" in node["categories"] for node in nodes.values())
+
+
+def test_trapi_stream_invalid_query():
+    """Test a streamed query which cannot be answered is rejected before streaming"""
+    with open("tests/queries/trapi_drugbank_limit1.json") as f:
+        reasoner_query = json.load(f)
+    reasoner_query["query_options"] = {"cursor": "invalid"}
+    response = client.post(
+        "/query?stream=true", data=json.dumps(reasoner_query), headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 400
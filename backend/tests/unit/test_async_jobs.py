@@ -0,0 +1,152 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from app.config import settings
+from app.trapi import async_jobs
+from app.trapi.async_jobs import COMPLETED, QUEUED, RUNNING, check_callback_url
+
+QUERY = {"message": {"query_graph": {"nodes": {}, "edges": {}}}, "callback": "https://example.org/callback"}
+
+
+@pytest.mark.parametrize(
+    "callback",
+    [
+        "ftp://93.184.216.34/callback",
+        "http:///callback",
+        "http://localhost:8000/callback",
+        "http://127.0.0.1/callback",
+        "http://10.0.0.1/callback",
+        "http://192.168.1.10/callback",
+        "http://169.254.169.254/latest/meta-data",
+        "http://0.0.0.0/callback",
+        "http://224.0.0.1/callback",
+        "http://[::1]/callback",
+        "http://[fe80::1]/callback",
+        "http://[::ffff:127.0.0.1]/callback",
+    ],
+)
+def test_reject_private_callbacks(callback):
+    with pytest.raises(ValueError):
+        check_callback_url(callback)
+
+
+def test_callback_hosts(monkeypatch):
+    check_callback_url("https://93.184.216.34/callback")
+    monkeypatch.setattr(settings, "ASYNC_QUERY_CALLBACK_HOSTS", ["Callback.Internal"])
+    check_callback_url("http://callback.internal:8080/callback")
+    with pytest.raises(ValueError):
+        check_callback_url("https://93.184.216.34/callback")
+
+
+def test_private_callback_not_sent(monkeypatch):
+    """Test the response is not sent to a callback resolving to a private address since the job was submitted"""
+    posted = []
+    monkeypatch.setattr(async_jobs.requests, "post", lambda *args, **kwargs: posted.append(args))
+    assert not async_jobs.send_callback("http://127.0.0.1/callback", {})
+    assert posted == []
+
+
+def test_callback_sent_to_the_checked_address(monkeypatch):
+    """Test the response is sent to the address checked, without resolving the host again"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.headers["Host"], self.path, json.loads(body)))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    port = server.server_address[1]
+    # The host resolved to this address when checked, and is not resolved again
+    monkeypatch.setattr(async_jobs, "check_callback_url", lambda callback: ["127.0.0.1"])
+    resolved = []
+    getaddrinfo = socket.getaddrinfo
+
+    def record_getaddrinfo(host, *args, **kwargs):
+        resolved.append(host)
+        return getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", record_getaddrinfo)
+    try:
+        assert async_jobs.send_callback(f"http://callback.example:{port}/callback?job=1", {"status": "Completed"})
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert received == [(f"callback.example:{port}", "/callback?job=1", {"status": "Completed"})]
+    assert "callback.example" not in resolved
+
+
+def test_pin_callback_url():
+    assert async_jobs.pin_callback_url("https://example.org/callback", "93.184.216.34") == (
+        "https://93.184.216.34/callback",
+        "example.org",
+    )
+    assert async_jobs.pin_callback_url("http://example.org:8080/callback", "2606:2800:220:1::1") == (
+        "http://[2606:2800:220:1::1]:8080/callback",
+        "example.org:8080",
+    )
+    # The TLS server name and certificate are checked against the host name
+    adapter = async_jobs.PinnedHostAdapter("example.org")
+    assert adapter.poolmanager.connection_pool_kw["server_hostname"] == "example.org"
+    assert adapter.poolmanager.connection_pool_kw["assert_hostname"] == "example.org"
+
+
+@pytest.fixture
+def run_jobs(monkeypatch):
+    """Answer the jobs without running their query, and collect the responses sent to their callback"""
+    monkeypatch.setattr(async_jobs, "run_job", lambda query, attempts: (COMPLETED, "Done", {"attempts": attempts}))
+    sent = []
+    monkeypatch.setattr(async_jobs, "send_callback", lambda callback, response: sent.append((callback, response)))
+    return sent
+
+
+def test_queued_job_survives_restart(tmp_path, run_jobs):
+    """Test a job queued before a restart is claimed and run by a new worker"""
+    path = str(tmp_path / "jobs.sqlite")
+    job_id = async_jobs.submit_job(QUERY, QUERY["callback"], path)
+    assert async_jobs.get_job(job_id, path)["status"] == QUEUED
+
+    # A new worker process, with a new connection
+    conn = async_jobs.connect(path)
+    try:
+        assert async_jobs.process_next_job(conn)
+        assert not async_jobs.process_next_job(conn)
+    finally:
+        conn.close()
+    job = async_jobs.get_job(job_id, path)
+    assert job["status"] == COMPLETED
+    assert job["response"] == {"attempts": 1}
+    assert run_jobs == [(QUERY["callback"], {"attempts": 1})]
+
+
+def test_abandoned_running_job_is_claimed(tmp_path, run_jobs):
+    """Test a job left running by a worker which stopped is run again once its time budget passed"""
+    path = str(tmp_path / "jobs.sqlite")
+    job_id = async_jobs.submit_job(QUERY, QUERY["callback"], path)
+    conn = async_jobs.connect(path)
+    try:
+        assert async_jobs.claim_job(conn)[0] == job_id
+        # The worker running the job stopped
+        assert async_jobs.get_job(job_id, path)["status"] == RUNNING
+        assert async_jobs.claim_job(conn) is None
+
+        abandoned_at = time.time() - settings.ASYNC_QUERY_TIMEOUT - async_jobs.ABANDONED_JOB_GRACE - 1
+        conn.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (abandoned_at, job_id))
+        assert async_jobs.process_next_job(conn)
+    finally:
+        conn.close()
+    job = async_jobs.get_job(job_id, path)
+    assert job["status"] == COMPLETED
+    assert job["response"] == {"attempts": 2}
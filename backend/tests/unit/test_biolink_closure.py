@@ -0,0 +1,84 @@
+import pytest
+from app.config import settings
+from app.trapi import biolink_closure
+from app.trapi.biolink_closure import BIOLINK_VOCAB, BiolinkClosure
+from rdflib import Graph, URIRef
+from rdflib.namespace import RDFS
+
+
+def biolink(name):
+    return BIOLINK_VOCAB + name
+
+
+@pytest.fixture
+def closure():
+    graph = Graph()
+    for child, parent in [("Drug", "ChemicalEntity"), ("ChemicalEntity", "NamedThing"), ("Gene", "NamedThing")]:
+        graph.add((URIRef(biolink(child)), RDFS.subClassOf, URIRef(biolink(parent))))
+    for child, parent in [("treats", "related_to"), ("related_to", "related_to_at_instance_level")]:
+        graph.add((URIRef(biolink(child)), RDFS.subPropertyOf, URIRef(biolink(parent))))
+    # Cycle, and terms outside of BioLink
+    graph.add((URIRef(biolink("related_to_at_instance_level")), RDFS.subPropertyOf, URIRef(biolink("related_to"))))
+    graph.add((URIRef("http://other/Thing"), RDFS.subClassOf, URIRef(biolink("NamedThing"))))
+    return BiolinkClosure.from_graph(graph)
+
+
+def test_expand(closure):
+    assert closure.expand([biolink("ChemicalEntity")]) == [biolink("ChemicalEntity"), biolink("Drug")]
+    assert closure.expand([biolink("Drug"), biolink("NamedThing")]) == [
+        biolink("Drug"),
+        biolink("NamedThing"),
+        biolink("ChemicalEntity"),
+        biolink("Gene"),
+    ]
+    assert closure.expand([biolink("related_to")]) == [
+        biolink("related_to"),
+        biolink("related_to_at_instance_level"),
+        biolink("treats"),
+    ]
+    assert closure.expand(["http://other/Thing", biolink("Unknown")]) == ["http://other/Thing", biolink("Unknown")]
+
+
+def test_get_ancestors(closure):
+    assert sorted(closure.get_ancestors(biolink("Drug"))) == [biolink("ChemicalEntity"), biolink("NamedThing")]
+    assert closure.get_ancestors(biolink("NamedThing")) == []
+    assert sorted(closure.get_ancestors(biolink("treats"))) == [
+        biolink("related_to"),
+        biolink("related_to_at_instance_level"),
+    ]
+    assert closure.get_ancestors("http://other/Thing") == []
+
+
+def test_load_checks_the_version(closure, tmp_path):
+    path = str(tmp_path / "closure.json")
+    assert BiolinkClosure.load(path, "4.2.0") is None
+    closure.save(path, "4.2.0")
+    loaded = BiolinkClosure.load(path, "4.2.0")
+    assert loaded.terms == closure.terms
+    assert loaded.expand([biolink("ChemicalEntity")]) == [biolink("ChemicalEntity"), biolink("Drug")]
+    assert BiolinkClosure.load(path, "4.2.1") is None
+
+
+def test_empty_closure_until_retry(closure, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "BIOLINK_CLOSURE_PATH", str(tmp_path / "closure.json"))
+    monkeypatch.setattr(biolink_closure, "closure", None)
+    monkeypatch.setattr(biolink_closure, "closure_failed_at", None)
+    builds = []
+
+    def build_closure(version):
+        builds.append(version)
+        if len(builds) == 1:
+            raise OSError("BioLink OWL not available")
+        return closure
+
+    monkeypatch.setattr(biolink_closure, "build_closure", build_closure)
+    assert biolink_closure.get_biolink_closure().terms == []
+    # Not built again before the retry interval
+    assert biolink_closure.get_biolink_closure().terms == []
+    assert len(builds) == 1
+
+    monkeypatch.setattr(biolink_closure, "RETRY_INTERVAL", 0)
+    assert biolink_closure.get_biolink_closure() is closure
+    assert len(builds) == 2
+    # Saved for the next start
+    assert BiolinkClosure.load(settings.BIOLINK_CLOSURE_PATH, settings.BIOLINK_VERSION).terms == closure.terms
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+from app.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, StaleCache
+
+
+def ok():
+    return "ok"
+
+
+def fail():
+    raise RuntimeError("upstream down")
+
+
+def call(breaker, function):
+    try:
+        return breaker.call(function)
+    except RuntimeError:
+        return None
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker("test", window=10, min_calls=4, failure_rate=0.5, slow_call_seconds=10, open_seconds=0.1)
+
+
+def test_opens_on_failure_rate(breaker):
+    for function in (ok, fail, ok):
+        call(breaker, function)
+    assert breaker.state == CLOSED
+    call(breaker, fail)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.call(ok)
+
+
+def test_half_open_trial(breaker):
+    """Test a single trial call is let through once open_seconds passed, it closes or opens the circuit again"""
+    breaker.trip()
+    assert not breaker.available
+    time.sleep(0.11)
+    assert breaker.available
+    assert breaker.acquire()
+    assert breaker.state == HALF_OPEN
+    # A single trial call at a time
+    assert not breaker.acquire()
+    breaker.record(True, 0)
+    assert breaker.state == OPEN
+
+    time.sleep(0.11)
+    assert breaker.call(ok) == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_slow_calls():
+    breaker = CircuitBreaker("slow", min_calls=2, slow_call_rate=0.5, slow_call_seconds=1, open_seconds=60)
+    breaker.record(False, 0.1)
+    breaker.record(False, 2)
+    assert breaker.state == OPEN
+
+
+def test_ignored_exceptions_release_the_trial():
+    breaker = CircuitBreaker("ignored", open_seconds=0, ignored_exceptions=(KeyError,))
+    breaker.trip()
+
+    def cancelled():
+        raise KeyError()
+
+    with pytest.raises(KeyError):
+        breaker.call(cancelled)
+    assert breaker.state == HALF_OPEN
+    assert breaker.acquire()
+
+
+def test_stale_cache():
+    cache = StaleCache(2)
+    assert cache.call("a", ok) == ("ok", None)
+    response, age = cache.call("a", fail)
+    assert response == "ok" and age >= 0
+    with pytest.raises(RuntimeError):
+        cache.call("b", fail)
+    # The least recently used responses are evicted
+    cache.put("b", "b")
+    cache.put("c", "c")
+    assert cache.get("a") is None
+
+
+def test_stale_cache_max_size():
+    """Test the responses larger than max_size are not cached, and drop the previous response"""
+    cache = StaleCache(10, max_size=2)
+    cache.put("rows", [1, 2])
+    assert cache.get("rows")[0] == [1, 2]
+    cache.put("rows", [1, 2, 3])
+    assert cache.get("rows") is None
+    with pytest.raises(RuntimeError):
+        cache.call("rows", fail)
@@ -0,0 +1,31 @@
+import pytest
+from app.trapi.constraints import EdgeConstraints, edge_matches
+
+
+def query_edge(operator, value):
+    return {"attribute_constraints": [{"id": "biolink:description", "operator": operator, "value": value}]}
+
+
+def edge(description):
+    return {"attributes": [{"attribute_type_id": "biolink:description", "value": description}]}
+
+
+def test_matches_constraint():
+    constraints = EdgeConstraints.from_query_edge(query_edge("matches", "^treats .*cancer$"))
+    assert edge_matches(edge("treats lung cancer"), [], constraints.attribute_constraints)
+    assert not edge_matches(edge("causes lung cancer"), [], constraints.attribute_constraints)
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["[unclosed", "(a+)+$", "(\\w*,?)*x", "(a|b+){2,}", "a" * 300, ["valid", "(x"]],
+)
+def test_invalid_matches_constraint(pattern):
+    """Test the invalid, too long, or exponentially backtracking regular expressions are rejected"""
+    with pytest.raises(ValueError):
+        EdgeConstraints.from_query_edge(query_edge("matches", pattern))
+
+
+@pytest.mark.parametrize("pattern", ["(ab)+", "(a+b)", "a+b*", "\\(a+\\)+", "x{2,3}"])
+def test_valid_matches_constraint(pattern):
+    assert EdgeConstraints.from_query_edge(query_edge("matches", pattern))
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from app.trapi import csr_snapshot, edge_store
+
+BIOLINK = "https://w3id.org/biolink/vocab/"
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def literal(value):
+    return {"type": "literal", "value": value}
+
+
+def association_row(association, subject, obj, predicate="treats", subject_category="Drug", **bindings):
+    row = {
+        "association": uri(association),
+        "np_uri": uri(f"{association}/np"),
+        "pubkey": literal(f"key-{association}"),
+        "subject": uri(subject),
+        "predicate": uri(BIOLINK + predicate),
+        "object": uri(obj),
+        "subject_category": uri(BIOLINK + subject_category),
+        "object_category": uri(BIOLINK + "Disease"),
+    }
+    row.update(bindings)
+    return row
+
+
+ROWS = [
+    association_row("http://a/1", "http://drug/1", "http://disease/1", label=literal("Label")),
+    association_row("http://a/1", "http://drug/1", "http://disease/1", publications=literal("P")),
+    association_row("http://a/1", "http://drug/1", "http://disease/1", primary_knowledge_source=uri("http://infores")),
+    association_row("http://a/2", "http://drug/1", "http://disease/2", "affects"),
+    # Node with two categories
+    association_row("http://a/3", "http://drug/2", "http://disease/1"),
+    association_row("http://a/3", "http://drug/2", "http://disease/1", subject_category="ChemicalEntity"),
+    association_row("http://a/4", "http://drug/3", "http://disease/2"),
+]
+
+
+@pytest.fixture
+def paths(tmp_path):
+    store_path = str(tmp_path / "edge-store.sqlite")
+    snapshot_path = str(tmp_path / "csr.bin")
+    conn = edge_store.connect(store_path, read_only=False)
+    edge_store.insert_bindings(conn, ROWS)
+    conn.commit()
+    conn.close()
+    assert csr_snapshot.build_csr_snapshot(store_path, snapshot_path) == 4
+    return store_path, snapshot_path
+
+
+def normalize(bindings):
+    """Bindings as a comparable set, the order of the rows of an association differs between the engines"""
+    return sorted(sorted((var, value["value"]) for var, value in row.items()) for row in bindings)
+
+
+@pytest.mark.parametrize(
+    "constraints",
+    [
+        {"subject_ids": ["http://drug/1"]},
+        {"object_ids": ["http://disease/1"]},
+        {"object_ids": ["http://disease/1", "http://disease/2"], "predicates": [BIOLINK + "treats"]},
+        {"subject_ids": ["http://drug/2"], "subject_categories": [BIOLINK + "ChemicalEntity"]},
+        {"subject_ids": ["http://drug/1", "http://drug/3"], "object_ids": ["http://disease/2"]},
+        {"subject_ids": ["http://drug/1", "http://drug/2", "http://drug/3"], "limit": 2, "offset": 1},
+        {"subject_ids": ["http://unknown"]},
+    ],
+)
+def test_parity_with_edge_store(paths, constraints):
+    """Test the snapshot returns the same rows as the edge store it was built from"""
+    store_path, snapshot_path = paths
+    conn = edge_store.connect(store_path)
+    try:
+        expected = edge_store.select_one_hop(conn, **constraints)
+    finally:
+        conn.close()
+    with csr_snapshot.open_snapshot(snapshot_path) as snapshot:
+        assert normalize(snapshot.select_one_hop(**constraints)) == normalize(expected)
+
+
+def test_replaced_snapshot_is_closed(paths):
+    """Test the previous snapshot is closed once the lookups running on it are done"""
+    store_path, snapshot_path = paths
+    with csr_snapshot.open_snapshot(snapshot_path) as first:
+        assert csr_snapshot.get_snapshot(snapshot_path) is first
+        csr_snapshot.build_csr_snapshot(store_path, snapshot_path)
+        # Force a different mtime, the build may happen within the same timestamp
+        os.utime(snapshot_path, ns=(0, 0))
+        with csr_snapshot.open_snapshot(snapshot_path) as second:
+            assert second is not first
+            # Still usable by the lookup running on it
+            assert first.select_one_hop(subject_ids=["http://drug/3"])
+            assert not first.mmap.closed
+    assert first.mmap.closed
+    assert not second.mmap.closed
+    assert csr_snapshot.get_snapshot(snapshot_path) is second
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from app import disconnect
+from app.deadline import Deadline, DeadlineExceededError
+from app.disconnect import CLIENT_CLOSED_REQUEST, iter_until_disconnected, run_until_disconnected
+
+
+def test_from_timeouts():
+    assert Deadline.from_timeouts(None, "", default=30).seconds == 30
+    assert Deadline.from_timeouts("20", 10, None, default=30).seconds == 10
+    for timeout in ("abc", 0, -1):
+        with pytest.raises(ValueError):
+            Deadline.from_timeouts(timeout, default=30)
+
+
+def test_expire_and_cancel():
+    deadline = Deadline(0.05)
+    assert not deadline.expired
+    assert 0 < deadline.timeout(60) <= 0.05
+    assert deadline.timeout(0.01) == 0.01
+    deadline.check()
+    time.sleep(0.06)
+    assert deadline.expired and deadline.remaining() == 0
+    with pytest.raises(DeadlineExceededError, match="time budget"):
+        deadline.check()
+
+    deadline = Deadline(60)
+    deadline.cancel()
+    assert deadline.expired and deadline.remaining() == 0
+    with pytest.raises(DeadlineExceededError, match="cancelled"):
+        deadline.check()
+
+
+def test_wait_truncates():
+    """Test the futures not done before the deadline are cancelled, and the deadline marked truncated"""
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fast = executor.submit(lambda: 1)
+        slow = executor.submit(release.wait, 5)
+        queued = executor.submit(lambda: 2)
+        deadline = Deadline(0.1)
+        assert deadline.wait([fast, slow, queued]) == {fast}
+        assert deadline.truncated
+        assert queued.cancelled()
+        release.set()
+
+    deadline = Deadline(60)
+    assert deadline.wait([]) == set() and not deadline.truncated
+
+
+def test_wait_stops_when_cancelled():
+    deadline = Deadline(60)
+    threading.Timer(0.1, deadline.cancel).start()
+    release = threading.Event()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(release.wait, 5)
+        assert deadline.wait([future]) == set()
+        release.set()
+    assert time.monotonic() - start < 1
+    assert deadline.truncated
+
+
+class FakeRequest:
+    def __init__(self, disconnected_after):
+        self.disconnected_at = time.monotonic() + disconnected_after
+
+    async def is_disconnected(self):
+        return time.monotonic() >= self.disconnected_at
+
+
+def test_run_until_disconnected(monkeypatch):
+    monkeypatch.setattr(disconnect, "DISCONNECT_POLL_INTERVAL", 0.02)
+    deadline = Deadline(60)
+
+    def work():
+        deadline.cancelled.wait(5)
+        return "done"
+
+    response = asyncio.run(run_until_disconnected(FakeRequest(0.05), deadline.cancel, work))
+    assert response.status_code == CLIENT_CLOSED_REQUEST
+    assert deadline.cancelled.is_set()
+
+    deadline = Deadline(60)
+    assert asyncio.run(run_until_disconnected(FakeRequest(60), deadline.cancel, lambda: "done")) == "done"
+    assert not deadline.expired
+
+
+def test_iter_until_disconnected():
+    deadline = Deadline(60)
+
+    async def consume(limit):
+        chunks = []
+        stream = iter_until_disconnected(iter(range(5)), deadline.cancel)
+        async for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) == limit:
+                # The client is gone, Starlette closes the stream
+                await stream.aclose()
+                break
+        return chunks
+
+    assert asyncio.run(consume(None)) == list(range(5))
+    assert not deadline.expired
+    assert asyncio.run(consume(2)) == [0, 1]
+    assert deadline.cancelled.is_set()
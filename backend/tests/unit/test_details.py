@@ -0,0 +1,68 @@
+import re
+
+from app.trapi import details
+from app.trapi.details import build_details_queries, merge_detail_rows
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def core_row(association, graph=None):
+    return {
+        "association": uri(association),
+        "np_assertion": uri(graph or f"{association}/assertion"),
+        "subject": uri("http://drug/1"),
+        "predicate": uri("https://w3id.org/biolink/vocab/treats"),
+        "object": uri("http://disease/1"),
+    }
+
+
+def bound_associations(query):
+    values = re.search(r"VALUES \(\?association \?np_assertion\) \{ (.*) \}", query).group(1)
+    return re.findall(r"\(<([^>]*)> <[^>]*>\)", values)
+
+
+def test_details_queries_batched(monkeypatch):
+    monkeypatch.setattr(details, "DETAILS_BATCH_SIZE", 2)
+    # One list of rows per core query: chunk 0 (old, new template), chunk 1 (old, new template)
+    source_results = [
+        [core_row("http://a/1"), core_row("http://a/1")],
+        [core_row("http://a/2"), core_row("http://a/3"), core_row("http://a/4")],
+        [],
+        [core_row("http://a/5"), core_row("http://a/2")],
+    ]
+    queries = build_details_queries(source_results, n_results=10)
+    # Rows are sent to the details template of their core template, without duplicates
+    assert [bound_associations(query) for query in queries] == [
+        ["http://a/1"],
+        ["http://a/2", "http://a/3"],
+        ["http://a/4", "http://a/5"],
+    ]
+    assert "rdfs:label ?label" in queries[0]
+    assert "biolink:has_attribute_type ?attribute_type" in queries[1]
+
+    # Associations beyond n_results are not queried
+    queries = build_details_queries(source_results, n_results=3)
+    assert [association for query in queries for association in bound_associations(query)] == [
+        "http://a/1",
+        "http://a/2",
+        "http://a/3",
+    ]
+    assert build_details_queries([[], []], n_results=3) == []
+
+
+def test_merge_detail_rows():
+    core_rows = [core_row("http://a/1"), core_row("http://a/2")]
+    detail_rows = [
+        {"association": uri("http://a/2"), "label": {"type": "literal", "value": "Label"}},
+        {"association": uri("http://a/1"), "publications": uri("http://pub/1")},
+        # Association not returned by the core queries
+        {"association": uri("http://a/3"), "label": {"type": "literal", "value": "Other"}},
+    ]
+    merged = list(merge_detail_rows(core_rows, detail_rows))
+    assert merged == [
+        *core_rows,
+        {**core_rows[1], "label": {"type": "literal", "value": "Label"}},
+        {**core_rows[0], "publications": uri("http://pub/1")},
+    ]
@@ -0,0 +1,76 @@
+import itertools
+
+from app.trapi.edge_assembler import EdgeAssembler
+from app.trapi.projection import Projection
+
+from tests.bench_edge_assembler import BIOLINK, legacy_assemble, resolve_uri, uri
+
+
+def literal(value):
+    return {"type": "literal", "value": value}
+
+
+def generate_rows():
+    """Rows of 2 associations, with the cartesian product of their attributes, publications and qualifiers"""
+    rows = []
+    for i in range(2):
+        core = {
+            "association": uri(f"http://purl.org/np/RA{i}#association"),
+            "subject": uri(f"http://identifiers.org/drugbank/DB0000{i}"),
+            "predicate": uri(BIOLINK + "treats"),
+            "object": uri("http://purl.obolibrary.org/obo/MONDO_0000001"),
+            "subject_category": uri(BIOLINK + "Drug"),
+            "object_category": uri(BIOLINK + "Disease"),
+            "label": literal(f"Association {i}"),
+            "primary_knowledge_source": uri("https://w3id.org/biolink/infores/knowledge-collaboratory"),
+            "primary_upstream_resource_ids": uri("https://w3id.org/biolink/infores/upstream"),
+        }
+        for attribute, publication, qualifier in itertools.product(range(2), range(2), range(2)):
+            rows.append({
+                **core,
+                "attribute_type": uri(BIOLINK + f"attribute_{attribute}"),
+                "attribute_value": literal(f"value {attribute}"),
+                "attribute_provider": uri("https://w3id.org/biolink/infores/knowledge-collaboratory"),
+                "publications": uri(f"http://www.ncbi.nlm.nih.gov/pubmed/{i * 10 + publication}"),
+                "qualifier": uri(BIOLINK + ["subject_aspect_qualifier", "object_aspect_qualifier"][qualifier]),
+                "qualifier_value": uri(BIOLINK + "activity"),
+            })
+    return rows
+
+
+def assemble(rows, **kwargs):
+    assembler = EdgeAssembler("e0", "n0", "n1", resolve_uri, **kwargs)
+    assembler.add_rows(rows)
+    return assembler.to_trapi()
+
+
+def test_same_output_as_legacy_loop():
+    """Test the assembler returns the output of the previous per-row loop, without its repeated attributes"""
+    rows = generate_rows()
+    kg, results = assemble(rows)
+    legacy_kg, legacy_results = legacy_assemble(rows)
+    for edge in legacy_kg["edges"].values():
+        # The previous loop added the name and publications once per row
+        edge["attributes"] = [
+            dict(attribute) for attribute in dict.fromkeys(tuple(attribute.items()) for attribute in edge["attributes"])
+        ]
+    assert kg == legacy_kg
+    assert results == legacy_results
+    assert len(kg["edges"]["http://purl.org/np/RA0#association"]["attributes"]) == 5
+
+
+def test_max_edges_and_projection():
+    rows = generate_rows()
+    kg, results = assemble(rows, max_edges=1, projection=Projection(["biolink:name"], qualifiers=False))
+    assert list(kg["edges"]) == ["http://purl.org/np/RA0#association"]
+    assert len(results) == 1
+    edge = kg["edges"]["http://purl.org/np/RA0#association"]
+    assert edge["attributes"] == [{"attribute_type_id": "biolink:name", "value": "Association 0"}]
+    assert edge["qualifiers"] == []
+    assert edge["sources"] == [
+        {
+            "resource_id": "infores:knowledge-collaboratory",
+            "resource_role": "primary_knowledge_source",
+            "upstream_resource_ids": ["infores:upstream"],
+        }
+    ]
@@ -0,0 +1,83 @@
+import pytest
+from app.trapi import edge_store
+
+BIOLINK = "https://w3id.org/biolink/vocab/"
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def literal(value):
+    return {"type": "literal", "value": value}
+
+
+def association_row(association, subject, obj, predicate="treats", object_category="Disease", **bindings):
+    row = {
+        "association": uri(association),
+        "np_uri": uri(f"{association}/np"),
+        "pubkey": literal(f"key-{association}"),
+        "subject": uri(subject),
+        "predicate": uri(BIOLINK + predicate),
+        "object": uri(obj),
+        "subject_category": uri(BIOLINK + "Drug"),
+        "object_category": uri(BIOLINK + object_category),
+    }
+    row.update(bindings)
+    return row
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = edge_store.connect(str(tmp_path / "edge-store.sqlite"), read_only=False)
+    edge_store.insert_bindings(
+        conn,
+        [
+            association_row("http://a/1", "http://drug/1", "http://disease/1", label=literal("Drug 1 treats")),
+            association_row("http://a/1", "http://drug/1", "http://disease/1", publications=literal("PMID:1")),
+            association_row(
+                "http://a/1",
+                "http://drug/1",
+                "http://disease/1",
+                qualifier=uri(BIOLINK + "frequency_qualifier"),
+                qualifier_value=uri("http://hp/often"),
+            ),
+            association_row("http://a/2", "http://drug/1", "http://disease/2"),
+            association_row("http://a/3", "http://drug/2", "http://gene/1", "affects", "Gene"),
+            association_row("http://a/4", "http://drug/2", "http://disease/1"),
+            association_row("http://a/5", "http://drug/3", "http://disease/3"),
+        ],
+    )
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def associations(bindings):
+    return list(dict.fromkeys(row["association"]["value"] for row in bindings))
+
+
+def test_select_one_hop(conn):
+    bindings = edge_store.select_one_hop(conn, subject_ids=["http://drug/1"], object_categories=[BIOLINK + "Disease"])
+    assert associations(bindings) == ["http://a/1", "http://a/2"]
+    first = [row for row in bindings if row["association"]["value"] == "http://a/1"]
+    assert first[0]["label"]["value"] == "Drug 1 treats"
+    assert all(row["pubkey"]["value"] == "key-http://a/1" for row in first)
+    assert any(row.get("publications", {}).get("value") == "PMID:1" for row in first)
+    assert any(row.get("qualifier_value", {}).get("value") == "http://hp/often" for row in first)
+
+    assert associations(edge_store.select_one_hop(conn, predicates=[BIOLINK + "affects"])) == ["http://a/3"]
+    by_object = edge_store.select_one_hop(conn, object_ids=["http://disease/1"])
+    assert associations(by_object) == ["http://a/1", "http://a/4"]
+    assert edge_store.select_one_hop(conn, subject_ids=["http://drug/3"], object_categories=[BIOLINK + "Gene"]) == []
+
+
+def test_select_one_hop_pages(conn):
+    """Test the pages of distinct associations, ordered by URI, cover all of them once"""
+    pages = [associations(edge_store.select_one_hop(conn, limit=2, offset=offset)) for offset in range(0, 6, 2)]
+    assert pages == [["http://a/1", "http://a/2"], ["http://a/3", "http://a/4"], ["http://a/5"]]
+    # The rows of the details of an association do not count in the limit
+    page = edge_store.select_one_hop(conn, object_categories=[BIOLINK + "Disease"], limit=1)
+    assert associations(page) == ["http://a/1"]
+    assert len(page) > 1
+
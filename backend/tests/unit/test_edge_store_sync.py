@@ -0,0 +1,148 @@
+import random
+import re
+
+import pytest
+from app.trapi import edge_store
+from app.trapi.sparql_templates import one_hop_templates, optional_blocks, optional_blocks_old
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def association_row(association, np_uri, subject="http://x/drug", obj="http://x/disease"):
+    return {
+        "association": uri(association),
+        "np_uri": uri(np_uri),
+        "subject": uri(subject),
+        "predicate": uri("https://w3id.org/biolink/vocab/treats"),
+        "object": uri(obj),
+        "subject_category": uri("https://w3id.org/biolink/vocab/Drug"),
+        "object_category": uri("https://w3id.org/biolink/vocab/Disease"),
+        "publications": {"type": "literal", "value": "http://pub/1"},
+    }
+
+
+class NetworkSparql:
+    """Answer the sync queries with the latest dct:created of the network and the invalidated nanopubs"""
+
+    def __init__(self, latest_created, invalidated):
+        self.latest_created = latest_created
+        self.invalidated = invalidated
+
+    def __call__(self, query):
+        if "MAX(?created)" in query:
+            return [{"latest_created": {"type": "literal", "value": self.latest_created}}]
+        assert "npx:supersedes" in query
+        return [{"np_uri": uri(np_uri)} for np_uri in self.invalidated]
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = str(tmp_path / "edge-store.sqlite")
+    conn = edge_store.connect(path, read_only=False)
+    edge_store.insert_bindings(
+        conn,
+        [association_row("http://a/1", "http://np/1"), association_row("http://a/2", "http://np/2", obj="http://x/d2")],
+    )
+    edge_store.set_state(conn, "latest_created", "2023-01-01T00:00:00Z")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def count(path, table):
+    conn = edge_store.connect(path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]  # noqa: S608 (table names of the tests)
+    finally:
+        conn.close()
+
+
+def test_incremental_sync_deletes_invalidated(store_path, monkeypatch):
+    """Test the associations of superseded nanopubs are deleted, and the new version inserted"""
+    new_pages = [[association_row("http://a/3", "http://np/3")]]
+    monkeypatch.setattr(edge_store, "fetch_bindings", lambda run_sparql_query, since, until: iter(new_pages))
+    sparql = NetworkSparql("2023-01-02T00:00:00Z", ["http://np/1"])
+
+    assert edge_store.sync_edge_store_incremental(store_path, sparql) == (1, 1)
+    conn = edge_store.connect(store_path)
+    try:
+        associations = {row[0] for row in conn.execute("SELECT association FROM associations")}
+        details = {row[0] for row in conn.execute("SELECT association FROM attributes")}
+        assert edge_store.get_state(conn, "latest_created") == "2023-01-02T00:00:00Z"
+    finally:
+        conn.close()
+    assert associations == {"http://a/2", "http://a/3"}
+    # The details of the deleted associations are deleted too
+    assert details == {"http://a/2", "http://a/3"}
+    assert edge_store.get_freshness_lag(store_path) == 0
+
+
+def test_incremental_sync_is_atomic(store_path, monkeypatch):
+    """Test a sync failing while applying its batch leaves the store unchanged, and the lag is reported"""
+    broken_row = association_row("http://a/3", "http://np/3")
+    del broken_row["subject"]
+    monkeypatch.setattr(edge_store, "fetch_bindings", lambda run_sparql_query, since, until: iter([[broken_row]]))
+    sparql = NetworkSparql("2023-01-01T01:00:00.5Z", ["http://np/1"])
+
+    with pytest.raises(KeyError):
+        edge_store.sync_edge_store_incremental(store_path, sparql)
+    assert count(store_path, "associations") == 2
+    assert count(store_path, "attributes") == 2
+    conn = edge_store.connect(store_path)
+    try:
+        assert edge_store.get_state(conn, "latest_created") == "2023-01-01T00:00:00Z"
+    finally:
+        conn.close()
+    assert edge_store.get_freshness_lag(store_path) == pytest.approx(3600.5)
+
+
+def test_parse_created():
+    assert edge_store.parse_created("2023-01-01T00:00:00Z") == edge_store.parse_created("2023-01-01T01:00:00+01:00")
+    assert edge_store.parse_created("2023-01-01T00:00:00.1234567") - edge_store.parse_created(
+        "2023-01-01T00:00:00"
+    ) == pytest.approx(0.123456)
+
+
+@pytest.mark.parametrize("since", [None, "2023-01-01T00:00:00Z"])
+def test_sync_query_retrieves_all_properties(since):
+    """Test the sync queries keep all the OPTIONAL blocks, the edge store should not depend on a projection"""
+    old_query, query = (
+        edge_store.get_sync_query(template, 100, 200, since, "2023-02-01T00:00:00Z")
+        for template in one_hop_templates
+    )
+    for name, (text, _provides) in optional_blocks.items():
+        assert text in query, name
+    for name, (text, _provides) in optional_blocks_old.items():
+        assert text in old_query, name
+    assert "biolink:has_attribute_type ?attribute_type" in query
+    assert "OPTIONAL { ?association ?qualifier ?qualifier_value . }" in query
+    assert "LIMIT 100 OFFSET 200" in query
+    assert "?_" not in query
+    assert ('"2023-01-01T00:00:00Z"^^xsd:dateTime' in query) == bool(since)
+
+
+def test_fetch_bindings_pages_over_associations(monkeypatch):
+    """Test the rows of an association are all retrieved, whatever their order, when they span a page boundary"""
+    monkeypatch.setattr(edge_store, "SYNC_WINDOW_SIZE", 3)
+    # 7 associations with 4 detail rows each, returned in a different order by each query
+    rows = [
+        {**association_row(f"http://a/{i}", f"http://np/{i}"), "publications": {"type": "literal", "value": str(j)}}
+        for i in range(7)
+        for j in range(4)
+    ]
+    queries = []
+
+    def run_sparql_query(query):
+        queries.append(query)
+        limit, offset = map(int, re.search(r"LIMIT (\d+) OFFSET (\d+)", query).groups())
+        window = sorted({row["association"]["value"] for row in rows})[offset : offset + limit]
+        page = [row for row in rows if row["association"]["value"] in window]
+        random.Random(offset).shuffle(page)
+        return page
+
+    bindings = [row for page in edge_store.fetch_bindings(run_sparql_query) for row in page]
+    # Retrieved once by each template
+    assert len(queries) == 2 * 3
+    assert sorted(map(str, bindings)) == sorted(map(str, rows * 2))
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from app.deadline import Deadline, DeadlineExceededError
+from app.governor import (
+    BACKGROUND,
+    INTERACTIVE,
+    Governor,
+    background_priority,
+    call_with_priority,
+    current_priority,
+)
+
+
+def hold_slot(governor):
+    """Take the slot of a governor in a thread, released when the returned event is set"""
+    taken = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with governor.slot():
+            taken.set()
+            release.wait(5)
+
+    threading.Thread(target=hold).start()
+    taken.wait(5)
+    return release
+
+
+def test_rate_limit():
+    governor = Governor("rate", 10, 5)
+    start = time.monotonic()
+    for _ in range(7):
+        with governor.slot():
+            pass
+    # A burst of 5 requests, then 5 per second
+    assert 0.3 < time.monotonic() - start < 1.5
+
+
+@pytest.mark.parametrize("slots_path", [None, "files"])
+def test_cancel_while_waiting(tmp_path, slots_path):
+    governor = Governor("cancel", 1, 100, str(tmp_path / slots_path) if slots_path else None)
+    release = hold_slot(governor)
+    with pytest.raises(DeadlineExceededError), governor.slot(deadline=Deadline(0.2)):
+        pass
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    with pytest.raises(DeadlineExceededError), governor.slot(cancel=cancel):
+        pass
+    release.set()
+    time.sleep(0.1)
+    assert governor.running == 0
+
+
+def test_cancel_while_waiting_for_a_file_slot(tmp_path):
+    """Test a request waiting for a slot taken by another worker process stops when cancelled"""
+    worker = Governor("shared", 1, 100, str(tmp_path))
+    other_worker = Governor("shared", 1, 100, str(tmp_path))
+    release = hold_slot(other_worker)
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceededError), worker.slot(cancel=cancel):
+        pass
+    assert time.monotonic() - start < 2
+    assert worker.running == 0
+    release.set()
+
+
+def test_token_taken_outside_the_condition(tmp_path):
+    """Test the file token bucket is not read while holding the condition of the governor"""
+    governor = Governor("bucket", 2, 100, str(tmp_path))
+    take = governor.bucket.take
+
+    def try_acquire_condition():
+        if not governor.condition.acquire(blocking=False):
+            return False
+        governor.condition.release()
+        return True
+
+    def check_take():
+        # The condition is reentrant, try to acquire it from another thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(try_acquire_condition).result()
+        return take()
+
+    governor.bucket.take = check_take
+    with governor.slot():
+        pass
+
+
+def test_priority_of_executor_threads():
+    with ThreadPoolExecutor(max_workers=1) as executor, background_priority():
+        assert current_priority() == BACKGROUND
+        assert executor.submit(current_priority).result() == INTERACTIVE
+        assert executor.submit(call_with_priority, current_priority(), current_priority).result() == BACKGROUND
+    assert current_priority() == INTERACTIVE
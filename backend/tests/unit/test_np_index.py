@@ -0,0 +1,102 @@
+import re
+import threading
+import time
+
+import pytest
+from app.config import settings
+from app.trapi import np_index
+from app.trapi.np_index import get_index_constraint, get_index_members
+
+
+class FakeEndpoint:
+    """Answer the index queries from a chain of appended indexes, counting the queries"""
+
+    def __init__(self):
+        # Index: (appended index, elements)
+        self.indexes = {"http://index/1": (None, ["http://np/1", "http://np/2"])}
+        self.queries = []
+
+    def append(self, index, previous, elements):
+        self.indexes[index] = (previous, elements)
+
+    def run_sparql_query(self, query):
+        self.queries.append(query)
+        iris = re.findall(r"<([^>]+)>", query.split("WHERE", 1)[1])
+        if "includesElement" in query:
+            return [{"np": {"value": np}} for index in iris for np in self.indexes[index][1]]
+        index = iris[0]
+        bindings = []
+        while index is not None:
+            bindings.append({"index": {"value": index}})
+            index = self.indexes[index][0]
+        return bindings
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    monkeypatch.setattr(np_index, "index_cache", {})
+    monkeypatch.setattr(settings, "NP_INDEX_CACHE_TTL", 60)
+    return FakeEndpoint()
+
+
+def test_members_are_cached(endpoint):
+    assert get_index_members("http://index/1", endpoint.run_sparql_query) == {"http://np/1", "http://np/2"}
+    assert len(endpoint.queries) == 2
+    assert get_index_members("http://index/1", endpoint.run_sparql_query) == {"http://np/1", "http://np/2"}
+    assert len(endpoint.queries) == 2
+
+
+def test_only_new_indexes_are_resolved(endpoint, monkeypatch):
+    """Test once the TTL passed, only the members of the indexes not seen before are retrieved"""
+    monkeypatch.setattr(settings, "NP_INDEX_CACHE_TTL", 0)
+    get_index_members("http://index/1", endpoint.run_sparql_query)
+    endpoint.queries.clear()
+    assert len(get_index_members("http://index/1", endpoint.run_sparql_query)) == 2
+    # Only the chain of appended indexes is checked
+    assert len(endpoint.queries) == 1
+
+    # A new version of the index 1 appends the index 2
+    endpoint.indexes["http://index/1"] = ("http://index/2", ["http://np/1", "http://np/2"])
+    endpoint.append("http://index/2", None, ["http://np/3"])
+    endpoint.queries.clear()
+    members = get_index_members("http://index/1", endpoint.run_sparql_query)
+    assert members == {"http://np/1", "http://np/2", "http://np/3"}
+    assert "<http://index/2>" in endpoint.queries[-1]
+    assert "<http://index/1>" not in endpoint.queries[-1]
+
+
+def test_indexes_queried_in_batches(endpoint, monkeypatch):
+    monkeypatch.setattr(np_index, "INDEX_BATCH_SIZE", 2)
+    for number in range(2, 6):
+        endpoint.append(f"http://index/{number}", f"http://index/{number - 1}", [f"http://np/{number + 1}"])
+    members = get_index_members("http://index/5", endpoint.run_sparql_query)
+    assert members == {f"http://np/{number}" for number in range(1, 7)}
+    # The chain, then the 5 indexes by 2
+    assert len(endpoint.queries) == 4
+
+
+def test_concurrent_requests_resolve_once(endpoint):
+    run_sparql_query = endpoint.run_sparql_query
+
+    def slow_query(query):
+        time.sleep(0.05)
+        return run_sparql_query(query)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(get_index_members("http://index/1", slow_query)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{"http://np/1", "http://np/2"}] * 4
+    assert len(endpoint.queries) == 2
+
+
+def test_large_indexes_are_checked_on_the_rows(endpoint, monkeypatch):
+    """Test the members of an index are only sent in the queries up to TRAPI_ID_CHUNK_SIZE of them"""
+    assert get_index_constraint("http://index/1", endpoint.run_sparql_query) == (["http://np/1", "http://np/2"], None)
+    monkeypatch.setattr(settings, "TRAPI_ID_CHUNK_SIZE", 1)
+    assert get_index_constraint("http://index/1", endpoint.run_sparql_query) == (None, {"http://np/1", "http://np/2"})
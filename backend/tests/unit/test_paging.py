@@ -0,0 +1,36 @@
+import re
+
+import pytest
+from app.trapi.paging import decode_cursor, encode_cursor, get_next_offsets
+from app.trapi.sparql_templates import one_hop_templates
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor([0, 25, 3])
+    assert re.fullmatch(r"[A-Za-z0-9_=-]+", cursor)
+    assert decode_cursor(cursor) == [0, 25, 3]
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", encode_cursor(["a"]), "eyJvZmZzZXQiOiBbMV19"])
+def test_decode_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("template", one_hop_templates)
+def test_n_results_pushed_down(template):
+    """Test each source only retrieves a window of n_results associations from its offset"""
+    query = template.render({"subject": ["http://a/1"]}, 7, 14)
+    assert re.search(r"\bLIMIT 7\s+OFFSET 14\b", query)
+
+
+def test_next_offsets():
+    returned = [{"a1", "a2", "a3"}, {"b1"}]
+    # The first source returned a full window, the next page resumes after what was consumed and dropped
+    assert get_next_offsets([10, 0], returned, [1, 0], {"a1", "a2", "a3", "b1"}, 3, False) == [14, 1]
+    # Associations left out of the page (beyond n_results) are retrieved by the next page
+    assert get_next_offsets([0, 0], returned, None, {"a1", "b1"}, 5, False) == [1, 1]
+    # Every source returned less than a window, and everything was consumed
+    assert get_next_offsets([0, 0], returned, None, {"a1", "a2", "a3", "b1"}, 5, False) is None
+    # Sources cancelled by the deadline are resumed
+    assert get_next_offsets([0, 0], [set(), set()], None, set(), 5, True) == [0, 0]
@@ -0,0 +1,122 @@
+from app.trapi.planner import chunk_one_hop_graph, execute_query_graph, get_hop_graph
+
+QUERY_GRAPH = {
+    "nodes": {"n0": {"ids": ["MONDO:1"]}, "n1": {"categories": ["biolink:Drug"]}, "n2": {}},
+    "edges": {"e0": {"subject": "n0", "object": "n1"}, "e1": {"subject": "n1", "object": "n2"}},
+}
+# (subject, object, edge) rows of each hop, with the URIs of the nodes as stored
+HOP_ROWS = {
+    "e0": [("MONDO:1", "DRUGBANK:DB1", "a1"), ("MONDO:1", "DRUGBANK:DB2", "a2")],
+    "e1": [("DRUGBANK:DB1", "HGNC:1", "a3"), ("DRUGBANK:DB2", "HGNC:1", "a4"), ("DRUGBANK:DB2", "HGNC:2", "a5")],
+}
+NODE_URIS = {
+    "DRUGBANK:DB1": "https://go.drugbank.com/drugs/DB1",
+    "DRUGBANK:DB2": "http://unknown.org/DB2",
+}
+
+
+def hop_answer(hop_graph, edge_id, hops):
+    hops.append(hop_graph)
+    edge = hop_graph["edges"][edge_id]
+    subject_ids = hop_graph["nodes"][edge["subject"]].get("ids")
+    object_ids = hop_graph["nodes"][edge["object"]].get("ids")
+    rows = [
+        (subject_id, object_id, edge_uri)
+        for subject_id, object_id, edge_uri in HOP_ROWS[edge_id]
+        if (not subject_ids or NODE_URIS.get(subject_id, subject_id) in subject_ids)
+        and (not object_ids or NODE_URIS.get(object_id, object_id) in object_ids)
+    ]
+    return {
+        "knowledge_graph": {
+            "nodes": {node: {"categories": []} for row in rows for node in row[:2]},
+            "edges": {edge_uri: {"subject": s, "object": o} for s, o, edge_uri in rows},
+        },
+        "results": [
+            {
+                "node_bindings": {edge["subject"]: [{"id": s}], edge["object"]: [{"id": o}]},
+                "analyses": [{"edge_bindings": {edge_id: [{"id": edge_uri}]}}],
+            }
+            for s, o, edge_uri in rows
+        ],
+        "node_uris": {node: [NODE_URIS[node]] for row in rows for node in row[:2] if node in NODE_URIS},
+    }
+
+
+def test_next_hops_are_pinned_on_the_node_uris():
+    """Test the ids bound by a hop are passed to the next hops as the URIs they were resolved from"""
+    hops = []
+    answer = execute_query_graph(QUERY_GRAPH, lambda hop_graph, edge_id: hop_answer(hop_graph, edge_id, hops))
+    assert hops[0]["nodes"]["n0"]["ids"] == ["MONDO:1"]
+    assert hops[1]["nodes"]["n1"]["ids"] == ["http://unknown.org/DB2", "https://go.drugbank.com/drugs/DB1"]
+    assert len(answer["results"]) == 3
+    assert not answer["truncated"]
+
+
+def test_results_truncated_by_n_results():
+    answer = execute_query_graph(QUERY_GRAPH, lambda hop_graph, edge_id: hop_answer(hop_graph, edge_id, []), 2)
+    assert len(answer["results"]) == 2
+    assert answer["truncated"]
+
+
+def test_hop_graph_without_node_uris():
+    hop_graph = get_hop_graph(QUERY_GRAPH, "e1", {"n1": {"DRUGBANK:DB2", "DRUGBANK:DB1"}})
+    assert hop_graph["nodes"]["n1"]["ids"] == ["DRUGBANK:DB1", "DRUGBANK:DB2"]
+    assert hop_graph["edges"] == {"e1": QUERY_GRAPH["edges"]["e1"]}
+
+
+def test_chunk_one_hop_graph():
+    """Test the largest list of ids of an edge is split in chunks, the other node is kept on each chunk"""
+    query_graph = {
+        "nodes": {"n0": {"ids": [f"MONDO:{i}" for i in range(5)]}, "n1": {"ids": ["DRUGBANK:DB1", "DRUGBANK:DB2"]}},
+        "edges": {"e0": {"subject": "n0", "object": "n1"}},
+    }
+    assert chunk_one_hop_graph(query_graph, "e0", 5) == [query_graph]
+    chunks = chunk_one_hop_graph(query_graph, "e0", 2)
+    assert [chunk["nodes"]["n0"]["ids"] for chunk in chunks] == [
+        ["MONDO:0", "MONDO:1"],
+        ["MONDO:2", "MONDO:3"],
+        ["MONDO:4"],
+    ]
+    assert all(chunk["nodes"]["n1"] == query_graph["nodes"]["n1"] for chunk in chunks)
+    assert all(chunk["edges"] == query_graph["edges"] for chunk in chunks)
+    # The query graph is not modified
+    assert len(query_graph["nodes"]["n0"]["ids"]) == 5
+
+    unpinned = {"nodes": {"n0": {}, "n1": {"categories": ["biolink:Drug"]}}, "edges": query_graph["edges"]}
+    assert chunk_one_hop_graph(unpinned, "e0", 2) == [unpinned]
+
+
+def test_disjoint_hops_short_circuit():
+    """Test hops binding disjoint ids on a shared node give no results, without running the next hops unpinned"""
+    query_graph = {
+        "nodes": {"n0": {"ids": ["MONDO:1"]}, "n1": {}, "n2": {"ids": ["HGNC:1"]}, "n3": {}},
+        "edges": {
+            "e0": {"subject": "n1", "object": "n0"},
+            "e1": {"subject": "n1", "object": "n2"},
+            "e2": {"subject": "n1", "object": "n3"},
+        },
+    }
+    rows = {
+        "e0": [("DRUGBANK:DB1", "MONDO:1", "a1")],
+        "e1": [("DRUGBANK:DB2", "HGNC:1", "a2")],
+        "e2": [("DRUGBANK:DB1", "HGNC:3", "a3")],
+    }
+    hops = []
+
+    def run_hop(hop_graph, edge_id):
+        hops.append(edge_id)
+        object_node_id = hop_graph["edges"][edge_id]["object"]
+        return {
+            "knowledge_graph": {"nodes": {}, "edges": {edge_uri: {} for _s, _o, edge_uri in rows[edge_id]}},
+            "results": [
+                {
+                    "node_bindings": {"n1": [{"id": s}], object_node_id: [{"id": o}]},
+                    "analyses": [{"edge_bindings": {edge_id: [{"id": edge_uri}]}}],
+                }
+                for s, o, edge_uri in rows[edge_id]
+            ],
+        }
+
+    answer = execute_query_graph(query_graph, run_hop)
+    assert answer["results"] == []
+    assert sorted(hops) == ["e0", "e1"]
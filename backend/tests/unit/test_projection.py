@@ -0,0 +1,100 @@
+import pytest
+from app.trapi.projection import Projection
+from app.trapi.sparql_templates import one_hop_templates
+from app.trapi.workflow import filter_kgraph_orphans, parse_workflow
+
+TEMPLATE = one_hop_templates[1]
+
+
+def test_parse_workflow():
+    assert parse_workflow({}) == (None, False)
+    assert parse_workflow({"workflow": [{"id": "lookup"}]}) == (None, False)
+    workflow = [
+        {"id": "lookup"},
+        {"id": "filter_results_top_n", "parameters": {"max_results": 10}},
+        {"id": "filter_kgraph_orphans"},
+        {"id": "filter_results_top_n", "parameters": {"max_results": 5}},
+    ]
+    assert parse_workflow({"workflow": workflow}) == (5, True)
+
+
+@pytest.mark.parametrize(
+    "workflow",
+    [
+        {"id": "lookup"},
+        [{"id": "lookup"}, {"id": "sort_results_score"}],
+        [{"id": "filter_results_top_n", "parameters": {"max_results": 5}}],
+        [{"id": "lookup"}, {"id": "lookup"}],
+        [{"id": "lookup"}, {"id": "filter_results_top_n", "parameters": {"max_results": 0}}],
+        [{"id": "lookup"}, {"id": "filter_results_top_n", "parameters": {"max_results": True}}],
+        [{"id": "lookup"}, {"id": "filter_results_top_n"}],
+    ],
+)
+def test_parse_invalid_workflow(workflow):
+    with pytest.raises(ValueError):
+        parse_workflow({"workflow": workflow})
+
+
+def test_filter_kgraph_orphans():
+    knowledge_graph = {
+        "nodes": {"n1": {}, "n2": {}, "n3": {}, "n4": {}},
+        "edges": {"e1": {"subject": "n1", "object": "n2"}, "e2": {"subject": "n3", "object": "n4"}},
+    }
+    results = [{"node_bindings": {"a": [{"id": "n1"}]}, "analyses": [{"edge_bindings": {"b": [{"id": "e1"}]}}]}]
+    assert filter_kgraph_orphans(knowledge_graph, results) == {
+        "nodes": {"n1": {}, "n2": {}},
+        "edges": {"e1": {"subject": "n1", "object": "n2"}},
+    }
+
+
+def test_projection_from_query_options():
+    assert Projection.from_query_options({}) is None
+    assert Projection.from_query_options({"qualifiers": True}) is None
+    projection = Projection.from_query_options({"attributes": ["biolink:publications"]})
+    assert projection.attribute_types == {"biolink:publications"}
+    assert projection.qualifiers
+    projection = Projection.from_query_options({"qualifiers": False})
+    assert projection.attribute_types is None
+    assert not projection.qualifiers
+    for options in [{"attributes": "biolink:publications"}, {"attributes": [1]}, {"qualifiers": "false"}]:
+        with pytest.raises(ValueError):
+            Projection.from_query_options(options)
+
+
+def test_projection_apply():
+    edge = {
+        "attributes": [{"attribute_type_id": "biolink:publications"}, {"attribute_type_id": "biolink:name"}],
+        "qualifiers": [{"qualifier_type_id": "biolink:qualified_predicate"}],
+    }
+    Projection(["biolink:name"], qualifiers=False).apply(edge)
+    assert edge == {"attributes": [{"attribute_type_id": "biolink:name"}], "qualifiers": []}
+
+
+# Graph pattern of each OPTIONAL block dropped by a projection
+PATTERNS = {
+    "attribute_block": "biolink:has_attribute_type ?attribute_type",
+    "publications_block": "biolink:publications ?publications",
+    "label_block": "biolink:name ?label",
+    "description_block": "biolink:description ?description",
+    "qualifier_block": "?association ?qualifier ?qualifier_value",
+}
+
+
+def rendered_blocks(projection):
+    query = TEMPLATE.render({"subject": ["http://a/1"]}, 10, projection=projection)
+    # The knowledge sources are always retrieved
+    assert "biolink:primary_knowledge_source ?pks" in query
+    return {name for name, pattern in PATTERNS.items() if pattern in query}
+
+
+def test_projection_drops_optional_blocks():
+    assert rendered_blocks(None) == set(PATTERNS)
+    assert rendered_blocks(Projection(None, qualifiers=True)) == set(PATTERNS)
+    assert rendered_blocks(Projection([], qualifiers=False)) == set()
+    assert rendered_blocks(Projection(["biolink:publications"])) == {"publications_block", "qualifier_block"}
+    assert rendered_blocks(Projection(["biolink:name", "biolink:description"], qualifiers=False)) == {
+        "label_block",
+        "description_block",
+    }
+    # Attribute types without a dedicated variable are retrieved by the generic attribute block
+    assert rendered_blocks(Projection(["biolink:evidence_count"], qualifiers=False)) == {"attribute_block"}
@@ -0,0 +1,50 @@
+from app.trapi.retractions import InvalidatedNanopubs
+
+
+class CannedSparql:
+    """Answer the queries of InvalidatedNanopubs.refresh with canned bindings"""
+
+    def __init__(self, latest_created, invalidated):
+        self.latest_created = latest_created
+        self.invalidated = invalidated
+        self.queries = []
+
+    def __call__(self, query):
+        self.queries.append(query)
+        if "MAX(?created)" in query:
+            return [{"latest_created": {"type": "literal", "value": self.latest_created}}]
+        return [{"np_uri": {"type": "uri", "value": uri}} for uri in self.invalidated]
+
+
+def test_refresh_retracted_and_superseded():
+    """Test the nanopubs retracted in an assertion or superseded in a publication info are invalidated"""
+    sparql = CannedSparql("2023-01-01T00:00:00Z", ["http://np/retracted", "http://np/superseded"])
+    invalidated = InvalidatedNanopubs()
+    assert not invalidated.loaded
+    assert invalidated.refresh(sparql) == 2
+    assert invalidated.loaded
+    assert "http://np/retracted" in invalidated
+    assert "http://np/superseded" in invalidated
+    assert "http://np/valid" not in invalidated
+
+    query = sparql.queries[-1]
+    assert "npx:retracts" in query and "np:hasAssertion" in query
+    # npx:supersedes is published in the publication info graph of the new version
+    supersedes_branch = query[query.index("UNION") :]
+    assert "np:hasPublicationInfo ?invalidating_graph" in supersedes_branch
+    assert "npx:supersedes ?np_uri" in supersedes_branch
+    assert "?_created_filter" not in query
+
+
+def test_refresh_incremental():
+    """Test the next refresh only retrieves the nanopubs invalidated since the previous one"""
+    sparql = CannedSparql("2023-01-01T00:00:00Z", ["http://np/1"])
+    invalidated = InvalidatedNanopubs()
+    invalidated.refresh(sparql)
+    sparql.latest_created = "2023-02-01T00:00:00Z"
+    sparql.invalidated = ["http://np/2"]
+    assert invalidated.refresh(sparql) == 1
+    assert '?created > "2023-01-01T00:00:00Z"^^xsd:dateTime' in sparql.queries[-1]
+    assert '?created <= "2023-02-01T00:00:00Z"^^xsd:dateTime' in sparql.queries[-1]
+    assert "http://np/1" in invalidated and "http://np/2" in invalidated
+    assert len(invalidated) == 2
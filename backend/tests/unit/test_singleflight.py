@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+from app.deadline import Deadline
+from app.singleflight import coalesce
+
+
+def start(function, *args, **kwargs):
+    """Call a function in a thread, and get the thread and a list receiving its result"""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function(*args, **kwargs)))
+    thread.start()
+    return thread, results
+
+
+def wait_followers(function, *args, count=1, **kwargs):
+    for _ in range(100):
+        if function.followers(*args, **kwargs) == count:
+            return
+        time.sleep(0.01)
+    raise AssertionError("The followers did not join the call in flight")
+
+
+def test_followers_get_a_copy_of_the_result():
+    release = threading.Event()
+    calls = []
+
+    @coalesce(ignore=("deadline",))
+    def answer(query, deadline=None):
+        calls.append(query)
+        release.wait(5)
+        return {"results": [query]}
+
+    leader, leader_results = start(answer, "q", deadline=Deadline(60))
+    while not calls:
+        time.sleep(0.01)
+    follower, follower_results = start(answer, "q", deadline=Deadline(60))
+    wait_followers(answer, "q")
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == ["q"]
+    assert leader_results == follower_results == [{"results": ["q"]}]
+    assert leader_results[0] is not follower_results[0]
+
+
+def test_followers_get_the_error():
+    release = threading.Event()
+
+    @coalesce
+    def answer(query):
+        release.wait(5)
+        raise ValueError(query)
+
+    leader, _ = start(lambda: pytest.raises(ValueError, answer, "q"))
+    time.sleep(0.05)
+    errors = []
+    follower = threading.Thread(target=lambda: errors.append(pytest.raises(ValueError, answer, "q").value))
+    follower.start()
+    wait_followers(answer, "q")
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert [str(error) for error in errors] == ["q"]
+
+
+def test_follower_stops_waiting_at_its_deadline():
+    """Test a follower with a shorter deadline runs the call itself when its deadline expires"""
+    release = threading.Event()
+    calls = []
+
+    @coalesce(ignore=("deadline",))
+    def answer(query, deadline=None):
+        calls.append(deadline)
+        if deadline.expired:
+            return {"results": [], "truncated": True}
+        release.wait(5)
+        return {"results": [query], "truncated": False}
+
+    leader_deadline = Deadline(60)
+    leader, leader_results = start(answer, "q", deadline=leader_deadline)
+    while not calls:
+        time.sleep(0.01)
+
+    follower_deadline = Deadline(0.2)
+    start_time = time.monotonic()
+    assert answer("q", deadline=follower_deadline) == {"results": [], "truncated": True}
+    assert time.monotonic() - start_time < 2
+    assert calls == [leader_deadline, follower_deadline]
+    # The follower left, so the leader has no follower anymore and can be cancelled
+    assert answer.followers("q") == 0
+
+    release.set()
+    leader.join(5)
+    assert leader_results == [{"results": ["q"], "truncated": False}]
+
+
+def test_cancelled_follower_stops_waiting():
+    release = threading.Event()
+    started = threading.Event()
+
+    @coalesce(ignore=("deadline",))
+    def answer(query, deadline=None):
+        if started.is_set():
+            return None
+        started.set()
+        release.wait(5)
+        return query
+
+    leader, _ = start(answer, "q", deadline=Deadline(60))
+    started.wait(5)
+    follower_deadline = Deadline(60)
+    follower, follower_results = start(answer, "q", deadline=follower_deadline)
+    wait_followers(answer, "q")
+    follower_deadline.cancel()
+    follower.join(2)
+    assert not follower.is_alive()
+    assert follower_results == [None]
+    release.set()
+    leader.join(5)
+
+
+def test_follower_runs_the_call_when_the_leader_result_is_truncated():
+    """Test a follower with time left does not get the result truncated by the shorter deadline of the leader"""
+    release = threading.Event()
+    calls = []
+
+    @coalesce(ignore=("deadline",))
+    def answer(query, deadline=None):
+        calls.append(deadline)
+        if deadline.seconds < 1:
+            release.wait(5)
+            deadline.truncated = True
+        return {"results": [query], "truncated": deadline.truncated}
+
+    leader_deadline = Deadline(0.5)
+    leader, leader_results = start(answer, "q", deadline=leader_deadline)
+    while not calls:
+        time.sleep(0.01)
+    follower_deadline = Deadline(60)
+    follower, follower_results = start(answer, "q", deadline=follower_deadline)
+    wait_followers(answer, "q")
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == [leader_deadline, follower_deadline]
+    assert leader_results == [{"results": ["q"], "truncated": True}]
+    assert follower_results == [{"results": ["q"], "truncated": False}]
+
+
+def test_cancel_follower_and_leader():
+    """Test cancelling a follower stops its wait, and the leader is only cancelled once its followers left"""
+    release = threading.Event()
+    started = threading.Event()
+
+    @coalesce(ignore=("deadline",))
+    def answer(query, deadline=None):
+        if started.is_set():
+            return None
+        started.set()
+        release.wait(5)
+        return query
+
+    leader_deadline = Deadline(60)
+    leader, _ = start(answer, "q", deadline=leader_deadline)
+    started.wait(5)
+    follower_deadline = Deadline(60)
+    follower, follower_results = start(answer, "q", deadline=follower_deadline)
+    wait_followers(answer, "q")
+
+    # The follower still waits for the leader
+    answer.cancel("q", deadline=leader_deadline)
+    assert not leader_deadline.expired
+    assert follower.is_alive()
+
+    answer.cancel("q", deadline=follower_deadline)
+    follower.join(2)
+    assert not follower.is_alive()
+    assert follower_results == [None]
+    assert follower_deadline.expired
+    # Nobody waits for the result of the leader anymore
+    assert leader_deadline.expired
+    release.set()
+    leader.join(5)
@@ -0,0 +1,65 @@
+import pytest
+from app.trapi.sparql_builder import OneHopTemplate, QueryTemplate, sparql_iri
+
+QUERY = """SELECT * WHERE {
+  ?_association_window
+  ?_entity_filters
+  ?association ?p ?o .
+  ?_label_block
+} LIMIT ?_limit"""
+WINDOW = """{ SELECT DISTINCT ?association WHERE {
+      ?_values
+      ?_prov_block
+      ?association ?p ?o .
+    } LIMIT ?_limit OFFSET ?_offset }"""
+LABEL_BLOCK = "OPTIONAL { ?association rdfs:label ?label }"
+
+
+def test_render_missing_placeholders():
+    template = QueryTemplate("SELECT ?_vars WHERE { ?_pattern } LIMIT ?_limit")
+    assert template.render(limit="5") == "SELECT  WHERE {  } LIMIT 5"
+    assert template.fill(limit="5") == "SELECT ?_vars WHERE { ?_pattern } LIMIT 5"
+    assert template.partial(vars="?s").render(pattern="?s ?p ?o") == "SELECT ?s WHERE { ?s ?p ?o } LIMIT "
+
+
+@pytest.mark.parametrize("uri", ["", "http://a b", "http://a>", "http://a/{x}", 'http://a"', "http://a\\b"])
+def test_sparql_iri_rejects_unsafe_uris(uri):
+    with pytest.raises(ValueError):
+        sparql_iri(uri)
+
+
+def test_one_hop_values_blocks():
+    template = OneHopTemplate(QUERY, WINDOW, {"label_block": (LABEL_BLOCK, ("biolink:name",))})
+    query = template.render(
+        {"subject": ["http://a/1", "http://a/2", "http://a/1"], "object_category": ["http://c/1"], "object": []},
+        10,
+        20,
+        prov_block="?association prov:wasDerivedFrom ?p .",
+    )
+    # Duplicates are removed, empty lists are not constrained
+    assert "VALUES ?subject { <http://a/1> <http://a/2> }" in query
+    assert "VALUES ?object " not in query
+    # The categories are constrained again in the main query
+    assert query.count("VALUES ?object_category { <http://c/1> }") == 2
+    assert "LIMIT 10 OFFSET 20" in query
+    assert "?association prov:wasDerivedFrom ?p ." in query
+    assert LABEL_BLOCK in query
+    assert "?_" not in query
+
+    with pytest.raises(ValueError):
+        template.render({"subject": ["http://a/1> } DROP ALL {"]}, 10)
+
+
+def test_one_hop_skeleton_cached_per_shape():
+    template = OneHopTemplate(QUERY, WINDOW)
+    template.render({"subject": ["http://a/1"]}, 10)
+    template.render({"subject": ["http://a/2", "http://a/3"]}, 5)
+    assert list(template.skeletons) == [("subject",)]
+    skeleton = template.skeletons[("subject",)]
+    template.render({"object": ["http://a/1"], "subject": ["http://a/2"]}, 10)
+    # Shapes follow the order of ONE_HOP_VARIABLES, not the order of the constraints
+    assert list(template.skeletons) == [("subject",), ("subject", "object")]
+    assert template.skeleton(("subject",)) is skeleton
+    # The window placeholders stay in the skeleton, the ones of the main query only are dropped
+    assert "?_prov_block" in skeleton.fill()
+    assert "?_entity_filters" not in skeleton.fill()
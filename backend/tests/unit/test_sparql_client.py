@@ -0,0 +1,138 @@
+import itertools
+import threading
+import time
+
+import orjson
+import pytest
+import requests
+from app.circuit_breaker import OPEN, CircuitOpenError
+from app.deadline import Deadline
+from app.trapi.sparql_client import MIN_LATENCY_SAMPLES, QueryCancelledError, SparqlClient
+
+test_ids = itertools.count()
+
+
+class FakeResponse:
+    def __init__(self, body, status_code):
+        self.body = body
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), 10):
+            yield self.body[start : start + 10]
+
+
+class FakeSession:
+    """Session answering the bindings of its endpoint after a delay, or failing"""
+
+    def __init__(self, name, delay=0, status_code=200, error=None):
+        self.name = name
+        self.delay = delay
+        self.status_code = status_code
+        self.error = error
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, data, headers, stream, timeout):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        body = orjson.dumps({"head": {"vars": ["s"]}, "results": {"bindings": [{"s": {"value": self.name}}]}})
+        return FakeResponse(body, self.status_code)
+
+
+def make_client(*sessions):
+    """Client with an endpoint for each session, their URLs are unique so they do not share their governors"""
+    test_id = next(test_ids)
+    client = SparqlClient([f"http://sparql-{test_id}-{position}" for position in range(len(sessions))], timeout=5)
+    for endpoint, session in zip(client.endpoints, sessions):
+        endpoint.session = session
+    return client
+
+
+def answered_by(bindings):
+    return [row["s"]["value"] for row in bindings]
+
+
+def test_primary_answers():
+    primary, secondary = FakeSession("primary"), FakeSession("secondary")
+    client = make_client(primary, secondary)
+    assert answered_by(client.query("SELECT")) == ["primary"]
+    assert answered_by(client.stream("SELECT")) == ["primary"]
+    assert secondary.calls == 0
+
+
+def test_hedged_when_the_primary_is_slow():
+    """Test the query is hedged to the next endpoint once the primary is slower than its usual latencies"""
+    primary, secondary = FakeSession("primary", delay=0.5), FakeSession("secondary")
+    client = make_client(primary, secondary)
+    client.endpoints[0].latencies.extend([0.01] * MIN_LATENCY_SAMPLES)
+    client.endpoints[1].latencies.extend([0.02] * MIN_LATENCY_SAMPLES)
+    start = time.monotonic()
+    assert answered_by(client.query("SELECT")) == ["secondary"]
+    assert time.monotonic() - start < 0.4
+    assert primary.calls == 1 and secondary.calls == 1
+
+
+def test_failover():
+    primary = FakeSession("primary", error=requests.ConnectionError("refused"))
+    secondary = FakeSession("secondary", status_code=500)
+    third = FakeSession("third")
+    client = make_client(primary, secondary, third)
+    assert answered_by(client.query("SELECT")) == ["third"]
+    assert answered_by(client.stream("SELECT")) == ["third"]
+    assert (primary.calls, secondary.calls, third.calls) == (2, 2, 2)
+
+
+def test_all_endpoints_fail():
+    client = make_client(FakeSession("primary", status_code=502), FakeSession("secondary", status_code=503))
+    with pytest.raises(requests.HTTPError):
+        client.query("SELECT")
+    with pytest.raises(requests.HTTPError):
+        list(client.stream("SELECT"))
+
+
+def test_open_circuits_are_skipped():
+    primary, secondary = FakeSession("primary"), FakeSession("secondary")
+    client = make_client(primary, secondary)
+    client.endpoints[0].breaker.trip()
+    assert answered_by(client.query("SELECT")) == ["secondary"]
+    assert primary.calls == 0
+    client.endpoints[1].breaker.trip()
+    assert client.endpoints[1].breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        client.query("SELECT")
+    with pytest.raises(CircuitOpenError):
+        list(client.stream("SELECT"))
+
+
+def test_expired_deadline():
+    """Test a query is not sent once its deadline expired, and a timeout due to the deadline does not count as a
+    failure of the endpoint"""
+    session = FakeSession("primary")
+    client = make_client(session)
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+    with pytest.raises(QueryCancelledError):
+        client.query("SELECT", deadline=deadline)
+    assert session.calls == 0
+
+    # The requests time out once the deadline expired
+    session.delay = 0.03
+    session.error = requests.ReadTimeout("timeout")
+    for _ in range(5):
+        with pytest.raises(QueryCancelledError):
+            client.fetch(client.endpoints[0], "SELECT", deadline=Deadline(0.01))
+    assert client.endpoints[0].breaker.available
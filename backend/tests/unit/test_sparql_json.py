@@ -0,0 +1,51 @@
+import json
+
+import pytest
+from app.trapi.sparql_json import iter_bindings
+
+BINDINGS = [
+    {"s": {"type": "uri", "value": "http://drug/1"}, "label": {"type": "literal", "value": "Aspirine é ✓"}},
+    {"s": {"type": "uri", "value": "http://drug/2"}, "label": {"type": "literal", "value": 'Quote " and ] [ }'}},
+    {"s": {"type": "uri", "value": "http://drug/3"}},
+]
+BODY = json.dumps(
+    {"head": {"vars": ["s", "label"]}, "results": {"bindings": BINDINGS}}, ensure_ascii=False, indent=1
+).encode()
+
+
+def split(body, size):
+    return [body[start : start + size] for start in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(BODY)])
+def test_bindings_across_chunk_boundaries(size):
+    """Test the bindings are the same wherever the chunks are split, also inside multi-byte characters"""
+    assert list(iter_bindings(split(BODY, size))) == BINDINGS
+
+
+def test_bindings_are_yielded_before_the_end():
+    """Test a binding is yielded as soon as it is received"""
+    # Within the second binding
+    end = BODY.index(b"http://drug/2")
+    received = []
+
+    def chunks():
+        received.append(BODY[:end])
+        yield BODY[:end]
+        received.append(BODY[end:])
+        yield BODY[end:]
+
+    bindings = iter_bindings(chunks())
+    assert next(bindings) == BINDINGS[0]
+    assert len(received) == 1
+    assert list(bindings) == BINDINGS[1:]
+
+
+def test_empty_results():
+    assert list(iter_bindings([b'{"head": {"vars": []}, "results": {"bindings": []}}'])) == []
+
+
+@pytest.mark.parametrize("body", [BODY[: len(BODY) // 2], BODY[: BODY.index(b"]") - 3], b'{"error": "Timeout"}', b""])
+def test_truncated_or_invalid(body):
+    with pytest.raises(ValueError):
+        list(iter_bindings(split(body, 5)))
@@ -0,0 +1,41 @@
+import json
+
+from app.trapi.streaming import iter_trapi_response
+
+QUERY = {
+    "message": {"query_graph": {"nodes": {"n0": {}, "n1": {}}, "edges": {"e0": {"subject": "n0", "object": "n1"}}}}
+}
+
+
+def test_stream_response():
+    """Test the chunks of a streamed response form the TRAPI response"""
+
+    def answer_query(reasoner_query):
+        return {
+            "message": {
+                "query_graph": reasoner_query["message"]["query_graph"],
+                "knowledge_graph": {"nodes": {f"n{i}": {} for i in range(25)}, "edges": {"e": {}}},
+                "results": [{"i": i} for i in range(21)],
+            },
+            "status": "Success",
+            "logs": [],
+        }
+
+    response = json.loads(b"".join(iter_trapi_response(QUERY, answer_query, chunk_size=10)))
+    assert len(response["message"]["knowledge_graph"]["nodes"]) == 25
+    assert [result["i"] for result in response["message"]["results"]] == list(range(21))
+    assert response["message"]["query_graph"] == QUERY["message"]["query_graph"]
+    assert response["status"] == "Success"
+
+
+def test_stream_response_error():
+    """Test a query failing after the first chunk was sent still produces a valid JSON response, with the error"""
+
+    def answer_query(reasoner_query):
+        raise RuntimeError("upstream failure")
+
+    response = json.loads(b"".join(iter_trapi_response(QUERY, answer_query)))
+    assert response["message"]["results"] == []
+    assert response["status"] == "Error"
+    assert response["logs"][0]["level"] == "ERROR"
+    assert "upstream failure" in response["description"]
@@ -0,0 +1,46 @@
+import itertools
+
+import pytest
+from app.config import settings
+from app.trapi import validation
+from app.trapi.validation import check_query, should_validate
+
+QUERY_GRAPH = {"nodes": {"n0": {"ids": ["MONDO:1"]}, "n1": {}}, "edges": {"e0": {"subject": "n0", "object": "n1"}}}
+
+
+def test_should_validate_sample(monkeypatch):
+    monkeypatch.setattr(validation, "query_counter", itertools.count())
+    monkeypatch.setattr(settings, "DEV_MODE", False)
+    monkeypatch.setattr(settings, "TRAPI_VALIDATION_SAMPLE_RATE", 3)
+    assert [should_validate() for _ in range(7)] == [True, False, False, True, False, False, True]
+
+    monkeypatch.setattr(settings, "TRAPI_VALIDATION_SAMPLE_RATE", 0)
+    assert not any(should_validate() for _ in range(5))
+
+    monkeypatch.setattr(settings, "DEV_MODE", True)
+    assert all(should_validate() for _ in range(5))
+
+
+def test_check_query():
+    assert check_query({"message": {"query_graph": QUERY_GRAPH}}) is QUERY_GRAPH
+    assert check_query({"message": {"query_graph": QUERY_GRAPH}, "query_options": None}) is QUERY_GRAPH
+
+
+@pytest.mark.parametrize(
+    "reasoner_query",
+    [
+        [],
+        {},
+        {"message": None},
+        {"message": "query"},
+        {"message": {"query_graph": None}},
+        {"message": {"query_graph": {"nodes": [], "edges": {}}}},
+        {"message": {"query_graph": {"nodes": {}, "edges": {}}}},
+        {"message": {"query_graph": {"nodes": {}, "edges": ["e0"]}}},
+        {"message": {"query_graph": {"nodes": {"n0": None}, "edges": QUERY_GRAPH["edges"]}}},
+        {"message": {"query_graph": QUERY_GRAPH}, "query_options": ["n_results"]},
+    ],
+)
+def test_check_invalid_query(reasoner_query):
+    with pytest.raises(ValueError):
+        check_query(reasoner_query)